@@ -0,0 +1,48 @@
+"""Compares the throughput of batched feature extraction at different batch sizes on CPU.
+
+Run from the root of the repository:
+```
+python benchmarks/batch_extraction.py --max-edge 768 --images 8
+```
+"""
+import argparse
+import time
+
+import torch
+
+from common import ensure_model, sample_images
+from extern.cnn_matching.lib.cnn_feature import cnn_feature_extract, cnn_feature_extract_batch
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--max-edge", type=int, default=768, help="Longest edge of the sample images")
+    parser.add_argument("--images", type=int, default=8, help="Number of sample images")
+    parser.add_argument("--batch-sizes", type=int, nargs="+", default=[1, 4, 8])
+    parser.add_argument("--threads", type=int, default=None, help="torch CPU threads")
+    args = parser.parse_args()
+
+    if args.threads:
+        torch.set_num_threads(args.threads)
+    ensure_model()
+    images = sample_images(args.max_edge, args.images)
+    print(f"{len(images)} images, longest edge {args.max_edge}px, {torch.get_num_threads()} threads")
+
+    # Warm up
+    cnn_feature_extract(images[0], nfeatures=-1)
+
+    start = time.perf_counter()
+    for image in images:
+        cnn_feature_extract(image, nfeatures=-1)
+    elapsed = time.perf_counter() - start
+    print(f"{'per image':<14} {elapsed / len(images) * 1000:8.1f} ms/image")
+
+    for batch_size in args.batch_sizes:
+        start = time.perf_counter()
+        cnn_feature_extract_batch(images, nfeatures=-1, batch_size=batch_size)
+        elapsed = time.perf_counter() - start
+        print(f"{'batch ' + str(batch_size):<14} {elapsed / len(images) * 1000:8.1f} ms/image")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,48 @@
+"""Shared helpers for the benchmark scripts in this folder."""
+import glob
+import logging
+import os
+import sys
+
+import cv2
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SAMPLES = os.path.join(ROOT, "prototype_data", "amersfoort_test", "samples")
+
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+
+
+def sample_images(max_edge: int = 1024, count: int = None) -> list:
+    """The bundled TMK sample scans, shrunk so their longest edge is max_edge pixels."""
+    images = []
+    for fp in sorted(glob.glob(os.path.join(SAMPLES, "*.jpg")))[:count]:
+        image = cv2.imread(fp)
+        scale = max_edge / max(image.shape[:2])
+        images.append(cv2.resize(image, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA))
+    return images
+
+
+def warp(image, angle: float = 5, scale: float = 0.9):
+    """Rotated and scaled copy of an image, to match the image against."""
+    h, w = image.shape[:2]
+    matrix = cv2.getRotationMatrix2D((w / 2, h / 2), angle, scale)
+    return cv2.warpAffine(image, matrix, (w, h), borderValue=(255, 255, 255))
+
+
+def ensure_model():
+    """Loads the D2-Net weights, or random weights if d2_tf.pth isn't downloaded.
+
+    Random weights give the same timings, but no meaningful matches.
+    """
+    import torch
+    from extern.cnn_matching.lib import cnn_feature
+    from extern.cnn_matching.lib.model import D2Net
+
+    try:
+        return cnn_feature.get_model()
+    except FileNotFoundError:
+        logging.warning("d2_tf.pth not found, benchmarking with random weights.")
+        torch.manual_seed(0)
+        cnn_feature._model = D2Net(model_file=None, use_cuda=cnn_feature.use_cuda).eval()
+        return cnn_feature._model
@@ -0,0 +1,63 @@
+"""Compares the speed and match quality of the CPU backends of the feature extractor.
+
+Every sample sheet is matched against a rotated and scaled copy of itself. For every backend this
+reports the extraction time and the number of RANSAC inliers, next to the fp32 baseline.
+
+Run from the root of the repository:
+```
+python benchmarks/cpu_backend.py --max-edge 1024 --threads 8
+```
+"""
+import argparse
+import time
+
+import numpy as np
+
+from common import ensure_model, sample_images, warp
+from extern.cnn_matching.lib import cnn_feature
+from src.georeference.features import extract_features
+from src.georeference.matchfinder import _filter_matches_geometrically, _match_features
+
+BACKENDS = {
+    "fp32": dict(channels_last=False, bfloat16=False),
+    "fp32 channels_last": dict(channels_last=True, bfloat16=False),
+    "bf16 channels_last": dict(channels_last=True, bfloat16=True),
+}
+
+
+def count_inliers(image: np.ndarray, warped: np.ndarray) -> int:
+    matches = _match_features(extract_features(warped), extract_features(image))
+    if len(matches[0]) < 3:
+        return 0
+    return len(_filter_matches_geometrically(matches, seed=0)[0])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--max-edge", type=int, default=1024, help="Longest edge of the sample images")
+    parser.add_argument("--images", type=int, default=4, help="Number of sample images")
+    parser.add_argument("--threads", type=int, default=None, help="torch CPU threads")
+    args = parser.parse_args()
+
+    ensure_model()
+    images = sample_images(args.max_edge, args.images)
+    pairs = [(image, warp(image)) for image in images]
+
+    print(f"{'backend':<20} {'ms/image':>10} {'inliers':>10} {'vs fp32':>8}")
+    baseline = None
+    for name, options in BACKENDS.items():
+        cnn_feature.configure_cpu_backend(num_threads=args.threads, **options)
+        extract_features(images[0])  # Warm up
+
+        start = time.perf_counter()
+        for image in images:
+            extract_features(image)
+        elapsed = (time.perf_counter() - start) / len(images)
+
+        inliers = sum(count_inliers(image, warped) for image, warped in pairs)
+        baseline = baseline or inliers
+        print(f"{name:<20} {elapsed * 1000:10.1f} {inliers:10d} {inliers / max(baseline, 1):8.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,68 @@
+"""Compares scale schedules of the multiscale feature extraction on the sample sheets.
+
+Every sample sheet is matched against a rotated and scaled copy of itself. For every schedule this
+reports the time per scale, the number of keypoints found up to each scale, and the number of RANSAC inliers.
+
+Run from the root of the repository:
+```
+python benchmarks/scales.py --max-edge 2500 --min-keypoints 20000
+```
+"""
+import argparse
+import time
+from collections import defaultdict
+
+from common import ensure_model, sample_images, warp
+from extern.cnn_matching.lib.cnn_feature import cnn_feature_extract
+from src.georeference.features import Features
+from src.georeference.matchfinder import _filter_matches_geometrically, _match_features
+
+SCHEDULES = [
+    [0.25, 0.5, 1.0],
+    [0.5, 1.0],
+    [1.0],
+    [0.25, 0.5],
+]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--max-edge", type=int, default=1024, help="Longest edge of the sample images")
+    parser.add_argument("--images", type=int, default=4, help="Number of sample images")
+    parser.add_argument("--min-keypoints", type=int, default=None, help="Stop early at this many keypoints")
+    args = parser.parse_args()
+
+    ensure_model()
+    images = sample_images(args.max_edge, args.images)
+    cnn_feature_extract(images[0], nfeatures=-1)  # Warm up
+
+    for scales in SCHEDULES:
+        report = []
+        inliers = 0
+        start = time.perf_counter()
+        for image in images:
+            features = [
+                Features(*cnn_feature_extract(
+                    im, scales=scales, nfeatures=-1, min_keypoints=args.min_keypoints, report=report
+                ))
+                for im in (image, warp(image))
+            ]
+            matches = _match_features(features[1], features[0])
+            if len(matches[0]) >= 3:
+                inliers += len(_filter_matches_geometrically(matches, seed=0)[0])
+        elapsed = time.perf_counter() - start
+
+        seconds, keypoints, runs = defaultdict(float), defaultdict(int), defaultdict(int)
+        for level in report:
+            seconds[level["scale"]] += level["seconds"]
+            keypoints[level["scale"]] += level["keypoints"][0]
+            runs[level["scale"]] += 1
+        print(f"scales {scales}: {elapsed:.1f} s, {inliers} inliers")
+        for scale in scales:
+            if runs[scale]:
+                print(f"  {scale:<5} ran {runs[scale]:3d}x  {seconds[scale]:7.2f} s  "
+                      f"{keypoints[scale] / runs[scale]:9.0f} keypoints/image up to this scale")
+
+
+if __name__ == "__main__":
+    main()
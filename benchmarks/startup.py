@@ -0,0 +1,56 @@
+"""Measures the startup cost of the package.
+
+Every measurement runs in a fresh interpreter, so nothing is cached in the process:
+- `import src`: what scripts pay that never match features (e.g. combine.py or the unit tests).
+- `import cnn_feature`: importing torch and the feature extraction code.
+- `get_model()`: constructing D2Net and loading d2_tf.pth, only done on the first feature extraction.
+
+Run from the root of the repository:
+```
+python benchmarks/startup.py
+```
+"""
+import os
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+REPEATS = 5
+
+SNIPPETS = {
+    "import src": "import src",
+    "import cnn_feature": "import extern.cnn_matching.lib.cnn_feature",
+    "get_model()": "from extern.cnn_matching.lib.cnn_feature import get_model; get_model()",
+}
+
+TIMER = """
+import time
+start = time.perf_counter()
+{snippet}
+print(time.perf_counter() - start)
+"""
+
+
+def time_snippet(snippet: str) -> float:
+    result = subprocess.run(
+        [sys.executable, "-c", TIMER.format(snippet=snippet)],
+        cwd=ROOT, capture_output=True, text=True,
+    )
+    if result.returncode != 0:
+        raise RuntimeError(result.stderr.strip().splitlines()[-1])
+    return float(result.stdout.strip().splitlines()[-1])
+
+
+def main():
+    for name, snippet in SNIPPETS.items():
+        try:
+            timings = [time_snippet(snippet) for _ in range(REPEATS)]
+        except RuntimeError as e:
+            print(f"{name:<20} failed: {e}")
+            continue
+        print(f"{name:<20} min {min(timings) * 1000:8.1f} ms   "
+              f"mean {sum(timings) / len(timings) * 1000:8.1f} ms")
+
+
+if __name__ == "__main__":
+    main()
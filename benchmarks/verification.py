@@ -0,0 +1,82 @@
+"""Compares the geometric verification of src.georeference.verification with skimage's RANSAC.
+
+Runs on stored match sets: .npz files with the (N, 2) arrays `image` and `reference`. Store the matches of a
+real run with:
+```
+np.savez("matches/sheet.npz", image=matches[0], reference=matches[1])
+```
+Without a folder, synthetic match sets with a known affine transform and different inlier ratios are used.
+
+Run from the root of the repository:
+```
+python benchmarks/verification.py --matches matches/
+```
+"""
+import argparse
+import glob
+import os
+import time
+
+import numpy as np
+from skimage import measure, transform
+
+import common  # noqa: F401, puts the repository on the path
+from src.georeference.verification import ransac_affine
+
+RESIDUAL_THRESHOLD = 50
+
+
+def synthetic_match_sets(total: int = 2000) -> dict:
+    rng = np.random.default_rng(0)
+    affine = np.array([[1.9, -0.1, 120], [0.08, 2.05, -40]])
+    match_sets = {}
+    for inlier_ratio in (0.1, 0.3, 0.6, 0.9):
+        src = rng.random((total, 2)) * 5000
+        dst = src @ affine[:, :2].T + affine[:, 2] + rng.normal(scale=5, size=(total, 2))
+        outliers = rng.random(total) > inlier_ratio
+        dst[outliers] = rng.random((outliers.sum(), 2)) * 10000
+        match_sets[f"synthetic {inlier_ratio:.0%} inliers"] = (src, dst)
+    return match_sets
+
+
+def run_skimage(matches, seed):
+    return measure.ransac(
+        matches, transform.AffineTransform, min_samples=3, residual_threshold=RESIDUAL_THRESHOLD,
+        max_trials=1000, rng=seed,
+    )[1]
+
+
+def run_verification(matches, seed):
+    return ransac_affine(matches, RESIDUAL_THRESHOLD, seed=seed).inliers
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--matches", help="Folder with .npz match sets")
+    parser.add_argument("--runs", type=int, default=5, help="Runs per match set, with different seeds")
+    args = parser.parse_args()
+
+    if args.matches:
+        match_sets = {}
+        for fp in sorted(glob.glob(os.path.join(args.matches, "*.npz"))):
+            with np.load(fp) as data:
+                match_sets[os.path.basename(fp)] = (data["image"], data["reference"])
+    else:
+        match_sets = synthetic_match_sets()
+
+    print(f"{'match set':<28} {'method':<13} {'ms':>8} {'inliers (min-max)':>18} {'same for all seeds':>19}")
+    for name, matches in match_sets.items():
+        for method, run in (("skimage", run_skimage), ("verification", run_verification)):
+            elapsed, results = 0, []
+            for seed in range(args.runs):
+                start = time.perf_counter()
+                results.append(run(matches, seed))
+                elapsed += time.perf_counter() - start
+            counts = [int(inliers.sum()) for inliers in results]
+            stable = all(np.array_equal(results[0], inliers) for inliers in results)
+            print(f"{name:<28} {method:<13} {elapsed / args.runs * 1000:8.1f} "
+                  f"{f'{min(counts)}-{max(counts)}':>18} {str(stable):>19}")
+
+
+if __name__ == "__main__":
+    main()
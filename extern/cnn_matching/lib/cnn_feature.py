@@ -1,4 +1,8 @@
+import logging
 import os
+import threading
+import warnings
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
 import cv2
@@ -8,29 +12,120 @@ import scipy.io
 import scipy.misc
 import torch
 
-from .model import D2Net
-from .pyramid import process_multiscale
+from .model import D2Net, set_cpu_backend
+from .pyramid import process_multiscale, process_multiscale_batch
 from .utils import preprocess_image
 
 use_cuda = torch.cuda.is_available()
 current_dir = os.path.dirname(__file__)
 cnn_dir = Path(current_dir).parent
-# Creating CNN model
-model = D2Net(
-    model_file=os.path.join(cnn_dir, 'models', 'd2_tf.pth'),
-    use_relu=True,
-    use_cuda=use_cuda,
-)
+model_file = os.path.join(cnn_dir, 'models', 'd2_tf.pth')
+# TorchScript version of the model, built from the weights the first time they're loaded. Named after the
+# torch version, since a scripted model isn't guaranteed to load in other versions.
+scripted_model_file = os.path.join(cnn_dir, 'models', f'd2_tf.torchscript-{torch.__version__}.pt')
+use_scripted_model = True
 device = torch.device("cuda:0" if use_cuda else "cpu")
 
+# CNN model, created on first use by get_model() so importing this module doesn't load the weights
+_model = None
+_model_lock = threading.Lock()
+# CPU backend options of the model, see configure_cpu_backend
+_channels_last = False
+_bfloat16 = False
+
+
+def get_model():
+    """Returns the process-wide D2Net model, loading it on the first call."""
+    global _model
+    if _model is None:
+        with _model_lock:
+            if _model is None:
+                if not os.path.exists(model_file):
+                    raise FileNotFoundError(
+                        f"D2-Net weights not found at {model_file}, see extern/cnn_matching/readme.md "
+                        f"for how to download them."
+                    )
+                with warnings.catch_warnings():
+                    # torch.jit warns that it is deprecated in favour of torch.export, but it is still supported
+                    warnings.simplefilter("ignore", FutureWarning)
+                    model = _load_model()
+                set_cpu_backend(model.dense_feature_extraction, _channels_last, _bfloat16)
+                _model = model
+    return _model
+
+
+def _load_model():
+    # TorchScript can't run the bfloat16 autocast, so that needs the eager model
+    scripted = use_scripted_model and not _bfloat16
+    if scripted and os.path.exists(scripted_model_file) \
+            and os.path.getmtime(scripted_model_file) >= os.path.getmtime(model_file):
+        return torch.jit.load(scripted_model_file, map_location=device)
+
+    model = D2Net(
+        model_file=model_file,
+        use_relu=True,
+        use_cuda=use_cuda,
+    ).eval()
+    if not scripted:
+        return model
+
+    try:
+        model = torch.jit.script(model)
+    except Exception as e:
+        logging.warning(f"Failed to script the D2-Net model, using the eager model: {e}")
+        return model
+
+    try:
+        tmp_file = f"{scripted_model_file}.{os.getpid()}.tmp"
+        torch.jit.save(model, tmp_file)
+        os.replace(tmp_file, scripted_model_file)
+    except OSError as e:
+        logging.warning(f"Failed to store the scripted D2-Net model at {scripted_model_file}: {e}")
+    return model
+
+
+def configure_cpu_backend(num_threads=None, channels_last=True, bfloat16=False):
+    """Settings for running the feature extraction on CPU.
+
+    Args:
+        num_threads: Number of threads torch uses per operation. Defaults to None (torch's default, the
+            number of physical cores).
+        channels_last: Run the convolutions on NHWC activations, which is faster with oneDNN.
+        bfloat16: Run the convolutions in bfloat16. Only faster on CPUs with AVX512-BF16 or AMX, and the
+            features differ slightly from fp32. Run benchmarks/cpu_backend.py to compare the match quality.
+    """
+    global _model, _channels_last, _bfloat16
+    if num_threads is not None:
+        torch.set_num_threads(num_threads)
+    _channels_last = channels_last
+    _bfloat16 = bfloat16
+    if _model is None:
+        return
+    if bfloat16 and isinstance(_model, torch.jit.ScriptModule):
+        # Loaded again as an eager model on next use
+        _model = None
+    else:
+        set_cpu_backend(_model.dense_feature_extraction, channels_last, bfloat16)
+
+
+def uses_bfloat16():
+    """Whether the features are extracted in bfloat16, see configure_cpu_backend."""
+    return _bfloat16
+
 multiscale = True
 max_edge = 2500
 max_sum_edges = 5000
+# Defaults for cnn_feature_extract_tiled
+tile_size = 1024
+tile_overlap = 128
 
 
 
-# de-net feature extract function
-def cnn_feature_extract(image, scales=[0.25, 0.50, 1.0], nfeatures=1000):
+def _resize_image(image):
+    """Converts the image to 3 float channels and shrinks it to fit max_edge and max_sum_edges.
+
+    Returns the resized image and the factors to go from resized to original pixel coordinates.
+    """
     if len(image.shape) == 2:
         image = image[:, :, np.newaxis]
         image = np.repeat(image, 3, -1)
@@ -50,26 +145,10 @@ def cnn_feature_extract(image, scales=[0.25, 0.50, 1.0], nfeatures=1000):
 
     fact_i = image.shape[0] / resized_image.shape[0]
     fact_j = image.shape[1] / resized_image.shape[1]
+    return resized_image, fact_i, fact_j
 
-    input_image = preprocess_image(resized_image, preprocessing="torch")
-    with torch.no_grad():
-        if multiscale:
-            keypoints, scores, descriptors = process_multiscale(
-                torch.tensor(
-                    input_image[np.newaxis, :, :, :].astype(np.float32), device=device
-                ),
-                model,
-                scales,
-            )
-        else:
-            keypoints, scores, descriptors = process_multiscale(
-                torch.tensor(
-                    input_image[np.newaxis, :, :, :].astype(np.float32), device=device
-                ),
-                model,
-                scales,
-            )
 
+def _postprocess(keypoints, scores, descriptors, fact_i, fact_j, nfeatures):
     # Input image coordinates
     keypoints[:, 0] *= fact_i
     keypoints[:, 1] *= fact_j
@@ -77,15 +156,155 @@ def cnn_feature_extract(image, scales=[0.25, 0.50, 1.0], nfeatures=1000):
     keypoints = keypoints[:, [1, 0, 2]]
 
     if nfeatures != -1:
-        # 根据scores排序
-        scores2 = np.array([scores]).T
-        res = np.hstack((scores2, keypoints))
-        res = res[np.lexsort(-res[:, ::-1].T)]
-
-        res = np.hstack((res, descriptors))
-        # 取前几个
-        scores = res[0:nfeatures, 0].copy()
-        keypoints = res[0:nfeatures, 1:4].copy()
-        descriptors = res[0:nfeatures, 4:].copy()
-        del res
+        # Highest scores first, ties ordered by the keypoint location. Only the candidates for the top
+        # nfeatures are sorted, instead of all keypoints with their descriptors.
+        candidates = np.arange(len(scores))
+        if 0 < nfeatures < len(scores):
+            kth_score = scores[np.argpartition(-scores, nfeatures - 1)[nfeatures - 1]]
+            candidates = np.flatnonzero(scores >= kth_score)
+        order = np.lexsort((
+            -keypoints[candidates, 2], -keypoints[candidates, 1], -keypoints[candidates, 0], -scores[candidates]
+        ))
+        top = candidates[order][:nfeatures]
+        keypoints, scores, descriptors = keypoints[top], scores[top], descriptors[top]
     return keypoints, scores, descriptors
+
+
+# de-net feature extract function
+def cnn_feature_extract(image, scales=[0.25, 0.50, 1.0], nfeatures=1000, min_keypoints=None, report=None):
+    """Extracts D2-Net features from an image at the given scales, from coarse to fine.
+
+    min_keypoints and report are passed to process_multiscale: stop once this many keypoints are found, and
+    collect the time and number of keypoints per scale to tune the scales.
+    """
+    resized_image, fact_i, fact_j = _resize_image(image)
+
+    input_image = preprocess_image(resized_image, preprocessing="torch")
+    model = get_model()
+    with torch.no_grad():
+        keypoints, scores, descriptors = process_multiscale(
+            torch.tensor(
+                input_image[np.newaxis, :, :, :].astype(np.float32), device=device
+            ),
+            model,
+            scales,
+            min_keypoints=min_keypoints,
+            report=report,
+        )
+
+    return _postprocess(keypoints, scores, descriptors, fact_i, fact_j, nfeatures)
+
+
+def cnn_feature_extract_batch(images, scales=[0.25, 0.50, 1.0], nfeatures=1000, batch_size=4, min_keypoints=None,
+                              report=None):
+    """Same as cnn_feature_extract, but for a list of images that go through the network in batches.
+
+    Images are sorted by size and grouped in batches of similar size, which are padded to the largest
+    image in the batch. Keypoints in the padding are dropped. Close to the padded edges the features can
+    differ slightly from those of cnn_feature_extract, since the network sees the padding.
+
+    Returns:
+        A list with the (keypoints, scores, descriptors) of every image, in the order of the input.
+    """
+    prepared = []
+    for image in images:
+        resized_image, fact_i, fact_j = _resize_image(image)
+        prepared.append((preprocess_image(resized_image, preprocessing="torch"), fact_i, fact_j))
+
+    # Buckets of similar size waste the least computation on padding
+    order = sorted(range(len(prepared)), key=lambda k: prepared[k][0].shape[1] * prepared[k][0].shape[2])
+    model = get_model()
+    results = [None] * len(prepared)
+    for start in range(0, len(order), batch_size):
+        bucket = order[start:start + batch_size]
+        image_sizes = [prepared[k][0].shape[1:] for k in bucket]
+        h = max(size[0] for size in image_sizes)
+        w = max(size[1] for size in image_sizes)
+
+        # Padding with zeros, which is the mean color after preprocessing
+        batch = np.zeros((len(bucket), 3, h, w), dtype=np.float32)
+        for i, k in enumerate(bucket):
+            input_image = prepared[k][0]
+            batch[i, :, :input_image.shape[1], :input_image.shape[2]] = input_image
+
+        with torch.no_grad():
+            outputs = process_multiscale_batch(
+                torch.tensor(batch, device=device), model, scales, image_sizes, min_keypoints, report
+            )
+        del batch
+
+        for k, (keypoints, scores, descriptors) in zip(bucket, outputs):
+            _, fact_i, fact_j = prepared[k]
+            results[k] = _postprocess(keypoints, scores, descriptors, fact_i, fact_j, nfeatures)
+    return results
+
+
+def _tile_layout(length, size, overlap):
+    """Start positions of overlapping tiles along one axis, and the part of the axis every tile owns.
+
+    A keypoint in the overlap of two tiles belongs to the tile of which it is furthest from the edge,
+    so the owned parts cover the axis exactly once.
+    """
+    if length <= size:
+        return [0], [(0, length)]
+    stride = size - overlap
+    starts = list(range(0, length - size, stride)) + [length - size]
+    boundaries = [0] + [(start + previous + size) // 2 for previous, start in zip(starts, starts[1:])] + [length]
+    return starts, list(zip(boundaries, boundaries[1:]))
+
+
+def cnn_feature_extract_tiled(image, scales=[0.25, 0.50, 1.0], nfeatures=1000, tile_size=tile_size,
+                              overlap=tile_overlap, max_workers=1, min_keypoints=None):
+    """Same as cnn_feature_extract, but runs the network on overlapping tiles of the full resolution image.
+
+    The image isn't shrunk to max_edge, and the memory needed is bounded by the tile size instead of the
+    image size. Keypoints are only kept from the tile that owns their location, so features in the
+    overlaps aren't duplicated. The overlap should be larger than the receptive field of the features
+    that matter, otherwise keypoints near tile edges differ from those of the whole image.
+
+    Args:
+        tile_size: Width and height of the tiles in pixels.
+        overlap: Number of pixels neighbouring tiles share.
+        max_workers: Number of tiles processed at the same time. Torch already uses multiple threads per
+            tile, so more workers mainly help when the thread count is limited.
+        min_keypoints: Stop at the scale at which a tile has this many keypoints, see process_multiscale.
+    """
+    if overlap >= tile_size:
+        raise ValueError(f"The overlap ({overlap}) must be smaller than the tile size ({tile_size}).")
+
+    if len(image.shape) == 2:
+        image = np.repeat(image[:, :, np.newaxis], 3, -1)
+    model = get_model()
+    rows, row_cores = _tile_layout(image.shape[0], tile_size, overlap)
+    cols, col_cores = _tile_layout(image.shape[1], tile_size, overlap)
+
+    def extract_tile(tile):
+        (i0, (core_i0, core_i1)), (j0, (core_j0, core_j1)) = tile
+        crop = image[i0:i0 + tile_size, j0:j0 + tile_size].astype("float")
+        input_image = preprocess_image(crop, preprocessing="torch")
+        with torch.no_grad():
+            keypoints, scores, descriptors = process_multiscale(
+                torch.tensor(input_image[np.newaxis, :, :, :].astype(np.float32), device=device),
+                model,
+                scales,
+                min_keypoints=min_keypoints,
+            )
+        keypoints[:, 0] += i0
+        keypoints[:, 1] += j0
+        owned = (
+            (keypoints[:, 0] >= core_i0) & (keypoints[:, 0] < core_i1)
+            & (keypoints[:, 1] >= core_j0) & (keypoints[:, 1] < core_j1)
+        )
+        return keypoints[owned], scores[owned], descriptors[owned]
+
+    tiles = [(row, col) for row in zip(rows, row_cores) for col in zip(cols, col_cores)]
+    if max_workers > 1:
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            outputs = list(executor.map(extract_tile, tiles))
+    else:
+        outputs = [extract_tile(tile) for tile in tiles]
+
+    keypoints = np.concatenate([output[0] for output in outputs])
+    scores = np.concatenate([output[1] for output in outputs])
+    descriptors = np.concatenate([output[2] for output in outputs])
+    return _postprocess(keypoints, scores, descriptors, 1, 1, nfeatures)
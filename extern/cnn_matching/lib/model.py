@@ -34,15 +34,42 @@ class DenseFeatureExtractionModule(nn.Module):
         self.num_channels = 512
 
         self.use_relu = use_relu
+        # CPU backend options, see set_cpu_backend. Plain attributes so they can be changed after scripting
+        self.channels_last = False
+        self.bfloat16 = False
 
         if use_cuda:
             self.model = self.model.cuda()
 
     def forward(self, batch):
-        output = self.model(batch)
+        if self.channels_last:
+            batch = batch.contiguous(memory_format=torch.channels_last)
+        if self.bfloat16:
+            with torch.autocast("cpu", dtype=torch.bfloat16):
+                output = self.model(batch)
+        else:
+            output = self.model(batch)
         if self.use_relu:
             output = F.relu(output)
-        return output
+        # The detection and description steps expect a contiguous fp32 tensor
+        return output.float().contiguous()
+
+
+def set_cpu_backend(dense_feature_extraction, channels_last=False, bfloat16=False):
+    """Faster inference on CPU, for an eager or scripted DenseFeatureExtractionModule.
+
+    channels_last stores the activations as NHWC, which is the layout the oneDNN convolutions are fastest
+    with. bfloat16 runs the convolutions with bfloat16 autocast, which is only faster on CPUs with
+    AVX512-BF16 or AMX and changes the features slightly. TorchScript can't run the autocast, so bfloat16
+    needs the eager module.
+    """
+    if bfloat16 and isinstance(dense_feature_extraction, torch.jit.ScriptModule):
+        raise ValueError("bfloat16 autocast is not supported for a scripted model, use the eager model.")
+    dense_feature_extraction.channels_last = channels_last
+    dense_feature_extraction.bfloat16 = bfloat16
+    memory_format = torch.channels_last if channels_last else torch.contiguous_format
+    dense_feature_extraction.model.to(memory_format=memory_format)
+    return dense_feature_extraction
 
 
 class D2Net(nn.Module):
@@ -62,6 +89,10 @@ class D2Net(nn.Module):
                 torch.load(model_file, map_location=torch.device("cpu"))["model"]
             )
 
+        if use_cuda:
+            self.detection = self.detection.cuda()
+            self.localization = self.localization.cuda()
+
     def forward(self, batch):
         _, _, h, w = batch.size()
         dense_features = self.dense_feature_extraction(batch)
@@ -83,21 +114,22 @@ class HardDetectionModule(nn.Module):
 
         self.edge_threshold = edge_threshold
 
-        self.dii_filter = torch.tensor([[0, 1.0, 0], [0, -2.0, 0], [0, 1.0, 0]]).view(
+        # Buffers move with the module to the right device, instead of being copied on every call. Not
+        # persistent, since they're not in the state dict of the published weights.
+        self.register_buffer("dii_filter", torch.tensor([[0, 1.0, 0], [0, -2.0, 0], [0, 1.0, 0]]).view(
             1, 1, 3, 3
-        )
-        self.dij_filter = 0.25 * torch.tensor(
+        ), persistent=False)
+        self.register_buffer("dij_filter", 0.25 * torch.tensor(
             [[1.0, 0, -1.0], [0, 0.0, 0], [-1.0, 0, 1.0]]
-        ).view(1, 1, 3, 3)
-        self.djj_filter = torch.tensor([[0, 0, 0], [1.0, -2.0, 1.0], [0, 0, 0]]).view(
+        ).view(1, 1, 3, 3), persistent=False)
+        self.register_buffer("djj_filter", torch.tensor([[0, 0, 0], [1.0, -2.0, 1.0], [0, 0, 0]]).view(
             1, 1, 3, 3
-        )
+        ), persistent=False)
 
     def forward(self, batch):
         b, c, h, w = batch.size()
-        device = batch.device
-
-        depth_wise_max = torch.max(batch, dim=1)[0]
+        # keepdim, otherwise the comparison below broadcasts wrongly for batches of more than one image
+        depth_wise_max = torch.max(batch, dim=1, keepdim=True)[0]
         is_depth_wise_max = batch == depth_wise_max
         del depth_wise_max
 
@@ -106,13 +138,13 @@ class HardDetectionModule(nn.Module):
         del local_max
 
         dii = F.conv2d(
-            batch.view(-1, 1, h, w), self.dii_filter.to(device), padding=1
+            batch.view(-1, 1, h, w), self.dii_filter, padding=1
         ).view(b, c, h, w)
         dij = F.conv2d(
-            batch.view(-1, 1, h, w), self.dij_filter.to(device), padding=1
+            batch.view(-1, 1, h, w), self.dij_filter, padding=1
         ).view(b, c, h, w)
         djj = F.conv2d(
-            batch.view(-1, 1, h, w), self.djj_filter.to(device), padding=1
+            batch.view(-1, 1, h, w), self.djj_filter, padding=1
         ).view(b, c, h, w)
 
         det = dii * djj - dij * dij
@@ -132,35 +164,33 @@ class HandcraftedLocalizationModule(nn.Module):
     def __init__(self):
         super(HandcraftedLocalizationModule, self).__init__()
 
-        self.di_filter = torch.tensor([[0, -0.5, 0], [0, 0, 0], [0, 0.5, 0]]).view(
+        self.register_buffer("di_filter", torch.tensor([[0, -0.5, 0], [0, 0, 0], [0, 0.5, 0]]).view(
             1, 1, 3, 3
-        )
-        self.dj_filter = torch.tensor([[0, 0, 0], [-0.5, 0, 0.5], [0, 0, 0]]).view(
+        ), persistent=False)
+        self.register_buffer("dj_filter", torch.tensor([[0, 0, 0], [-0.5, 0, 0.5], [0, 0, 0]]).view(
             1, 1, 3, 3
-        )
+        ), persistent=False)
 
-        self.dii_filter = torch.tensor([[0, 1.0, 0], [0, -2.0, 0], [0, 1.0, 0]]).view(
+        self.register_buffer("dii_filter", torch.tensor([[0, 1.0, 0], [0, -2.0, 0], [0, 1.0, 0]]).view(
             1, 1, 3, 3
-        )
-        self.dij_filter = 0.25 * torch.tensor(
+        ), persistent=False)
+        self.register_buffer("dij_filter", 0.25 * torch.tensor(
             [[1.0, 0, -1.0], [0, 0.0, 0], [-1.0, 0, 1.0]]
-        ).view(1, 1, 3, 3)
-        self.djj_filter = torch.tensor([[0, 0, 0], [1.0, -2.0, 1.0], [0, 0, 0]]).view(
+        ).view(1, 1, 3, 3), persistent=False)
+        self.register_buffer("djj_filter", torch.tensor([[0, 0, 0], [1.0, -2.0, 1.0], [0, 0, 0]]).view(
             1, 1, 3, 3
-        )
+        ), persistent=False)
 
     def forward(self, batch):
         b, c, h, w = batch.size()
-        device = batch.device
-
         dii = F.conv2d(
-            batch.view(-1, 1, h, w), self.dii_filter.to(device), padding=1
+            batch.view(-1, 1, h, w), self.dii_filter, padding=1
         ).view(b, c, h, w)
         dij = F.conv2d(
-            batch.view(-1, 1, h, w), self.dij_filter.to(device), padding=1
+            batch.view(-1, 1, h, w), self.dij_filter, padding=1
         ).view(b, c, h, w)
         djj = F.conv2d(
-            batch.view(-1, 1, h, w), self.djj_filter.to(device), padding=1
+            batch.view(-1, 1, h, w), self.djj_filter, padding=1
         ).view(b, c, h, w)
         det = dii * djj - dij * dij
 
@@ -170,10 +200,10 @@ class HandcraftedLocalizationModule(nn.Module):
         del dii, dij, djj, det
 
         di = F.conv2d(
-            batch.view(-1, 1, h, w), self.di_filter.to(device), padding=1
+            batch.view(-1, 1, h, w), self.di_filter, padding=1
         ).view(b, c, h, w)
         dj = F.conv2d(
-            batch.view(-1, 1, h, w), self.dj_filter.to(device), padding=1
+            batch.view(-1, 1, h, w), self.dj_filter, padding=1
         ).view(b, c, h, w)
 
         step_i = -(inv_hess_00 * di + inv_hess_01 * dj)
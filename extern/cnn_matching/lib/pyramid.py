@@ -1,3 +1,6 @@
+import logging
+import time
+
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
@@ -5,26 +8,57 @@ import torch.nn.functional as F
 from .exceptions import EmptyTensorError
 from .utils import interpolate_dense_features, upscale_positions
 import numpy as np
-import matplotlib.pyplot as plt
 
-def process_multiscale(image, model, scales=[.25, 0.50, 1.0]):
+def process_multiscale(image, model, scales=[.25, 0.50, 1.0], min_keypoints=None, report=None):
     b, _, h_init, w_init = image.size()
-    device = image.device
     assert(b == 1)
 
-    all_keypoints = torch.zeros([3, 0])
-    all_descriptors = torch.zeros([
-        model.dense_feature_extraction.num_channels, 0
-    ])
-    all_scores = torch.zeros(0)
+    return process_multiscale_batch(image, model, scales, min_keypoints=min_keypoints, report=report)[0]
+
+
+def process_multiscale_batch(images, model, scales=[.25, 0.50, 1.0], image_sizes=None, min_keypoints=None,
+                             report=None):
+    """Same as process_multiscale, but for a batch of images that are padded to the same size.
+
+    The dense feature network runs on the whole batch at once, detection and description per image.
+
+    Args:
+        images: (B, 3, H, W) tensor of preprocessed images.
+        model: D2Net model.
+        scales: Scales of the image pyramid.
+        image_sizes: (h, w) of the content of each image, the rest is padding of which the keypoints are
+            dropped. Defaults to the full size of the tensor for every image.
+        min_keypoints: Stop after the scale at which every image has at least this many keypoints, which skips
+            the larger and slower scales. Defaults to None (run all scales).
+        report: If a list is given, a dict with the scale, the size of the level, the time it took and the
+            number of keypoints per image found up to and including that scale is appended to it for every
+            scale that ran.
+
+    Returns:
+        A list with for every image the keypoints (N, 3), scores (N,) and descriptors (N, C) as numpy arrays.
+    """
+    b, _, h_init, w_init = images.size()
+    device = images.device
+    if image_sizes is None:
+        image_sizes = [(h_init, w_init)] * b
+
+    # Chunks per scale, concatenated once at the end instead of copying the growing matrices at every scale
+    all_keypoints = [[] for _ in range(b)]
+    all_descriptors = [[] for _ in range(b)]
+    all_scores = [[] for _ in range(b)]
 
     previous_dense_features = None
     banned = None
     for idx, scale in enumerate(scales):
-        current_image = F.interpolate(
-            image, scale_factor=scale,
-            mode='bilinear', align_corners=True
-        )
+        start = time.perf_counter()
+        if scale == 1:
+            # Interpolating to the same size gives the same image
+            current_image = images
+        else:
+            current_image = F.interpolate(
+                images, scale_factor=scale,
+                mode='bilinear', align_corners=True
+            )
         _, _, h_level, w_level = current_image.size()
 
         dense_features = model.dense_feature_extraction(current_image)
@@ -50,106 +84,122 @@ def process_multiscale(image, model, scales=[.25, 0.50, 1.0]):
             )
         else:
             banned = torch.max(detections, dim=1)[0].unsqueeze(1)
-        fmap_pos = torch.nonzero(detections[0].cpu()).t()
-        del detections
-        # vis
-
-        """
-        fig = plt.figure()
-
-        #plt.subplot(2, 1, 2)
-        #plt.imshow(img_out)
-        for i in range(25):
-            vismap = dense_features[0,i,::,::]
-            #
-            vismap = vismap.cpu()
-
-            #use sigmod to [0,1]
-            vismap= 1.0/(1+np.exp(-1*vismap))
-
-            # to [0,255]
-            vismap=np.round(vismap*255)
-            vismap=vismap.data.numpy()
-            plt.subplot(5, 5, i+1)
-            plt.axis('off')
-            plt.imshow(vismap)
-            filename = '/home/asky/featuremap/CH%d.jpg'% (i)
-
-            #cv2.imwrite(filename,vismap)
-
-        plt.tight_layout()
-        fig.show()
-        """
-        # Recover displacements.
-        displacements = model.localization(dense_features)[0].cpu()
-        displacements_i = displacements[
-            0, fmap_pos[0, :], fmap_pos[1, :], fmap_pos[2, :]
-        ]
-        displacements_j = displacements[
-            1, fmap_pos[0, :], fmap_pos[1, :], fmap_pos[2, :]
-        ]
-        del displacements
-
-        mask = torch.min(
-            torch.abs(displacements_i) < 0.5,
-            torch.abs(displacements_j) < 0.5
-        )
-        fmap_pos = fmap_pos[:, mask]
-        valid_displacements = torch.stack([
-            displacements_i[mask],
-            displacements_j[mask]
-        ], dim=0)
-        del mask, displacements_i, displacements_j
-
-        fmap_keypoints = fmap_pos[1 :, :].float() + valid_displacements
-        del valid_displacements
-
-        try:
-            raw_descriptors, _, ids = interpolate_dense_features(
-                fmap_keypoints.to(device),
-                dense_features[0]
-            )
-        except EmptyTensorError:
-            continue
-        fmap_pos = fmap_pos[:, ids]
-        fmap_keypoints = fmap_keypoints[:, ids]
-        del ids
-
-        keypoints = upscale_positions(fmap_keypoints, scaling_steps=2)
-        del fmap_keypoints
-
-        descriptors = F.normalize(raw_descriptors, dim=0).cpu()
-        del raw_descriptors
-
-        keypoints[0, :] *= h_init / h_level
-        keypoints[1, :] *= w_init / w_level
-
-        fmap_pos = fmap_pos.cpu()
-        keypoints = keypoints.cpu()
-
-        keypoints = torch.cat([
-            keypoints,
-            torch.ones([1, keypoints.size(1)]) * 1 / scale,
-        ], dim=0)
+        detections = detections.cpu()
 
-        scores = dense_features[
-            0, fmap_pos[0, :], fmap_pos[1, :], fmap_pos[2, :]
-        ].cpu() / (idx + 1)
-        del fmap_pos
+        # Recover displacements.
+        all_displacements = model.localization(dense_features).cpu()
 
-        all_keypoints = torch.cat([all_keypoints, keypoints], dim=1)
-        all_descriptors = torch.cat([all_descriptors, descriptors], dim=1)
-        all_scores = torch.cat([all_scores, scores], dim=0)
-        del keypoints, descriptors
+        for i in range(b):
+            keypoints, scores, descriptors = _describe_level(
+                detections[i], all_displacements[i], dense_features[i], device,
+                scale, idx, h_init / h_level, w_init / w_level, image_sizes[i]
+            )
+            if keypoints is None:
+                continue
+            all_keypoints[i].append(keypoints.t())
+            all_descriptors[i].append(descriptors.t())
+            all_scores[i].append(scores)
+            del keypoints, descriptors
+        del detections, all_displacements
 
         previous_dense_features = dense_features
         del dense_features
+
+        counts = [sum(len(chunk) for chunk in chunks) for chunks in all_keypoints]
+        elapsed = time.perf_counter() - start
+        logging.debug(f"Scale {scale} ({h_level}x{w_level}): {elapsed:.2f} s, keypoints: {counts}")
+        if report is not None:
+            report.append(dict(scale=scale, size=(h_level, w_level), seconds=elapsed, keypoints=counts))
+        if min_keypoints is not None and min(counts) >= min_keypoints:
+            break
     del previous_dense_features, banned
 
-    keypoints = all_keypoints.t().numpy()
-    del all_keypoints
-    scores = all_scores.numpy()
-    del all_scores
-    descriptors = all_descriptors.t().numpy()
-    del all_descriptors
+    results = []
+    for i in range(b):
+        if all_keypoints[i]:
+            keypoints = torch.cat(all_keypoints[i]).numpy()
+            scores = torch.cat(all_scores[i]).numpy()
+            descriptors = torch.cat(all_descriptors[i]).numpy()
+        else:
+            keypoints = np.zeros((0, 3), dtype=np.float32)
+            scores = np.zeros(0, dtype=np.float32)
+            descriptors = np.zeros((0, model.dense_feature_extraction.num_channels), dtype=np.float32)
+        all_keypoints[i] = all_scores[i] = all_descriptors[i] = None
+        results.append((keypoints, scores, descriptors))
+    del all_keypoints, all_scores, all_descriptors
+    return results
+
+
+def _describe_level(detections, displacements, dense_features, device, scale, idx,
+                    scale_i, scale_j, image_size):
+    """Keypoints, scores and descriptors of a single image at a single pyramid level.
+
+    Returns (None, None, None) if no valid keypoints were found.
+    """
+    fmap_pos = torch.nonzero(detections).t()
+
+    displacements_i = displacements[
+        0, fmap_pos[0, :], fmap_pos[1, :], fmap_pos[2, :]
+    ]
+    displacements_j = displacements[
+        1, fmap_pos[0, :], fmap_pos[1, :], fmap_pos[2, :]
+    ]
+
+    mask = torch.min(
+        torch.abs(displacements_i) < 0.5,
+        torch.abs(displacements_j) < 0.5
+    )
+    fmap_pos = fmap_pos[:, mask]
+    valid_displacements = torch.stack([
+        displacements_i[mask],
+        displacements_j[mask]
+    ], dim=0)
+    del mask, displacements_i, displacements_j
+
+    fmap_keypoints = fmap_pos[1 :, :].float() + valid_displacements
+    del valid_displacements
+
+    try:
+        raw_descriptors, _, ids = interpolate_dense_features(
+            fmap_keypoints.to(device),
+            dense_features
+        )
+    except EmptyTensorError:
+        return None, None, None
+    ids = ids.cpu()
+    fmap_pos = fmap_pos[:, ids]
+    fmap_keypoints = fmap_keypoints[:, ids]
+    del ids
+
+    keypoints = upscale_positions(fmap_keypoints, scaling_steps=2)
+    del fmap_keypoints
+
+    descriptors = F.normalize(raw_descriptors, dim=0).cpu()
+    del raw_descriptors
+
+    keypoints[0, :] *= scale_i
+    keypoints[1, :] *= scale_j
+
+    fmap_pos = fmap_pos.cpu()
+    keypoints = keypoints.cpu()
+
+    # Drop keypoints in the padding of batched images.
+    h_valid, w_valid = image_size
+    in_image = torch.min(keypoints[0, :] < h_valid, keypoints[1, :] < w_valid)
+    if not torch.all(in_image):
+        keypoints = keypoints[:, in_image]
+        descriptors = descriptors[:, in_image]
+        fmap_pos = fmap_pos[:, in_image]
+    del in_image
+
+    keypoints = torch.cat([
+        keypoints,
+        torch.ones([1, keypoints.size(1)]) * 1 / scale,
+    ], dim=0)
+
+    scores = dense_features[
+        fmap_pos[0, :], fmap_pos[1, :], fmap_pos[2, :]
+    ].cpu() / (idx + 1)
+    del fmap_pos
+
     return keypoints, scores, descriptors
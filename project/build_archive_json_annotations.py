@@ -2,7 +2,7 @@ import json
 import os
 import logging
 
-from src import MapSheet
+from src import MapSheet, prefetch_image_info
 
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
@@ -36,6 +36,14 @@ def main():
     with open(tmk_data_path, "r") as f:
         tmk_data = json.load(f)
 
+    # Resolve the size of all images at once, instead of one blocking request per sheet
+    tmk_endpoints = [
+        drawing["images"][0]
+        for sheet in tmk_data
+        for drawing in sheet["nettekeningen"] + sheet["veldminuten"]
+    ]
+    prefetch_image_info(tmk_endpoints)
+
     for sheet in tmk_data:
         sheet_title = sheet["title"]
         sheet_index = sheet["sheet"]
@@ -66,6 +74,8 @@ def main():
     with open(bonnebladen_data_path, "r") as f:
         bonnebladen_data = json.load(f)
 
+    prefetch_image_info(minute["images"][0] for sheet in bonnebladen_data for minute in sheet["minuten"])
+
     for sheet in bonnebladen_data:
         sheet_title = sheet["title"]
         sheet_index = sheet["sheet"]
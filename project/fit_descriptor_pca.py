@@ -0,0 +1,44 @@
+"""Fits the descriptor projection used by `configure_descriptor_pca` on a folder of sheet scans.
+
+Usage, from the root of the repository:
+```
+python -m project.fit_descriptor_pca prototype_data/amersfoort_test/samples descriptor_pca.npz --dimensions 128
+```
+"""
+import argparse
+import glob
+import logging
+import os
+
+import cv2
+
+from src.georeference import DescriptorPCA
+from src.georeference.features import extract_features
+
+logging.basicConfig(level=logging.INFO, format='%(levelname)s - %(message)s')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("folder", help="Folder with .jpg scans")
+    parser.add_argument("output", help="Path of the .npz file to write")
+    parser.add_argument("--dimensions", type=int, default=128)
+    parser.add_argument("--max-edge", type=int, default=2500, help="Scans are shrunk to this size first")
+    args = parser.parse_args()
+
+    def feature_sets():
+        for fp in sorted(glob.glob(os.path.join(args.folder, "*.jpg"))):
+            image = cv2.imread(fp)
+            scale = min(1, args.max_edge / max(image.shape[:2]))
+            image = cv2.resize(image, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+            logging.info(f"Extracting features of {fp}")
+            yield extract_features(image)
+
+    pca = DescriptorPCA.fit(feature_sets(), dimensions=args.dimensions, seed=0)
+    pca.save(args.output)
+    logging.info(f"Saved {pca.version} to {args.output}, "
+                 f"it keeps {pca.explained_variance_ratio.sum():.1%} of the variance.")
+
+
+if __name__ == "__main__":
+    main()
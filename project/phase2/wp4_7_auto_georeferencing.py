@@ -1,7 +1,8 @@
 import logging
 
 from src import MapSeries
-from src.georeference.matchfinder import get_georeference_from_mapsheet_matches
+from src.georeference.matchfinder import extract_mapsheet_features, match_mapsheet_features, \
+    verify_mapsheet_matches
 from logger_config import setup_logging
 
 setup_logging("wp4_7_auto_georeferencing_final_lowres.log")
@@ -43,7 +44,10 @@ def main():
 
             neatdrawing = next(nsheet for nsheet in neatdrawings_series.mapsheets if nsheet.metadata["sheet"] == sheet_idx)
 
-            georeferencing = get_georeference_from_mapsheet_matches(sheet, neatdrawing)
+            # Extracting and matching features is the expensive part, so it's only done once per sheet.
+            # Retries only rerun the geometric verification with a different seed.
+            matches = match_mapsheet_features(extract_mapsheet_features(sheet), neatdrawing)
+            georeferencing = verify_mapsheet_matches(matches, neatdrawing, seed=0)
             #georeferencing = get_georeference_from_mapsheet_template_matching(sheet, 25000, neatdrawing, 50000)
 
             succesful = validate_georeferencing(georeferencing)
@@ -56,7 +60,7 @@ def main():
                     failed = True
                     break
                 logging.info(f"Retry {retries}/{MAX_RETRIES}...")
-                georeferencing = get_georeference_from_mapsheet_matches(sheet, neatdrawing)
+                georeferencing = verify_mapsheet_matches(matches, neatdrawing, seed=retries)
                 succesful = validate_georeferencing(georeferencing)
                 sheet.set_georeference(georeferencing)
                 fn = f"retries_final/{sheet.id}_{retries}.json"
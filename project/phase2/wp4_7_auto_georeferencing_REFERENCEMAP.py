@@ -33,7 +33,7 @@ def main():
 
     reference_url = "https://raw.githubusercontent.com/geor-tudelft/iiifmap/master/project/phase1/results_wp3/tmk_neat_combined/with%20mask/FULL_tmk_neat_combined.json"
     reference_map = ReferenceMap(reference_url)
-    georeference_generator = GeoreferenceMatchFinder(reference_map, 30_000, 20_000)
+    georeference_generator = GeoreferenceMatchFinder(reference_map, 30_000, 20_000, refine=True)
 
     total_sheets = len(fieldminute_series.mapsheets)
     succesful_sheets = 0
@@ -0,0 +1,43 @@
+"""Downloads the reference map tiles of a bounding box into the tile cache, so later runs work offline.
+
+Usage, from the root of the repository:
+```
+python -m project.warm_up_tile_cache "https://.../annotation" tiles.sqlite \
+    --bbox 52.20 5.30 52.10 5.45 --zooms 13 14 15
+```
+The bounding box is given as the latitude and longitude of the top left corner, followed by those of the
+bottom right corner.
+"""
+import argparse
+import logging
+
+from src import configure_tile_cache
+from src.georeference import ReferenceMap
+from src.georeference.referencemap import ReferenceMapResolution, SearchBox
+from src.custom_types import Wgs84Coordinate
+
+logging.basicConfig(level=logging.INFO, format='%(levelname)s - %(message)s')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("map_link", help="IIIF link of the georeferenced reference map")
+    parser.add_argument("cache", help="Path of the SQLite tile cache")
+    parser.add_argument("--bbox", type=float, nargs=4, required=True, metavar=("TOP", "LEFT", "BOTTOM", "RIGHT"))
+    parser.add_argument("--zooms", type=int, nargs="+", default=[
+        ReferenceMapResolution.LOW, ReferenceMapResolution.MEDIUM, ReferenceMapResolution.HIGH
+    ])
+    parser.add_argument("--max-gb", type=float, default=1)
+    args = parser.parse_args()
+
+    cache = configure_tile_cache(args.cache, max_bytes=int(args.max_gb * 1024 ** 3))
+    top, left, bottom, right = args.bbox
+    searchbox = SearchBox(Wgs84Coordinate(top, left), Wgs84Coordinate(bottom, right))
+    downloaded = ReferenceMap(args.map_link).warm_up_tile_cache(searchbox, args.zooms)
+    stats = cache.stats()
+    logging.info(f"Downloaded {downloaded} tiles, the cache now holds {stats['entries']} tiles "
+                 f"({stats['size_bytes'] / 1024 ** 2:.1f} MB).")
+
+
+if __name__ == "__main__":
+    main()
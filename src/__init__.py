@@ -2,3 +2,5 @@ from .mapsheet import Resolution, MapSheet
 from .georeference import Georeference, GeoreferenceMatchFinder, ReferenceMap, geocode
 from .mask import RectangleMask, Mask, MaskGenerator
 from .mapseries import MapSeries
+from .cache import ImageCache, configure_image_cache, get_image_cache, configure_info_cache, TileCache, configure_tile_cache
+from .imageinfo import get_image_info, prefetch_image_info
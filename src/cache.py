@@ -0,0 +1,404 @@
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from typing import Any, Optional
+
+# Default maximum size of the image cache on disk (2 GB).
+DEFAULT_MAX_CACHE_BYTES = 2 * 1024 ** 3
+# Default time after which a cached info.json is requested again (one week).
+DEFAULT_INFO_TTL_SECONDS = 7 * 24 * 3600
+# Default maximum size of the XYZ tile cache (1 GB).
+DEFAULT_MAX_TILE_CACHE_BYTES = 1024 ** 3
+
+
+class ImageCache:
+    """Content-addressed disk cache for downloaded IIIF images.
+
+    Images are stored as the raw bytes returned by the image server, in a file named after the hash
+    of the request (endpoint, region, size and rotation). When the total size of the cache grows
+    above `max_bytes`, the least recently used files are removed.
+
+    Usually you don't create this class yourself, but call `configure_image_cache` once per process.
+    """
+
+    directory: str
+    max_bytes: int
+    hits: int
+    misses: int
+    bytes_saved: int
+
+    def __init__(self, directory: str, max_bytes: int = DEFAULT_MAX_CACHE_BYTES) -> None:
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.bytes_saved = 0
+        self._lock = threading.Lock()
+
+        os.makedirs(directory, exist_ok=True)
+        # Maps file name -> (last access time, size in bytes). Rebuilt from disk so the cache
+        # survives between runs.
+        self._index: dict[str, tuple[float, int]] = {}
+        for fn in os.listdir(directory):
+            if not fn.endswith(".bin"):
+                continue
+            stat = os.stat(os.path.join(directory, fn))
+            self._index[fn] = (stat.st_mtime, stat.st_size)
+        self._total_bytes = sum(size for _, size in self._index.values())
+
+    @staticmethod
+    def key(endpoint: str, region: str, size: str, rotation: "int | str") -> str:
+        """Hash of the parameters that uniquely identify an IIIF image request."""
+        request = f"{endpoint}|{region}|{size}|{rotation}"
+        return hashlib.sha256(request.encode("utf-8")).hexdigest()
+
+    def get(self, key: str) -> Optional[bytes]:
+        """Returns the cached bytes for the key, or None if the key is not in the cache."""
+        fn = key + ".bin"
+        fp = os.path.join(self.directory, fn)
+        with self._lock:
+            if fn not in self._index:
+                self.misses += 1
+                return None
+            try:
+                with open(fp, "rb") as f:
+                    content = f.read()
+            except OSError:
+                # Removed by someone else in the meantime.
+                self._forget(fn)
+                self.misses += 1
+                return None
+
+            os.utime(fp)
+            self._index[fn] = (os.stat(fp).st_mtime, len(content))
+            self.hits += 1
+            self.bytes_saved += len(content)
+            return content
+
+    def put(self, key: str, content: bytes) -> None:
+        """Stores the bytes under the given key and evicts old entries if the cache is full."""
+        if len(content) > self.max_bytes:
+            logging.debug(f"Not caching {key}, it is larger than the cache ({len(content)} bytes).")
+            return
+
+        fn = key + ".bin"
+        fp = os.path.join(self.directory, fn)
+        with self._lock:
+            # Write to a temporary file first so other processes never read half written images.
+            tmp_fp = f"{fp}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(tmp_fp, "wb") as f:
+                f.write(content)
+            os.replace(tmp_fp, fp)
+
+            self._forget(fn)
+            self._index[fn] = (os.stat(fp).st_mtime, len(content))
+            self._total_bytes += len(content)
+            self._evict()
+
+    def clear(self) -> None:
+        """Removes all images from the cache. The counters are kept."""
+        with self._lock:
+            for fn in list(self._index):
+                self._remove(fn)
+
+    @property
+    def size_bytes(self) -> int:
+        return self._total_bytes
+
+    def stats(self) -> dict[str, int]:
+        """Returns the hit/miss counters and the amount of bytes that didn't have to be downloaded."""
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "bytes_saved": self.bytes_saved,
+            "size_bytes": self._total_bytes,
+            "entries": len(self._index),
+        }
+
+    def _evict(self) -> None:
+        if self._total_bytes <= self.max_bytes:
+            return
+        for fn, _ in sorted(self._index.items(), key=lambda item: item[1][0]):
+            self._remove(fn)
+            if self._total_bytes <= self.max_bytes:
+                break
+
+    def _remove(self, fn: str) -> None:
+        try:
+            os.remove(os.path.join(self.directory, fn))
+        except FileNotFoundError:
+            pass
+        self._forget(fn)
+
+    def _forget(self, fn: str) -> None:
+        if fn in self._index:
+            _, size = self._index.pop(fn)
+            self._total_bytes -= size
+
+
+class InfoCache:
+    """Cache for the IIIF info.json of image endpoints, in memory and optionally on disk.
+
+    Entries older than `ttl_seconds` are treated as missing, so changes on the image server
+    are picked up eventually.
+    """
+
+    directory: Optional[str]
+    ttl_seconds: float
+    hits: int
+    misses: int
+
+    def __init__(self, directory: Optional[str] = None, ttl_seconds: float = DEFAULT_INFO_TTL_SECONDS) -> None:
+        self.directory = directory
+        self.ttl_seconds = ttl_seconds
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        # Maps endpoint -> (time fetched, info.json)
+        self._memory: dict[str, tuple[float, dict[str, Any]]] = {}
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+    def get(self, endpoint: str) -> Optional[dict[str, Any]]:
+        """Returns the info.json of the endpoint, or None if it's not cached or expired."""
+        with self._lock:
+            entry = self._memory.get(endpoint)
+            if entry is None and self.directory:
+                entry = self._read_from_disk(endpoint)
+                if entry is not None:
+                    self._memory[endpoint] = entry
+
+            if entry is None or time.time() - entry[0] > self.ttl_seconds:
+                self.misses += 1
+                return None
+            self.hits += 1
+            return entry[1]
+
+    def put(self, endpoint: str, info: dict[str, Any]) -> None:
+        entry = (time.time(), info)
+        with self._lock:
+            self._memory[endpoint] = entry
+            if self.directory:
+                self._write_to_disk(endpoint, entry)
+
+    def _filepath(self, endpoint: str) -> str:
+        return os.path.join(self.directory, hashlib.sha256(endpoint.encode("utf-8")).hexdigest() + ".json")
+
+    def _read_from_disk(self, endpoint: str) -> Optional[tuple[float, dict[str, Any]]]:
+        try:
+            with open(self._filepath(endpoint), "r") as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return None
+        return data["fetched"], data["info"]
+
+    def _write_to_disk(self, endpoint: str, entry: tuple[float, dict[str, Any]]) -> None:
+        fp = self._filepath(endpoint)
+        tmp_fp = f"{fp}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_fp, "w") as f:
+            json.dump({"endpoint": endpoint, "fetched": entry[0], "info": entry[1]}, f)
+        os.replace(tmp_fp, fp)
+
+
+class TileCache:
+    """Cache for XYZ tiles of reference maps, in a single SQLite file.
+
+    The table follows the MBTiles layout (zoom_level, tile_column, tile_row, tile_data), with an extra
+    column for the hash of the map the tiles are rendered from, so one file can hold the tiles of several
+    maps. Rows are XYZ rows, not the flipped TMS rows of MBTiles. When the total size grows above
+    `max_bytes`, the least recently used tiles are removed.
+
+    Usually you don't create this class yourself, but call `configure_tile_cache` once per process.
+    """
+
+    filepath: str
+    max_bytes: int
+    hits: int
+    misses: int
+    bytes_saved: int
+
+    def __init__(self, filepath: str, max_bytes: int = DEFAULT_MAX_TILE_CACHE_BYTES) -> None:
+        self.filepath = filepath
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.bytes_saved = 0
+        self._lock = threading.Lock()
+
+        directory = os.path.dirname(filepath)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        # The connection is shared between threads, guarded by the lock
+        self._connection = sqlite3.connect(filepath, check_same_thread=False, isolation_level=None)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS tiles ("
+            "map_hash TEXT, zoom_level INTEGER, tile_column INTEGER, tile_row INTEGER, tile_data BLOB, "
+            "size INTEGER, last_access REAL, "
+            "PRIMARY KEY (map_hash, zoom_level, tile_column, tile_row))"
+        )
+        self._connection.execute("CREATE INDEX IF NOT EXISTS tiles_last_access ON tiles (last_access)")
+        self._total_bytes = self._connection.execute("SELECT COALESCE(SUM(size), 0) FROM tiles").fetchone()[0]
+
+    @staticmethod
+    def map_hash(map_link: str) -> str:
+        return hashlib.sha256(map_link.encode("utf-8")).hexdigest()
+
+    def get(self, map_link: str, zoom: int, x: int, y: int) -> Optional[bytes]:
+        """Returns the cached tile, or None if it is not in the cache."""
+        key = (self.map_hash(map_link), zoom, x, y)
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT tile_data FROM tiles "
+                "WHERE map_hash = ? AND zoom_level = ? AND tile_column = ? AND tile_row = ?", key
+            ).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self._connection.execute(
+                "UPDATE tiles SET last_access = ? "
+                "WHERE map_hash = ? AND zoom_level = ? AND tile_column = ? AND tile_row = ?", (time.time(), *key)
+            )
+            self.hits += 1
+            self.bytes_saved += len(row[0])
+            return row[0]
+
+    def contains(self, map_link: str, zoom: int, x: int, y: int) -> bool:
+        """Whether the tile is cached, without counting as a hit or miss."""
+        with self._lock:
+            return self._connection.execute(
+                "SELECT 1 FROM tiles WHERE map_hash = ? AND zoom_level = ? AND tile_column = ? AND tile_row = ?",
+                (self.map_hash(map_link), zoom, x, y)
+            ).fetchone() is not None
+
+    def put(self, map_link: str, zoom: int, x: int, y: int, content: bytes) -> None:
+        """Stores a tile and evicts old tiles if the cache is full."""
+        key = (self.map_hash(map_link), zoom, x, y)
+        with self._lock:
+            previous = self._connection.execute(
+                "SELECT size FROM tiles WHERE map_hash = ? AND zoom_level = ? AND tile_column = ? AND tile_row = ?",
+                key
+            ).fetchone()
+            self._connection.execute(
+                "INSERT OR REPLACE INTO tiles VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (*key, sqlite3.Binary(content), len(content), time.time())
+            )
+            self._total_bytes += len(content) - (previous[0] if previous else 0)
+            self._evict()
+
+    def clear(self) -> None:
+        """Removes all tiles from the cache. The counters are kept."""
+        with self._lock:
+            self._connection.execute("DELETE FROM tiles")
+            self._total_bytes = 0
+
+    @property
+    def size_bytes(self) -> int:
+        return self._total_bytes
+
+    def stats(self) -> dict[str, int]:
+        """Returns the hit/miss counters and the amount of bytes that didn't have to be downloaded."""
+        with self._lock:
+            entries = self._connection.execute("SELECT COUNT(*) FROM tiles").fetchone()[0]
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "bytes_saved": self.bytes_saved,
+            "size_bytes": self._total_bytes,
+            "entries": entries,
+        }
+
+    def close(self) -> None:
+        with self._lock:
+            self._connection.close()
+
+    def _evict(self) -> None:
+        while self._total_bytes > self.max_bytes:
+            rows = self._connection.execute(
+                "SELECT rowid, size FROM tiles ORDER BY last_access LIMIT 64"
+            ).fetchall()
+            if not rows:
+                break
+            for rowid, size in rows:
+                self._connection.execute("DELETE FROM tiles WHERE rowid = ?", (rowid,))
+                self._total_bytes -= size
+                if self._total_bytes <= self.max_bytes:
+                    break
+
+
+_image_cache: Optional[ImageCache] = None
+_info_cache: InfoCache = InfoCache()
+_tile_cache: Optional[TileCache] = None
+
+
+def configure_image_cache(directory: Optional[str], max_bytes: int = DEFAULT_MAX_CACHE_BYTES) -> Optional[ImageCache]:
+    """Enables (or with directory=None disables) the image cache for this process.
+
+    Args:
+        directory (str): Folder in which the downloaded images are stored. Can be shared between runs.
+        max_bytes (int, optional): Maximum total size of the cache, after which the least recently used
+            images are removed. Defaults to 2 GB.
+
+    Returns:
+        ImageCache: The cache that is now in use, so its counters can be inspected.
+    """
+    global _image_cache
+    if directory is None:
+        _image_cache = None
+    else:
+        _image_cache = ImageCache(directory, max_bytes)
+    return _image_cache
+
+
+def get_image_cache() -> Optional[ImageCache]:
+    """Returns the image cache of this process, or None if caching is disabled."""
+    return _image_cache
+
+
+def configure_info_cache(directory: Optional[str] = None, ttl_seconds: float = DEFAULT_INFO_TTL_SECONDS) -> InfoCache:
+    """Replaces the info.json cache of this process.
+
+    By default info.json responses are only cached in memory. Give a directory to also keep them between runs.
+
+    Args:
+        directory (str, optional): Folder in which the info.json files are stored. Defaults to None (memory only).
+        ttl_seconds (float, optional): Time after which a cached info.json is requested again. Defaults to one week.
+
+    Returns:
+        InfoCache: The cache that is now in use.
+    """
+    global _info_cache
+    _info_cache = InfoCache(directory, ttl_seconds)
+    return _info_cache
+
+
+def get_info_cache() -> InfoCache:
+    """Returns the info.json cache of this process."""
+    return _info_cache
+
+
+def configure_tile_cache(filepath: Optional[str], max_bytes: int = DEFAULT_MAX_TILE_CACHE_BYTES) -> Optional[TileCache]:
+    """Enables (or with filepath=None disables) the cache for reference map tiles for this process.
+
+    Args:
+        filepath (str): SQLite file in which the tiles are stored. Can be shared between runs.
+        max_bytes (int, optional): Maximum total size of the tiles, after which the least recently used
+            tiles are removed. Defaults to 1 GB.
+
+    Returns:
+        TileCache: The cache that is now in use, so its counters can be inspected.
+    """
+    global _tile_cache
+    if _tile_cache is not None:
+        _tile_cache.close()
+    _tile_cache = TileCache(filepath, max_bytes) if filepath is not None else None
+    return _tile_cache
+
+
+def get_tile_cache() -> Optional[TileCache]:
+    """Returns the tile cache of this process, or None if caching is disabled."""
+    return _tile_cache
@@ -1,4 +1,8 @@
 from .baseclasses import Georeference
 from .matchfinder import GeoreferenceMatchFinder
 from .referencemap import ReferenceMap
+from .localreferencemap import LocalReferenceMap
 from .geocoder import geocode
+from .features import Features, configure_descriptor_pca, configure_feature_cache
+from .matcher import ReferenceMatcher
+from .pca import DescriptorPCA
@@ -0,0 +1,234 @@
+import hashlib
+import logging
+import os
+import sys
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import TYPE_CHECKING, Optional
+
+import numpy as np
+
+from .matcher import DEFAULT_CHECKS, DEFAULT_TREES, ReferenceMatcher
+from .pca import DescriptorPCA
+
+if TYPE_CHECKING:
+    from ..custom_types import Cv2Image
+    from ..mapsheet import MapSheet
+
+# Identifies the feature extractor and its settings. Change this when the model or the extraction
+# changes, so that features cached by an older version are not used anymore.
+MODEL_VERSION = "d2_tf-multiscale-0.25,0.5,1.0-v1"
+# Number of feature sets kept in memory. A single sheet can take hundreds of MB.
+DEFAULT_MEMORY_ENTRIES = 4
+
+
+@dataclass
+class Features:
+    """Keypoints, scores and descriptors of an image, as returned by the CNN feature extractor."""
+    keypoints: np.ndarray  # (N, 3) array of x, y and scale, in pixels of the image the features were extracted from
+    scores: np.ndarray  # (N,) array
+    descriptors: np.ndarray  # (N, D) array, float32 or float16 when reduced by a DescriptorPCA
+
+    def __len__(self) -> int:
+        return len(self.keypoints)
+
+    def save(self, filepath: str) -> None:
+        np.savez(filepath, keypoints=self.keypoints, scores=self.scores, descriptors=self.descriptors)
+
+    @classmethod
+    def load(cls, filepath: str) -> "Features":
+        with np.load(filepath) as data:
+            return cls(data["keypoints"], data["scores"], data["descriptors"])
+
+
+def extract_features(image: "Cv2Image", nfeatures: int = -1, tile_size: Optional[int] = None,
+                     max_workers: int = 1) -> Features:
+    """Runs the CNN feature extractor on an image.
+
+    Args:
+        image (Cv2Image): The image.
+        nfeatures (int, optional): Number of features with the highest score to keep. Defaults to -1 (all).
+        tile_size (int, optional): If given, the image is processed at full resolution in overlapping tiles
+            of this size, instead of shrunk to fit in a single pass. Defaults to None.
+        max_workers (int, optional): Number of tiles processed at the same time. Defaults to 1.
+
+    If a descriptor projection is configured with `configure_descriptor_pca`, the descriptors are reduced by it.
+    """
+    # Imported here, since importing torch and the model is slow and not needed for most uses of the package
+    from extern.cnn_matching.lib.cnn_feature import cnn_feature_extract, cnn_feature_extract_tiled
+
+    if tile_size is None:
+        keypoints, scores, descriptors = cnn_feature_extract(image, nfeatures=nfeatures)
+    else:
+        keypoints, scores, descriptors = cnn_feature_extract_tiled(
+            image, nfeatures=nfeatures, tile_size=tile_size, max_workers=max_workers
+        )
+    features = Features(keypoints, scores, descriptors)
+    if _descriptor_pca is not None:
+        features = _descriptor_pca.apply(features)
+    return features
+
+
+def _extractor_precision() -> str:
+    # Only configure_cpu_backend switches to bfloat16, which can't have been called if the module isn't
+    # imported yet. Importing it here would import torch just to build a cache key.
+    cnn_feature = sys.modules.get("extern.cnn_matching.lib.cnn_feature")
+    return "bf16" if cnn_feature is not None and cnn_feature.uses_bfloat16() else "fp32"
+
+
+class FeatureCache:
+    """Cache for the features of (reference) mapsheets, in memory and optionally as .npz files on disk.
+
+    Features are keyed by the image endpoint, the resolution of the image they were extracted from, the
+    version of the feature extractor, its precision (bfloat16 or fp32) and the descriptor projection in use.
+    """
+
+    directory: Optional[str]
+    memory_entries: int
+    hits: int
+    misses: int
+
+    def __init__(self, directory: Optional[str] = None, memory_entries: int = DEFAULT_MEMORY_ENTRIES) -> None:
+        self.directory = directory
+        self.memory_entries = memory_entries
+        self.hits = 0
+        self.misses = 0
+        self._memory: OrderedDict[str, Features] = OrderedDict()
+        self._matchers: OrderedDict[str, ReferenceMatcher] = OrderedDict()
+        self._lock = threading.Lock()
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+    @staticmethod
+    def key(endpoint: str, resolution: str) -> str:
+        descriptors = _descriptor_pca.version if _descriptor_pca is not None else "full"
+        key = f"{endpoint}|{resolution}|{MODEL_VERSION}|{_extractor_precision()}|{descriptors}"
+        return hashlib.sha256(key.encode("utf-8")).hexdigest()
+
+    def get(self, key: str) -> Optional[Features]:
+        with self._lock:
+            features = self._memory.get(key)
+            if features is not None:
+                self._memory.move_to_end(key)
+                self.hits += 1
+                return features
+
+            if self.directory and os.path.exists(self._filepath(key)):
+                features = Features.load(self._filepath(key))
+                self._remember(key, features)
+                self.hits += 1
+                return features
+
+            self.misses += 1
+            return None
+
+    def put(self, key: str, features: Features) -> None:
+        with self._lock:
+            self._remember(key, features)
+            if self.directory:
+                fp = self._filepath(key)
+                tmp_fp = f"{fp[:-len('.npz')]}.{os.getpid()}.{threading.get_ident()}.tmp.npz"
+                features.save(tmp_fp)
+                os.replace(tmp_fp, fp)
+
+    def get_matcher(self, key: str, features: Features, trees: int = DEFAULT_TREES,
+                    checks: int = DEFAULT_CHECKS) -> ReferenceMatcher:
+        """Returns the FLANN index for the features stored under the key, building and storing it if needed.
+
+        On disk, the index is stored next to the .npz file of the features.
+        """
+        matcher_key = f"{key}.trees{trees}"
+        with self._lock:
+            matcher = self._matchers.get(matcher_key)
+            if matcher is not None:
+                self._matchers.move_to_end(matcher_key)
+                matcher.checks = checks
+                return matcher
+
+            fp = os.path.join(self.directory, matcher_key + ".flann") if self.directory else None
+            if fp and os.path.exists(fp):
+                matcher = ReferenceMatcher.load(features, fp, trees, checks)
+            else:
+                matcher = ReferenceMatcher(features, trees, checks)
+                if fp:
+                    matcher.save(fp)
+
+            self._matchers[matcher_key] = matcher
+            while len(self._matchers) > self.memory_entries:
+                self._matchers.popitem(last=False)
+            return matcher
+
+    def _filepath(self, key: str) -> str:
+        return os.path.join(self.directory, key + ".npz")
+
+    def _remember(self, key: str, features: Features) -> None:
+        self._memory[key] = features
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.memory_entries:
+            self._memory.popitem(last=False)
+
+
+_feature_cache = FeatureCache()
+_descriptor_pca: Optional[DescriptorPCA] = None
+
+
+def configure_feature_cache(directory: Optional[str] = None, memory_entries: int = DEFAULT_MEMORY_ENTRIES) -> FeatureCache:
+    """Replaces the feature cache of this process.
+
+    By default features are only cached in memory. Give a directory to also keep them between runs.
+    """
+    global _feature_cache
+    _feature_cache = FeatureCache(directory, memory_entries)
+    return _feature_cache
+
+
+def get_feature_cache() -> FeatureCache:
+    return _feature_cache
+
+
+def configure_descriptor_pca(pca: "DescriptorPCA | str | None") -> Optional[DescriptorPCA]:
+    """Reduces the descriptors of all extracted features with a PCA projection, or with None stops doing so.
+
+    Compact descriptors take less memory in the feature cache and make the FLANN index smaller and faster.
+
+    Args:
+        pca (DescriptorPCA | str | None): The projection, or the path of a projection saved with `DescriptorPCA.save`.
+
+    Returns:
+        DescriptorPCA: The projection that is now in use.
+    """
+    global _descriptor_pca
+    if isinstance(pca, str):
+        pca = DescriptorPCA.load(pca)
+    _descriptor_pca = pca
+    return _descriptor_pca
+
+
+def get_descriptor_pca() -> Optional[DescriptorPCA]:
+    return _descriptor_pca
+
+
+def get_mapsheet_features(mapsheet: "MapSheet", resolution: str) -> Features:
+    """Returns the features of a mapsheet image at the given resolution, extracting them only once per cache.
+
+    The keypoints are in pixels of the image at the given resolution.
+    """
+    cache = get_feature_cache()
+    key = FeatureCache.key(mapsheet._image_endpoint, resolution)
+    features = cache.get(key)
+    if features is None:
+        logging.debug(f"Extracting features of sheet {mapsheet.id} at {resolution=}.")
+        features = extract_features(mapsheet.get_image(resolution=resolution))
+        cache.put(key, features)
+    else:
+        logging.debug(f"Using cached features of sheet {mapsheet.id} at {resolution=}.")
+    return features
+
+
+def get_reference_matcher(mapsheet: "MapSheet", resolution: str, trees: int = DEFAULT_TREES,
+                          checks: int = DEFAULT_CHECKS) -> ReferenceMatcher:
+    """Returns a matcher for the features of a reference mapsheet, of which the index is built once per cache."""
+    features = get_mapsheet_features(mapsheet, resolution)
+    key = FeatureCache.key(mapsheet._image_endpoint, resolution)
+    return get_feature_cache().get_matcher(key, features, trees, checks)
@@ -1,11 +1,11 @@
 import urllib.parse
-import requests
 import logging
 from typing import Optional
 import pycountry
 from requests import JSONDecodeError
 
 from src.custom_types import Wgs84Coordinate
+from .. import session
 #import contextily as ctx
 # import matplotlib.pyplot as plt
 # import webbrowser
@@ -49,7 +49,7 @@ def geocode(toponym: str, countries_iso_codes: list[str]) -> Optional[Wgs84Coord
     country_codes = ','.join(countries_iso_codes)
     url = f'https://whgazetteer.org/api/index?name={urllib.parse.quote(toponym)}&ccode={country_codes},'
 
-    response = requests.get(url)
+    response = session.get(url)
 
     # Checks if the request was unsuccessful
     if not response.status_code == 200:
@@ -0,0 +1,232 @@
+"""Renders reference map imagery locally from a series of georeferenced mapsheets.
+
+`ReferenceMap` asks allmaps.xyz to warp the georeferenced sheets into XYZ tiles. `LocalReferenceMap` does
+the same warp on this machine, from the images in the image cache:
+```
+configure_image_cache("cache/images")
+reference_map = LocalReferenceMap(MapSeries.from_annotationpage(annotationpage), Resolution.percentage_size(50))
+finder = GeoreferenceMatchFinder(reference_map, 1000, 1000)
+```
+"""
+import logging
+import math
+from collections import OrderedDict
+from typing import TYPE_CHECKING, Optional
+
+import cv2
+import numpy as np
+
+from ..cache import get_image_cache, get_info_cache
+from ..mask.baseclass import LazyFullImageMask
+from .referencemap import (
+    ReferenceMapResolution, SearchBox, TileGridGeoreference, latlon_to_pixel, pixel_to_latlon, searchbox_pixel_bounds,
+)
+
+if TYPE_CHECKING:
+    from ..custom_types import Cv2Image
+    from ..mapseries import MapSeries
+    from ..mapsheet import MapSheet
+
+# Number of decoded sheet images kept in memory. Consecutive search boxes usually need the same sheets.
+DEFAULT_IMAGE_MEMORY_ENTRIES = 4
+
+
+def _cached_dimensions(sheet: "MapSheet") -> tuple[int, int]:
+    """Width and height of the full image of the sheet, from the info cache only."""
+    info = get_info_cache().get(sheet._image_endpoint)
+    if info is None:
+        raise RuntimeError(
+            f"The info.json of sheet {sheet.id} is not cached. Configure a persistent info cache with "
+            f"configure_info_cache(directory) and fill it with prefetch_image_info first."
+        )
+    return info["width"], info["height"]
+
+
+def _resolution_scale(resolution: str) -> Optional[float]:
+    """Size of an image at the resolution relative to the full image, or None if that depends on the image."""
+    if resolution in ("max", "full"):
+        return 1.0
+    if resolution.lstrip("^").startswith("pct:"):
+        return float(resolution.lstrip("^")[len("pct:"):]) / 100
+    return None
+
+
+def _sheet_outline(sheet: "MapSheet") -> np.ndarray:
+    """(N, 2) x, y pixel coordinates of the mask of the sheet, or of the full image if it has none."""
+    mask = sheet.mask
+    if mask is not None and not (isinstance(mask, LazyFullImageMask) and not mask.is_resolved):
+        return np.array([(c.x, c.y) for c in mask._coordinates], dtype=np.float64)
+    width, height = _cached_dimensions(sheet)
+    return np.array([(0, 0), (width, 0), (width, height), (0, height)], dtype=np.float64)
+
+
+def _to_latlon(sheet: "MapSheet", pixels: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    """Lat and lon of (N, 2) pixel coordinates of a sheet, with the affine transform of its georeference."""
+    a, b, c, d, e, f = sheet._georeference.transformation_matrix
+    return a * pixels[:, 0] + b * pixels[:, 1] + c, d * pixels[:, 0] + e * pixels[:, 1] + f
+
+
+def _inverse_affine(sheet: "MapSheet") -> np.ndarray:
+    """2x3 matrix from (lat, lon, 1) to full resolution pixels of the sheet."""
+    a, b, c, d, e, f = sheet._georeference.transformation_matrix
+    linear = np.linalg.inv(np.array([[a, b], [d, e]]))
+    return np.hstack([linear, -linear @ np.array([[c], [f]])])
+
+
+class _SheetIndex:
+    """Bounding boxes of sheets in lat/lon, bucketed in square grid cells to quickly find the sheets in an area."""
+
+    def __init__(self, boxes: list[tuple[float, float, float, float]]) -> None:
+        self.boxes = boxes  # min lat, min lon, max lat, max lon per sheet
+        # About one sheet per cell
+        extents = [max(max_lat - min_lat, max_lon - min_lon) for min_lat, min_lon, max_lat, max_lon in boxes]
+        self.cell_size = float(np.median(extents)) if extents else 1.0
+        self._cells: dict[tuple[int, int], list[int]] = {}
+        for i, box in enumerate(boxes):
+            for cell in self._cells_of(*box):
+                self._cells.setdefault(cell, []).append(i)
+
+    def _cells_of(self, min_lat: float, min_lon: float, max_lat: float, max_lon: float):
+        for cy in range(math.floor(min_lat / self.cell_size), math.floor(max_lat / self.cell_size) + 1):
+            for cx in range(math.floor(min_lon / self.cell_size), math.floor(max_lon / self.cell_size) + 1):
+                yield cx, cy
+
+    def query(self, min_lat: float, min_lon: float, max_lat: float, max_lon: float) -> list[int]:
+        """Indices of the sheets of which the bounding box overlaps the area, in the order they were added."""
+        candidates = set()
+        for cell in self._cells_of(min_lat, min_lon, max_lat, max_lon):
+            candidates.update(self._cells.get(cell, ()))
+        return [
+            i for i in sorted(candidates)
+            if self.boxes[i][0] <= max_lat and self.boxes[i][2] >= min_lat
+            and self.boxes[i][1] <= max_lon and self.boxes[i][3] >= min_lon
+        ]
+
+
+class LocalReferenceMap:
+    """Reference map rendered from the cached images of a series of georeferenced mapsheets.
+
+    It can be used instead of a `ReferenceMap`. `extract_searchbox` gives an image of the same pixels and
+    the same georeference, but the sheets are warped here instead of by allmaps.xyz. It never uses the
+    network: only images in the image cache are used, and sheets of which the image is not cached are logged
+    and left black, like tiles that fail to download. Use `MapSeries.fetch_images` with the same resolution
+    to fill the cache.
+
+    The info.json of a sheet is needed for sheets without a mask, and for resolutions that aren't a
+    percentage or the maximum. It is only taken from the info cache, so for offline use configure a
+    persistent one with `configure_info_cache(directory)` and fill it with `prefetch_image_info`.
+    If it is missing, a RuntimeError is raised.
+
+    Every sheet is warped with the affine transform of its georeference, within its mask. Where sheets
+    overlap, the later sheet of the series is drawn on top.
+
+    Args:
+        mapseries (MapSeries): The sheets to render. Sheets without georeference are left out.
+        resolution (Resolution, optional): Resolution of the cached images that are used. Defaults to
+            Resolution.MAX.
+        memory_entries (int, optional): Number of decoded images kept in memory. Defaults to 4.
+    """
+
+    mapsheets: list["MapSheet"]
+    resolution: str
+
+    def __init__(self, mapseries: "MapSeries", resolution: str = "max",
+                 memory_entries: int = DEFAULT_IMAGE_MEMORY_ENTRIES) -> None:
+        self.mapsheets = [sheet for sheet in mapseries.mapsheets if sheet._georeference is not None]
+        self.resolution = resolution
+        self.memory_entries = memory_entries
+        self._outlines = []
+        boxes = []
+        for sheet in self.mapsheets:
+            outline = _sheet_outline(sheet)
+            lat, lon = _to_latlon(sheet, outline)
+            self._outlines.append((lat, lon))
+            boxes.append((lat.min(), lon.min(), lat.max(), lon.max()))
+        self._index = _SheetIndex(boxes)
+        self._images: OrderedDict[str, "Cv2Image"] = OrderedDict()
+
+    def sheets_in(self, searchbox: "SearchBox") -> list["MapSheet"]:
+        """The sheets of which the bounding box overlaps the search box."""
+        top_left, bottom_right = searchbox.top_left, searchbox.bottom_right
+        return [self.mapsheets[i] for i in self._index.query(
+            bottom_right.lat, top_left.lon, top_left.lat, bottom_right.lon
+        )]
+
+    def extract_searchbox(
+            self, searchbox: "SearchBox", resolution: ReferenceMapResolution
+    ) -> tuple["Cv2Image", TileGridGeoreference]:
+        """Renders the search box at the given zoom level.
+
+        Returns:
+            tuple[Cv2Image, TileGridGeoreference]: The BGR image of the search box and the exact transform
+                between its pixels and WGS84 coordinates.
+        """
+        zoom = resolution
+        x0, y0, right, bottom = searchbox_pixel_bounds(searchbox, zoom)
+        width, height = right - x0, bottom - y0
+        image = np.zeros((height, width, 3), dtype=np.uint8)
+
+        # The search box, extended to whole pixels
+        (max_lat, min_lat), (min_lon, max_lon) = pixel_to_latlon([x0, right], [y0, bottom], zoom)
+        indices = self._index.query(min_lat, min_lon, max_lat, max_lon)
+        logging.debug(f"Rendering {len(indices)} sheets into {width}x{height} pixels at {zoom=}.")
+        for i in indices:
+            self._draw_sheet(image, i, x0, y0, zoom)
+        return image, TileGridGeoreference(zoom, x0, y0)
+
+    def _draw_sheet(self, composite: "Cv2Image", i: int, x0: int, y0: int, zoom: int) -> None:
+        sheet = self.mapsheets[i]
+        height, width = composite.shape[:2]
+
+        # Outline of the sheet in pixels of the composite, and the part of the composite it covers
+        lat, lon = self._outlines[i]
+        outline_x, outline_y = latlon_to_pixel(lat, lon, zoom)
+        outline = np.stack([outline_x - x0, outline_y - y0], axis=1)
+        left, top = np.maximum(np.floor(outline.min(axis=0)).astype(int), 0)
+        right, bottom = np.minimum(np.ceil(outline.max(axis=0)).astype(int), (width, height))
+        if left >= right or top >= bottom:
+            return
+
+        image = self._get_sheet_image(sheet)
+        if image is None:
+            return
+        scale = _resolution_scale(self.resolution)
+        if scale is None:
+            scale = image.shape[1] / _cached_dimensions(sheet)[0]
+
+        # Lat only depends on the row and lon only on the column, so the maps are an outer sum
+        rows = np.arange(top, bottom) + y0 + 0.5
+        columns = np.arange(left, right) + x0 + 0.5
+        row_lat, _ = pixel_to_latlon(np.zeros_like(rows), rows, zoom)
+        _, column_lon = pixel_to_latlon(columns, np.zeros_like(columns), zoom)
+        inverse = _inverse_affine(sheet) * scale
+        # Pixel centers are at .5 in IIIF coordinates and at integers in OpenCV
+        map_x = (inverse[0, 0] * row_lat[:, np.newaxis] + inverse[0, 1] * column_lon + inverse[0, 2] - 0.5)
+        map_y = (inverse[1, 0] * row_lat[:, np.newaxis] + inverse[1, 1] * column_lon + inverse[1, 2] - 0.5)
+        warped = cv2.remap(image, map_x.astype(np.float32), map_y.astype(np.float32), cv2.INTER_LINEAR,
+                           borderMode=cv2.BORDER_CONSTANT)
+
+        mask = np.zeros((bottom - top, right - left), dtype=np.uint8)
+        cv2.fillPoly(mask, [np.round(outline - (left, top)).astype(np.int32)], 1)
+        region = composite[top:bottom, left:right]
+        region[mask.astype(bool)] = warped[mask.astype(bool)]
+
+    def _get_sheet_image(self, sheet: "MapSheet") -> Optional["Cv2Image"]:
+        """Decoded BGR image of the sheet from the image cache, or None if it isn't cached."""
+        endpoint = sheet._image_endpoint
+        if endpoint in self._images:
+            self._images.move_to_end(endpoint)
+            return self._images[endpoint]
+
+        if get_image_cache() is None:
+            raise RuntimeError("No image cache configured, call configure_image_cache first.")
+        content = sheet._get_cached_image_bytes("full", self.resolution, 0)
+        if content is None:
+            logging.warning(f"Image of sheet {sheet.id} with resolution={self.resolution} is not cached, skipping it.")
+            return None
+
+        image = cv2.imdecode(np.frombuffer(content, dtype=np.uint8), cv2.IMREAD_COLOR)
+        self._images[endpoint] = image
+        while len(self._images) > self.memory_entries:
+            self._images.popitem(last=False)
+        return image
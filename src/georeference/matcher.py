@@ -0,0 +1,226 @@
+from typing import TYPE_CHECKING
+
+import cv2
+import numpy as np
+
+if TYPE_CHECKING:
+    from .features import Features
+
+FLANN_INDEX_KDTREE = 1
+# Default number of randomized kd-trees in the index. More trees give a better recall but a slower index build.
+DEFAULT_TREES = 5
+# Default number of leaves visited per query. More checks give a better recall but slower queries.
+DEFAULT_CHECKS = 40
+# Default distance in pixels between the predicted and the actual location of a match in guided matching.
+DEFAULT_GUIDED_TOLERANCE = 50
+# Average number of reference keypoints per grid cell in guided matching. Cells are never smaller than the
+# tolerance, but much smaller cells than this make the per-cell overhead dominate.
+_KEYPOINTS_PER_CELL = 32
+
+
+def _ratio_test(
+        indices: np.ndarray, distances: np.ndarray, kps_image: np.ndarray, kps_reference: np.ndarray
+) -> tuple[np.ndarray, np.ndarray]:
+    """Keeps the matches of which the nearest neighbour is clearly closer than the second nearest.
+
+    Args:
+        indices (np.ndarray): (N, 2) indices of the two nearest reference keypoints of every image keypoint.
+        distances (np.ndarray): (N, 2) squared L2 distances to those keypoints, as returned by FLANN.
+        kps_image (np.ndarray): (N, 2+) keypoints of the image.
+        kps_reference (np.ndarray): (M, 2+) keypoints of the reference.
+
+    Returns:
+        tuple[np.ndarray, np.ndarray]: The (K, 2) matching locations on the image and on the reference.
+    """
+    # Code adapted from https://github.com/lan-cz/cnn-matching
+    # LAN Chaozhen, LU Wanjie, YU Junming, XU Qing. Deep learning algorithm for feature matching of cross modality
+    # remote sensing images[J]. Acta Geodaetica et Cartographica Sinica, 2021, 50(2): 189-202.
+
+    # FLANN gives squared distances for L2, the matcher the original code used gives the distances themselves.
+    distances = np.sqrt(distances).astype(np.float64)
+    nearest, second_nearest = distances[:, 0], distances[:, 1]
+
+    # 匹配对筛选
+    # 统计平均距离差
+    disdif_avg = np.mean(second_nearest - nearest)
+    # 自适应阈值
+    good = second_nearest > nearest + disdif_avg
+
+    # Locations go through float32, like they did when they were stored in cv2.KeyPoint objects.
+    match_locations_on_image = kps_image[good, :2].astype(np.float32).astype(np.float64)
+    match_locations_on_reference = kps_reference[indices[good, 0], :2].astype(np.float32).astype(np.float64)
+
+    return match_locations_on_image, match_locations_on_reference
+
+
+class _SpatialGrid:
+    """Keypoints bucketed in square cells, to quickly find the keypoints near a location."""
+
+    def __init__(self, keypoints: np.ndarray, cell_size: float) -> None:
+        self.cell_size = cell_size
+        cells = np.floor(keypoints[:, :2] / cell_size).astype(np.int64)
+        order = np.lexsort((cells[:, 1], cells[:, 0]))
+        unique_cells, starts = np.unique(cells[order], axis=0, return_index=True)
+        ends = np.append(starts[1:], len(order))
+        self._cells = {
+            (cx, cy): order[start:end] for (cx, cy), start, end in zip(unique_cells.tolist(), starts, ends)
+        }
+
+    def neighbourhood(self, cx: int, cy: int) -> np.ndarray:
+        """Indices of the keypoints in the cell and the eight cells around it."""
+        chunks = [self._cells.get((cx + dx, cy + dy)) for dx in (-1, 0, 1) for dy in (-1, 0, 1)]
+        chunks = [chunk for chunk in chunks if chunk is not None]
+        return np.concatenate(chunks) if chunks else np.zeros(0, dtype=np.int64)
+
+
+def _guided_knn(
+        descriptors_image: np.ndarray, predicted: np.ndarray, keypoints_reference: np.ndarray,
+        descriptors_reference: np.ndarray, grid: _SpatialGrid, tolerance: float
+) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Two nearest reference descriptors of every image keypoint, among the reference keypoints near its predicted location.
+
+    Image keypoints are grouped by the grid cell of their predicted location, so every group is compared
+    against the reference keypoints of one neighbourhood at once.
+
+    Returns:
+        tuple[np.ndarray, np.ndarray, np.ndarray]: (K, 2) indices of and squared L2 distances to the two nearest
+            reference keypoints, and the (N,) mask of the image keypoints that had at least two candidates.
+    """
+    indices = np.zeros((len(predicted), 2), dtype=np.int64)
+    distances = np.full((len(predicted), 2), np.inf, dtype=np.float32)
+    cells = np.floor(predicted / grid.cell_size).astype(np.int64)
+    unique_cells, group_of = np.unique(cells, axis=0, return_inverse=True)
+    groups = np.split(np.argsort(group_of.ravel(), kind="stable"), np.cumsum(np.bincount(group_of.ravel()))[:-1])
+    reference_norms = np.einsum("ij,ij->i", descriptors_reference, descriptors_reference)
+
+    for (cx, cy), members in zip(unique_cells.tolist(), groups):
+        candidates = grid.neighbourhood(cx, cy)
+        if len(candidates) < 2:
+            continue
+        query = descriptors_image[members]
+        # Squared L2 distances, like FLANN returns
+        group_distances = (
+            np.einsum("ij,ij->i", query, query)[:, np.newaxis] + reference_norms[candidates]
+            - 2 * query @ descriptors_reference[candidates].T
+        )
+        offsets = predicted[members, np.newaxis, :] - keypoints_reference[np.newaxis, candidates, :2]
+        group_distances[np.einsum("ijk,ijk->ij", offsets, offsets) > tolerance ** 2] = np.inf
+
+        nearest_two = np.argpartition(group_distances, 1, axis=1)[:, :2]
+        nearest_distances = np.take_along_axis(group_distances, nearest_two, axis=1)
+        order = np.argsort(nearest_distances, axis=1)
+        indices[members] = candidates[np.take_along_axis(nearest_two, order, axis=1)]
+        distances[members] = np.maximum(np.take_along_axis(nearest_distances, order, axis=1), 0)
+
+    valid = np.isfinite(distances[:, 1])
+    return indices[valid], distances[valid], valid
+
+
+class ReferenceMatcher:
+    """FLANN kd-tree index over the descriptors of a reference image, built once and queried many times.
+
+    ```
+    matcher = ReferenceMatcher(reference_features, trees=8, checks=64)
+    matches = matcher.match(image_features)
+    ```
+    """
+
+    features: "Features"
+    trees: int
+    checks: int
+
+    def __init__(self, features: "Features", trees: int = DEFAULT_TREES, checks: int = DEFAULT_CHECKS) -> None:
+        self.features = features
+        self.trees = trees
+        self.checks = checks
+        # FLANN keeps a pointer to the descriptors, so they must stay alive as long as the index
+        self._descriptors = np.ascontiguousarray(features.descriptors, dtype=np.float32)
+        # FLANN crashes on an empty index, and the ratio test needs two neighbours, so a reference with fewer
+        # than two descriptors (e.g. a blank image) gets no index and matches nothing
+        self._index = None
+        if len(self._descriptors) >= 2:
+            self._index = cv2.flann_Index(self._descriptors, dict(algorithm=FLANN_INDEX_KDTREE, trees=trees))
+        self._grids: dict[float, _SpatialGrid] = {}
+
+    def knn_search(self, descriptors: np.ndarray, k: int = 2) -> tuple[np.ndarray, np.ndarray]:
+        """Returns the (N, k) indices of and squared distances to the nearest reference descriptors.
+
+        Without descriptors on either side, (0, k) arrays are returned.
+        """
+        if self._index is None or len(descriptors) == 0:
+            return np.zeros((0, k), dtype=np.int32), np.zeros((0, k), dtype=np.float32)
+        return self._index.knnSearch(
+            np.ascontiguousarray(descriptors, dtype=np.float32), k, params=dict(checks=self.checks)
+        )
+
+    def match(self, features_image: "Features") -> tuple[np.ndarray, np.ndarray]:
+        """Matches the features of an image against the reference.
+
+        Returns:
+            tuple[np.ndarray, np.ndarray]: The (K, 2) matching locations on the image and on the reference.
+        """
+        indices, distances = self.knn_search(features_image.descriptors, k=2)
+        if len(indices) == 0:
+            return np.zeros((0, 2)), np.zeros((0, 2))
+        return _ratio_test(indices, distances, features_image.keypoints, self.features.keypoints)
+
+    def guided_match(
+            self, features_image: "Features", transform: np.ndarray, tolerance: float = DEFAULT_GUIDED_TOLERANCE
+    ) -> tuple[np.ndarray, np.ndarray]:
+        """Matches the features of an image against the reference near the locations predicted by a transform.
+
+        Instead of searching all reference descriptors, every image keypoint is only compared with the reference
+        keypoints within `tolerance` pixels of where the transform puts it. Image keypoints with fewer than two
+        such candidates are skipped, since the ratio test needs two.
+
+        Args:
+            features_image (Features): Features of the image.
+            transform (np.ndarray): 2x3 or 3x3 affine matrix from image pixels to reference pixels, e.g. the
+                `params` of a transform estimated with RANSAC on earlier matches.
+            tolerance (float, optional): Maximum distance in reference pixels between the predicted and the
+                matched location. Defaults to 50.
+
+        Returns:
+            tuple[np.ndarray, np.ndarray]: The (K, 2) matching locations on the image and on the reference.
+        """
+        transform = np.asarray(transform, dtype=np.float64)[:2]
+        keypoints_image = features_image.keypoints
+        predicted = keypoints_image[:, :2] @ transform[:, :2].T + transform[:, 2]
+
+        grid = self._grids.get(tolerance)
+        if grid is None:
+            extent = np.ptp(self.features.keypoints[:, :2], axis=0) if len(self.features) else np.ones(2)
+            cell_size = max(tolerance, np.sqrt(np.prod(extent) * _KEYPOINTS_PER_CELL / max(len(self.features), 1)))
+            grid = self._grids[tolerance] = _SpatialGrid(self.features.keypoints, cell_size)
+        indices, distances, valid = _guided_knn(
+            np.asarray(features_image.descriptors, dtype=np.float32), predicted, self.features.keypoints,
+            self._descriptors, grid, tolerance
+        )
+        if len(indices) == 0:
+            return np.zeros((0, 2)), np.zeros((0, 2))
+        return _ratio_test(indices, distances, keypoints_image[valid], self.features.keypoints)
+
+    def save(self, filepath: str) -> None:
+        """Saves the index. The descriptors aren't included, store them with `Features.save`.
+
+        Nothing is saved if the reference has fewer than two descriptors, since there is no index then.
+        """
+        if self._index is not None:
+            self._index.save(filepath)
+
+    @classmethod
+    def load(cls, features: "Features", filepath: str, trees: int = DEFAULT_TREES,
+             checks: int = DEFAULT_CHECKS) -> "ReferenceMatcher":
+        """Loads an index saved with `save`, for the same features it was built from."""
+        descriptors = np.ascontiguousarray(features.descriptors, dtype=np.float32)
+        index = cv2.flann_Index()
+        if not index.load(descriptors, filepath):
+            raise RuntimeError(f"Failed to load FLANN index from {filepath}")
+        self = cls.__new__(cls)
+        self.features = features
+        self.trees = trees
+        self.checks = checks
+        self._descriptors = descriptors
+        self._index = index
+        self._grids = {}
+        return self
@@ -1,90 +1,91 @@
 import math
-from typing import TYPE_CHECKING
+from typing import TYPE_CHECKING, Optional
 
 import cv2
 import numpy as np
 from PIL import Image
-from matplotlib import pyplot as plt
-from skimage import measure, transform
 
-from extern.cnn_matching.lib.cnn_feature import cnn_feature_extract
 from ..custom_types import Wgs84Coordinate, Cv2Image, PixelCoordinate
 from .baseclasses import Georeference, ControlPoint
+from .features import Features, extract_features, get_reference_matcher
+from .matcher import ReferenceMatcher
+from .verification import AffineModel, ransac_affine
+from ..imageinfo import get_image_dimensions
 import logging
 
 if TYPE_CHECKING:
     from ..mapsheet import MapSheet, Resolution
 
-from .referencemap import ReferenceMap, SearchBox, ReferenceMapResolution
+from .referencemap import ReferenceMap, SearchBox, ReferenceMapResolution, TileGridGeoreference
 
 LOWRES_PERCENTAGE = 25
+REFINEMENT_PERCENTAGE = 50  # Resolution of the mapsheet windows in the refinement stage
+REFINEMENT_GRID = 3  # The mapsheet is refined in REFINEMENT_GRID x REFINEMENT_GRID windows
+REFINEMENT_MARGIN_METERS = 500  # Uncertainty of the location of a window predicted by the low resolution stage
+REFINEMENT_KEEP_BEST = 10  # Control points kept per window
+REFINEMENT_MIN_INLIERS = 8  # Windows with fewer RANSAC inliers are skipped
+REFINEMENT_RESIDUAL_METERS = 100  # Maximum distance of a control point to the transform of all windows combined
+MAPSHEET_PERCENTAGE = 25  # Resolution of the mapsheet when matching on another mapsheet
+REFERENCE_PERCENTAGE = 50  # Resolution of the georeferenced mapsheet when matching on another mapsheet
 _RESIDUAL_THRESHOLD = 50 # todo
+GUIDED_TOLERANCE = 100  # Distance in full resolution pixels around the predicted location searched in guided matching
 
 def _find_matches(image: "Cv2Image", reference_image: "Cv2Image") -> tuple[np.ndarray, np.ndarray]:
+    if image.size == 0 or reference_image.size == 0:
+        return np.zeros((0, 2)), np.zeros((0, 2))
+    features_image = extract_features(image, nfeatures=-1)  # TODO test with feature filering
+    features_reference = extract_features(reference_image, nfeatures=-1)
+    return _match_features(features_image, features_reference)
+
+
+def _find_guided_matches(
+        image: "Cv2Image", reference_image: "Cv2Image", prior: np.ndarray, tolerance: float
+) -> tuple[np.ndarray, np.ndarray]:
+    """Like _find_matches, but features are only matched within `tolerance` reference pixels of where the
+    2x3 or 3x3 affine `prior` from image to reference pixels puts them."""
+    if image.size == 0 or reference_image.size == 0:
+        return np.zeros((0, 2)), np.zeros((0, 2))
+    features_image = extract_features(image, nfeatures=-1)
+    features_reference = extract_features(reference_image, nfeatures=-1)
+    return ReferenceMatcher(features_reference).guided_match(features_image, prior, tolerance)
+
+
+def _match_features(features_image: "Features", features_reference: "Features") -> tuple[np.ndarray, np.ndarray]:
+    return ReferenceMatcher(features_reference).match(features_image)
+
+
+def _estimate_affine(
+        matches: tuple[np.ndarray, np.ndarray], residual_threshold: float = _RESIDUAL_THRESHOLD,
+        seed: Optional[int] = None
+) -> tuple[Optional["AffineModel"], np.ndarray]:
+    """Affine transform from the image to the reference that most matches agree with, and the mask of those inliers."""
+    result = ransac_affine(matches, residual_threshold, max_trials=1000, seed=seed)
+    return result.model, result.inliers
+
+
+def _filter_matches_geometrically(
+        matches: tuple[np.ndarray, np.ndarray], keep_best=-1, residual_threshold: float = _RESIDUAL_THRESHOLD,
+        seed: Optional[int] = None
+) -> tuple[np.ndarray, np.ndarray]:
     # Code adapted from https://github.com/lan-cz/cnn-matching
     # LAN Chaozhen, LU Wanjie, YU Junming, XU Qing. Deep learning algorithm for feature matching of cross modality
     # remote sensing images[J]. Acta Geodaetica et Cartographica Sinica, 2021, 50(2): 189-202.
 
-
-    kps_image, sco_image, des_image = cnn_feature_extract(image, nfeatures=-1)  # TODO test with feature filering
-    kps_reference, sco_reference, des_reference = cnn_feature_extract(reference_image, nfeatures=-1)
-
-    # Flann特征匹配
-    FLANN_INDEX_KDTREE = 1
-    index_params = dict(algorithm=FLANN_INDEX_KDTREE, trees=5)
-    search_params = dict(checks=40)
-    flann = cv2.FlannBasedMatcher(index_params, search_params)
-    matches = flann.knnMatch(des_image, des_reference, k=2)
-
-    goodMatch = []
-    match_locations_on_image = []
-    match_locations_on_reference = []
-
-    # 匹配对筛选
-    disdif_avg = 0
-    # 统计平均距离差
-    for m, n in matches:
-        disdif_avg += n.distance - m.distance
-    disdif_avg = disdif_avg / len(matches)
-
-    for m, n in matches:
-        # 自适应阈值
-        if n.distance > m.distance + disdif_avg:
-            goodMatch.append(m)
-            p2 = cv2.KeyPoint(kps_reference[m.trainIdx][0], kps_reference[m.trainIdx][1], 1)
-            p1 = cv2.KeyPoint(kps_image[m.queryIdx][0], kps_image[m.queryIdx][1], 1)
-            match_locations_on_image.append([p1.pt[0], p1.pt[1]])
-            match_locations_on_reference.append([p2.pt[0], p2.pt[1]])
-
-    match_locations_on_image = np.array(match_locations_on_image)
-    match_locations_on_reference = np.array(match_locations_on_reference)
-
-    return match_locations_on_image, match_locations_on_reference
-
-def _filter_matches_geometrically(matches: tuple[np.ndarray, np.ndarray], keep_best=-1) -> tuple[np.ndarray, np.ndarray]:
-    # Code adapted from https://github.com/lan-cz/cnn-matching
-    # LAN Chaozhen, LU Wanjie, YU Junming, XU Qing. Deep learning algorithm for feature matching of cross modality
-    # remote sensing images[J]. Acta Geodaetica et Cartographica Sinica, 2021, 50(2): 189-202.
-
-    model, inliers = measure.ransac(
-        matches,
-        transform.AffineTransform,
-        min_samples=3,
-        residual_threshold=_RESIDUAL_THRESHOLD,
-        max_trials=1000,
-    )
+    model, inliers = _estimate_affine(matches, residual_threshold, seed)
 
     inlier_idxs = np.nonzero(inliers)[0]
     matches_filtered = matches[0][inlier_idxs], matches[1][inlier_idxs]
 
-    if keep_best != -1:
+    if keep_best != -1 and model is not None:
         residuals = model.residuals(matches_filtered[0], matches_filtered[1])
         sorted_idxs = np.argsort(residuals)[:keep_best]
         matches_filtered = (matches_filtered[0][sorted_idxs], matches_filtered[1][sorted_idxs])
 
     return matches_filtered
 
-def _controlpoints_from_matches(matches: tuple[np.ndarray, np.ndarray], reference_georeference: "Georeference") -> list["ControlPoint"]:
+def _controlpoints_from_matches(
+        matches: tuple[np.ndarray, np.ndarray], reference_georeference: "Georeference | TileGridGeoreference"
+) -> list["ControlPoint"]:
     controlpoints = []
     for i in range(len(matches[0])):
         image_match = PixelCoordinate(*matches[0][i])
@@ -95,20 +96,99 @@ def _controlpoints_from_matches(matches: tuple[np.ndarray, np.ndarray], referenc
     return controlpoints
 
 
-def get_georeference_from_mapsheet_matches(mapsheet: "MapSheet", georeferenced_mapsheet: "MapSheet") -> "Georeference":
+def extract_mapsheet_features(mapsheet: "MapSheet") -> "Features":
+    """Stage 1 of georeferencing a mapsheet on another mapsheet: extracting the features of the mapsheet.
+
+    Only the features of the mapsheet to be georeferenced are extracted here, the ones of the reference
+    are extracted and cached in the matching stage.
+    """
+    from src import Resolution
+    mapsheet_image = mapsheet.get_image(resolution=Resolution.percentage_size(MAPSHEET_PERCENTAGE))
+    return extract_features(mapsheet_image)
+
+
+def match_mapsheet_features(
+        features: "Features", georeferenced_mapsheet: "MapSheet", prior: Optional[np.ndarray] = None,
+        tolerance: float = GUIDED_TOLERANCE
+) -> tuple[np.ndarray, np.ndarray]:
+    """Stage 2: matching the features of a mapsheet (from extract_mapsheet_features) with a georeferenced mapsheet.
+
+    Args:
+        features (Features): Features of the mapsheet.
+        georeferenced_mapsheet (MapSheet): The mapsheet to match on.
+        prior (np.ndarray, optional): 3x3 affine matrix from full resolution pixels of the mapsheet to those of
+            the georeferenced mapsheet, e.g. from earlier matches. If given, features are only matched near the
+            location the prior predicts (guided matching). Defaults to None (match all features).
+        tolerance (float, optional): Distance in full resolution pixels around the predicted location that is
+            searched in guided matching.
+
+    Returns:
+        tuple[np.ndarray, np.ndarray]: Matching locations, in full resolution pixels of the mapsheet and
+            of the georeferenced mapsheet.
+    """
     from src import Resolution
-    PERC_MAPSHEET = 25
-    mapsheet_image = mapsheet.get_image(resolution=Resolution.percentage_size(PERC_MAPSHEET))
-    PERC_REF = 50
-    reference_image = georeferenced_mapsheet.get_image(resolution=Resolution.percentage_size(PERC_REF))
-
-    matches = _find_matches(mapsheet_image, reference_image)
-    matches = (matches[0] * (100/PERC_MAPSHEET), matches[1] * (100/PERC_REF))
-    matches_filtered = _filter_matches_geometrically(matches, keep_best=5)
+    # Many mapsheets share the same reference, so its features are cached instead of extracted every time
+    reference_matcher = get_reference_matcher(georeferenced_mapsheet, Resolution.percentage_size(REFERENCE_PERCENTAGE))
+
+    if prior is None:
+        matches = reference_matcher.match(features)
+    else:
+        # The prior in the pixels of the images the features were extracted from
+        to_reference = np.diag([REFERENCE_PERCENTAGE / 100, REFERENCE_PERCENTAGE / 100, 1])
+        from_mapsheet = np.diag([100 / MAPSHEET_PERCENTAGE, 100 / MAPSHEET_PERCENTAGE, 1])
+        matches = reference_matcher.guided_match(
+            features, to_reference @ prior @ from_mapsheet, tolerance * REFERENCE_PERCENTAGE / 100
+        )
+    return matches[0] * (100 / MAPSHEET_PERCENTAGE), matches[1] * (100 / REFERENCE_PERCENTAGE)
+
+
+def verify_mapsheet_matches(
+        matches: tuple[np.ndarray, np.ndarray], georeferenced_mapsheet: "MapSheet", seed: Optional[int] = None,
+        residual_threshold: float = _RESIDUAL_THRESHOLD, keep_best: int = 5
+) -> "Georeference":
+    """Stage 3: filtering the matches geometrically and turning the best ones into a georeference.
+
+    This stage is cheap, so when the result is not good enough it can be retried with another seed or
+    residual threshold without extracting and matching the features again:
+    ```
+    matches = match_mapsheet_features(extract_mapsheet_features(sheet), neatdrawing)
+    georeference = verify_mapsheet_matches(matches, neatdrawing, seed=0)
+    if not good_enough(georeference):
+        georeference = verify_mapsheet_matches(matches, neatdrawing, seed=1)
+    ```
+
+    Args:
+        matches (tuple[np.ndarray, np.ndarray]): Matches from match_mapsheet_features.
+        georeferenced_mapsheet (MapSheet): The mapsheet the matches were found on.
+        seed (int, optional): Seed of the random sampling in RANSAC. Defaults to None (different every time).
+        residual_threshold (float, optional): Maximum distance in pixels for a match to count as inlier.
+        keep_best (int, optional): Number of matches with the lowest residuals to use as control points.
+    """
+    matches_filtered = _filter_matches_geometrically(
+        matches, keep_best=keep_best, residual_threshold=residual_threshold, seed=seed
+    )
     controlpoints = _controlpoints_from_matches(matches_filtered, georeferenced_mapsheet._georeference)
 
     return Georeference(controlpoints)
 
+
+def get_georeference_from_mapsheet_matches(
+        mapsheet: "MapSheet", georeferenced_mapsheet: "MapSheet", seed: Optional[int] = None, guided: bool = False
+) -> "Georeference":
+    """Georeferences a mapsheet on a georeferenced mapsheet.
+
+    With guided=True, the affine transform of the first matches is used to match the features again, but only
+    near their predicted location. That finds more correct matches than matching every feature to all features
+    of the reference.
+    """
+    features = extract_mapsheet_features(mapsheet)
+    matches = match_mapsheet_features(features, georeferenced_mapsheet)
+    if guided:
+        model, _ = _estimate_affine(matches, seed=seed)
+        if model is not None:
+            matches = match_mapsheet_features(features, georeferenced_mapsheet, prior=model.params)
+    return verify_mapsheet_matches(matches, georeferenced_mapsheet, seed=seed)
+
 def get_georeference_from_mapsheet_template_matching(mapsheet: "MapSheet", mapsheet_scale: int, georeferenced_mapsheet: "MapSheet", georeferenced_mapsheet_scale: int) -> "Georeference":
     from ..mapsheet import Resolution
 
@@ -150,26 +230,132 @@ def get_georeference_from_mapsheet_template_matching(mapsheet: "MapSheet", mapsh
 
 
 
-def _get_refinement_box(matches: tuple[np.ndarray, np.ndarray], reference_georeference: "Georeference") -> tuple["Wgs84Coordinate", "Wgs84Coordinate"]:
-    ... # TODO
+def _meters_to_degrees(x_meters: float, y_meters: float, latitude: float) -> tuple:
+    # Constants for converting meters to degrees
+    METERS_PER_DEGREE_LAT = 111139  # Approx. meters in a degree of latitude
+    METERS_PER_DEGREE_LON = 111139 * math.cos(math.radians(latitude))  # Approx. meters in a degree of longitude at the given latitude
+
+    x_degrees = x_meters / METERS_PER_DEGREE_LON
+    y_degrees = y_meters / METERS_PER_DEGREE_LAT
+
+    return x_degrees, y_degrees
+
+
+def _get_refinement_box(
+        window: tuple[int, int, int, int], georeference: "Georeference", margin_meters: float
+) -> tuple["Wgs84Coordinate", "Wgs84Coordinate"]:
+    """Predicts the area of the reference map that a window of the mapsheet covers.
+
+    Args:
+        window (tuple[int, int, int, int]): x, y, width and height of the window in full resolution pixels.
+        georeference (Georeference): Georeference of the full resolution mapsheet, from an earlier stage.
+        margin_meters (float): Uncertainty of that georeference, added around the predicted area.
+
+    Returns:
+        tuple[Wgs84Coordinate, Wgs84Coordinate]: Top left and bottom right corner of the area.
+    """
+    x, y, width, height = window
+    corners = [
+        georeference.interpolate(PixelCoordinate(px, py))
+        for px, py in ((x, y), (x + width, y), (x, y + height), (x + width, y + height))
+    ]
+    lats = [corner.lat for corner in corners]
+    lons = [corner.lon for corner in corners]
+    x_degrees, y_degrees = _meters_to_degrees(margin_meters, margin_meters, sum(lats) / len(lats))
+    return (
+        Wgs84Coordinate(max(lats) + y_degrees, min(lons) - x_degrees),
+        Wgs84Coordinate(min(lats) - y_degrees, max(lons) + x_degrees),
+    )
+
+
+def _refinement_prior(
+        window: tuple[int, int, int, int], scale_factor: float, georeference: "Georeference",
+        reference_georeference: "TileGridGeoreference", margin_meters: float
+) -> tuple[np.ndarray, float]:
+    """Predicts where the features of a window lie on the reference image extracted for it.
+
+    Args:
+        window (tuple[int, int, int, int]): x, y, width and height of the window in full resolution pixels.
+        scale_factor (float): Full resolution pixels per pixel of the window image.
+        georeference (Georeference): Georeference of the full resolution mapsheet, from an earlier stage.
+        reference_georeference (TileGridGeoreference): Georeference of the reference image.
+        margin_meters (float): Uncertainty of the georeference.
+
+    Returns:
+        tuple[np.ndarray, float]: 2x3 affine matrix from pixels of the window image to pixels of the reference
+            image, and the uncertainty in reference pixels.
+    """
+    x, y, width, height = window
+    corners = np.float32([(0, 0), (width / scale_factor, 0), (0, height / scale_factor)])
+    predicted = np.float32([
+        reference_georeference.pixel_of(georeference.interpolate(PixelCoordinate(x + cx, y + cy)))
+        for cx, cy in corners * scale_factor
+    ])
+    centre = georeference.interpolate(PixelCoordinate(x + width / 2, y + height / 2))
+    _, y_degrees = _meters_to_degrees(0, margin_meters, centre.lat)
+    shifted = Wgs84Coordinate(centre.lat + y_degrees, centre.lon)
+    tolerance = abs(reference_georeference.pixel_of(shifted)[1] - reference_georeference.pixel_of(centre)[1])
+    return cv2.getAffineTransform(corners, predicted), tolerance
+
+
+def _distances_meters(coordinates: list["Wgs84Coordinate"], others: list["Wgs84Coordinate"]) -> np.ndarray:
+    """Approximate distances in meters between pairs of nearby coordinates."""
+    x_degrees, y_degrees = _meters_to_degrees(1, 1, coordinates[0].lat)
+    return np.array([
+        math.hypot((a.lon - b.lon) / x_degrees, (a.lat - b.lat) / y_degrees) for a, b in zip(coordinates, others)
+    ])
+
+
+def _consistent_controlpoints(
+        controlpoints: list["ControlPoint"], residual_meters: float = REFINEMENT_RESIDUAL_METERS,
+        seed: Optional[int] = None
+) -> list["ControlPoint"]:
+    """The control points that agree with the affine transform that most of them agree with."""
+    if len(controlpoints) < 3:
+        return []
+    origin = controlpoints[0].wgs84_coordinate
+    pixels = np.array([(cp.pixel_coordinate.x, cp.pixel_coordinate.y) for cp in controlpoints])
+    x_degrees, y_degrees = _meters_to_degrees(1, 1, origin.lat)
+    # RANSAC in local meters, so the residual threshold is the same in both directions
+    meters = np.array([
+        ((cp.wgs84_coordinate.lon - origin.lon) / x_degrees, (cp.wgs84_coordinate.lat - origin.lat) / y_degrees)
+        for cp in controlpoints
+    ])
+    _, inliers = _estimate_affine((pixels, meters), residual_meters, seed)
+    return [cp for cp, inlier in zip(controlpoints, inliers) if inlier]
+
+
+def _refinement_windows(width: int, height: int, grid: int) -> list[tuple[int, int, int, int]]:
+    """Splits an image into grid x grid windows of (x, y, width, height)."""
+    xs = np.linspace(0, width, grid + 1).astype(int)
+    ys = np.linspace(0, height, grid + 1).astype(int)
+    return [
+        (xs[i], ys[j], xs[i + 1] - xs[i], ys[j + 1] - ys[j])
+        for j in range(grid) for i in range(grid)
+    ]
+
 
 class GeoreferenceMatchFinder:
+    """Georeferences mapsheets by matching them on a georeferenced reference map, from coarse to fine.
+
+    The whole mapsheet is first matched at low resolution on the area around a location hint. With
+    refine=True, the resulting georeference predicts where every window of the mapsheet lies on the reference
+    map, so each window is then matched at a higher resolution on just that part of the reference map.
+    """
     reference_map: "ReferenceMap"
 
-    def __init__(self, reference_map: "ReferenceMap", x_uncertainty_meters: float, y_uncertainty_meters):
+    def __init__(self, reference_map: "ReferenceMap", x_uncertainty_meters: float, y_uncertainty_meters,
+                 refine: bool = False, refinement_grid: int = REFINEMENT_GRID,
+                 refinement_margin_meters: float = REFINEMENT_MARGIN_METERS):
         self.reference_map = reference_map
         self.x_uncertainty_meters = x_uncertainty_meters
         self.y_uncertainty_meters = y_uncertainty_meters
+        self.refine = refine
+        self.refinement_grid = refinement_grid
+        self.refinement_margin_meters = refinement_margin_meters
 
     def meters_to_degrees(self, x_meters: float, y_meters: float, latitude: float) -> tuple:
-        # Constants for converting meters to degrees
-        METERS_PER_DEGREE_LAT = 111139  # Approx. meters in a degree of latitude
-        METERS_PER_DEGREE_LON = 111139 * math.cos(math.radians(latitude))  # Approx. meters in a degree of longitude at the given latitude
-
-        x_degrees = x_meters / METERS_PER_DEGREE_LON
-        y_degrees = y_meters / METERS_PER_DEGREE_LAT
-
-        return x_degrees, y_degrees
+        return _meters_to_degrees(x_meters, y_meters, latitude)
 
     def get_georeference_from_reference_map(
         self, mapsheet: "MapSheet", location_hint: "Wgs84Coordinate"
@@ -183,43 +369,91 @@ class GeoreferenceMatchFinder:
         bottom = location_hint.lat - y_degrees
         left = location_hint.lon - x_degrees
         right = location_hint.lon + x_degrees
-        top_left = Wgs84Coordinate(top, left)
-        bottom_right = Wgs84Coordinate(bottom, right)
-        bottom_left = Wgs84Coordinate(bottom, left)
-        top_right = Wgs84Coordinate(top, right)
-        searchbox = SearchBox(top_left, bottom_right)
-        reference_lowres = self.reference_map.extract_searchbox(searchbox, ReferenceMapResolution.LOW)
-        reference_height, reference_width, _ = reference_lowres.shape
-
-        cp_top_left = ControlPoint(PixelCoordinate(0, 0), top_left) # FIXME, doesn't account for tiles offset
-        cp_bottom_right = ControlPoint(PixelCoordinate(reference_width, reference_height), bottom_right)
-        cp_top_right = ControlPoint(PixelCoordinate(reference_width, 0), top_right)
-        cp_bottom_left = ControlPoint(PixelCoordinate(0, reference_height), bottom_left)
-        reference_georeference = Georeference([cp_bottom_left, cp_bottom_right, cp_top_right, cp_top_left])
+        searchbox = SearchBox(Wgs84Coordinate(top, left), Wgs84Coordinate(bottom, right))
+        reference_lowres, reference_georeference = self.reference_map.extract_searchbox(
+            searchbox, ReferenceMapResolution.LOW
+        )
 
         matches = _find_matches(mapsheet_lowres, reference_lowres)
         matches_filtered = _filter_matches_geometrically(matches, keep_best=30)
 
         self.plot(mapsheet_lowres, matches_filtered, reference_lowres)
 
-        # res_corrected_matches = []
-        # for img_match in matches_filtered[0]:
-
         scale_factor = 100/LOWRES_PERCENTAGE
         matches_resolution_corrected = (matches_filtered[0] * scale_factor, matches_filtered[1])
-
-        #refinement_box = _get_refinement_box(matches_filtered, reference_georeference)
-
-        #mapsheet_highres = mapsheet.get_image(resolution=Resolution.MAX)
-        #reference_cropped_highres = ... # TODO
-        #reference_cropped_georeference = ...
-
-        #matches_refined = _find_matches(mapsheet_highres, reference_cropped_highres)
-        #matches_refined_filtered = _filter_matches_geometrically(matches_refined)
-
         controlpoints = _controlpoints_from_matches(matches_resolution_corrected, reference_georeference)
+        georeference = Georeference(controlpoints)
+
+        if not self.refine:
+            return georeference
+        if len(controlpoints) < 3:
+            logging.warning(f"Too few low resolution matches for sheet {mapsheet.id}, skipping refinement.")
+            return georeference
+
+        refined_controlpoints = self.refine_georeference(mapsheet, georeference)
+        if len(refined_controlpoints) < 3:
+            logging.warning(f"Refinement of sheet {mapsheet.id} found too few matches, "
+                            f"keeping the low resolution georeference.")
+            return georeference
+        return Georeference(refined_controlpoints)
+
+    def refine_georeference(self, mapsheet: "MapSheet", georeference: "Georeference") -> list["ControlPoint"]:
+        """Matches windows of the mapsheet at a higher resolution on the part of the reference map they cover.
+
+        Features of a window are only matched near where the low resolution georeference puts them. Windows
+        with fewer than REFINEMENT_MIN_INLIERS RANSAC inliers, or of which the inliers are further than
+        `refinement_margin_meters` from that prediction, are skipped. Finally, the control points of all
+        windows are verified together with RANSAC.
+
+        Args:
+            mapsheet (MapSheet): The mapsheet.
+            georeference (Georeference): Georeference of the mapsheet in full resolution pixels, from the
+                low resolution stage.
+
+        Returns:
+            list[ControlPoint]: The control points of all windows that could be matched, in full resolution pixels.
+        """
+        width, height = get_image_dimensions(mapsheet._image_endpoint)
+        controlpoints = []
+        for window in _refinement_windows(width, height, self.refinement_grid):
+            controlpoints += self._refine_window(mapsheet, window, georeference)
+        return _consistent_controlpoints(controlpoints)
+
+    def _refine_window(
+            self, mapsheet: "MapSheet", window: tuple[int, int, int, int], georeference: "Georeference"
+    ) -> list["ControlPoint"]:
+        from src import Resolution
 
-        return Georeference(controlpoints)
+        x, y, _, _ = window
+        scale_factor = 100 / REFINEMENT_PERCENTAGE
+        window_image = mapsheet.get_image_region(*window, resolution=Resolution.percentage_size(REFINEMENT_PERCENTAGE))
+        top_left, bottom_right = _get_refinement_box(window, georeference, self.refinement_margin_meters)
+        reference_highres, reference_georeference = self.reference_map.extract_searchbox(
+            SearchBox(top_left, bottom_right), ReferenceMapResolution.HIGH
+        )
+
+        prior, tolerance = _refinement_prior(
+            window, scale_factor, georeference, reference_georeference, self.refinement_margin_meters
+        )
+        matches = _find_guided_matches(window_image, reference_highres, prior, tolerance)
+        model, inliers = _estimate_affine(matches)
+        if inliers.sum() < REFINEMENT_MIN_INLIERS:
+            logging.debug(f"Too few matches in window {window} of sheet {mapsheet.id}.")
+            return []
+
+        matches_inliers = matches[0][inliers], matches[1][inliers]
+        controlpoints = _controlpoints_from_matches(
+            (matches_inliers[0] * scale_factor + np.array([x, y]), matches_inliers[1]), reference_georeference
+        )
+        predicted = [georeference.interpolate(cp.pixel_coordinate) for cp in controlpoints]
+        distances = _distances_meters([cp.wgs84_coordinate for cp in controlpoints], predicted)
+        if np.median(distances) > self.refinement_margin_meters:
+            logging.debug(f"Matches in window {window} of sheet {mapsheet.id} are {np.median(distances):.0f} "
+                          f"meters from the low resolution georeference, skipping it.")
+            return []
+
+        best = np.argsort(model.residuals(*matches_inliers))[:REFINEMENT_KEEP_BEST]
+        return [controlpoints[i] for i in best]
 
     def plot(self, mapsheet_lowres, matches_filtered, reference_lowres):
         src_pts = np.float32(matches_filtered[0]).reshape(-1, 1, 2)
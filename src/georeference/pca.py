@@ -0,0 +1,94 @@
+import dataclasses
+import hashlib
+from typing import TYPE_CHECKING, Iterable, Optional
+
+import numpy as np
+
+if TYPE_CHECKING:
+    from .features import Features
+
+# Number of dimensions the descriptors are reduced to by default. D2-Net descriptors have 512.
+DEFAULT_PCA_DIMENSIONS = 128
+# Number of descriptors per feature set used to fit the projection.
+DEFAULT_SAMPLES_PER_SET = 20000
+
+
+class DescriptorPCA:
+    """Linear projection of D2-Net descriptors to fewer dimensions, stored as float16.
+
+    The projection is fitted once on the features of a set of sheets and stored as a .npz file:
+    ```
+    pca = DescriptorPCA.fit([extract_features(image) for image in images], dimensions=128)
+    pca.save("descriptor_pca.npz")
+    ```
+    All features that are matched against each other must be projected with the same `DescriptorPCA`,
+    see `configure_descriptor_pca`.
+    """
+
+    mean: np.ndarray  # (D,) mean of the original descriptors
+    components: np.ndarray  # (K, D) principal axes, with the largest variance first
+    explained_variance_ratio: np.ndarray  # (K,) fraction of the variance kept per axis
+
+    def __init__(self, mean: np.ndarray, components: np.ndarray, explained_variance_ratio: np.ndarray) -> None:
+        self.mean = mean.astype(np.float32)
+        self.components = components.astype(np.float32)
+        self.explained_variance_ratio = explained_variance_ratio
+
+    @property
+    def dimensions(self) -> int:
+        return len(self.components)
+
+    @property
+    def version(self) -> str:
+        """Short hash of the projection, so cached features of different projections are not mixed up."""
+        digest = hashlib.sha256(self.mean.tobytes() + self.components.tobytes()).hexdigest()
+        return f"pca{self.dimensions}-{digest[:12]}"
+
+    @classmethod
+    def fit(cls, feature_sets: Iterable["Features"], dimensions: int = DEFAULT_PCA_DIMENSIONS,
+            samples_per_set: int = DEFAULT_SAMPLES_PER_SET, seed: Optional[int] = None) -> "DescriptorPCA":
+        """Fits the projection on a random sample of the descriptors of every feature set.
+
+        Args:
+            feature_sets (Iterable[Features]): Features of sheets that are representative for the corpus.
+            dimensions (int, optional): Number of dimensions to keep. Defaults to 128.
+            samples_per_set (int, optional): Maximum number of descriptors used per feature set. Defaults to 20000.
+            seed (int, optional): Seed of the sampling. Defaults to None.
+        """
+        rng = np.random.default_rng(seed)
+        samples = []
+        for features in feature_sets:
+            descriptors = features.descriptors
+            if len(descriptors) > samples_per_set:
+                descriptors = descriptors[rng.choice(len(descriptors), samples_per_set, replace=False)]
+            samples.append(descriptors.astype(np.float64))
+        samples = np.concatenate(samples)
+        if dimensions > samples.shape[1]:
+            raise ValueError(f"Can't reduce {samples.shape[1]} dimensional descriptors to {dimensions} dimensions.")
+
+        mean = samples.mean(axis=0)
+        # Eigen decomposition of the (D, D) covariance, which is cheaper than an SVD of all samples
+        covariance = np.cov(samples - mean, rowvar=False)
+        eigenvalues, eigenvectors = np.linalg.eigh(covariance)
+        order = np.argsort(eigenvalues)[::-1][:dimensions]
+        explained_variance_ratio = eigenvalues[order] / eigenvalues.sum()
+        return cls(mean, eigenvectors[:, order].T, explained_variance_ratio)
+
+    def transform(self, descriptors: np.ndarray) -> np.ndarray:
+        """Projects (N, D) descriptors to (N, K) float16 descriptors."""
+        return ((descriptors.astype(np.float32) - self.mean) @ self.components.T).astype(np.float16)
+
+    def apply(self, features: "Features") -> "Features":
+        """Returns the features with projected descriptors."""
+        return dataclasses.replace(features, descriptors=self.transform(features.descriptors))
+
+    def save(self, filepath: str) -> None:
+        np.savez(
+            filepath, mean=self.mean, components=self.components,
+            explained_variance_ratio=self.explained_variance_ratio,
+        )
+
+    @classmethod
+    def load(cls, filepath: str) -> "DescriptorPCA":
+        with np.load(filepath) as data:
+            return cls(data["mean"], data["components"], data["explained_variance_ratio"])
@@ -1,80 +1,239 @@
+import logging
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass
-from typing import TYPE_CHECKING
+from typing import TYPE_CHECKING, Optional
 
 import cv2
 import numpy
 
+from ..custom_types import PixelCoordinate, Wgs84Coordinate
+
 if TYPE_CHECKING:
     from .. import MapSheet
-    from ..custom_types import Wgs84Coordinate, Cv2Image
+    from ..custom_types import Cv2Image
 
 import urllib.parse
-import aiohttp
 import asyncio
 from PIL import Image, ImageOps
 from io import BytesIO
 import math
 
-total = 0
-counter = 0
-
-# Fetches a tile from the server
-async def fetch_tile(session, x, y, zoom, iiif_map_link , retries=3):
-    url = f"https://allmaps.xyz/{zoom}/{x}/{y}.png?url=" + urllib.parse.quote(iiif_map_link)
-    headers = {'User-Agent': 'Mozilla/5.0'}
-
-    for i in range(retries):
-        try:
-            async with session.get(url, headers=headers, timeout=60) as response:
-                global counter
-                print(f"Received tile {counter}/{total}")
-                counter += 1
-                if response.status == 200:
-                    content = await response.read()
-                    return Image.open(BytesIO(content))
-                else:
-                    print(f"Failed to get tile {x},{y}. HTTP status code: {response.status}")
-                    return None
-        except:
-            print(f"An error occurred while fetching tile {x},{y}. Retrying...")
-            await asyncio.sleep(1)
-    print(f"Failed to retrieve tile {x},{y} after {retries} retries.")
-    return None
+from ..cache import get_tile_cache
+from ..session import RETRY_STATUS_CODES, create_async_session
+
+# Width and height of XYZ tiles in pixels.
+TILE_SIZE = 256
+# Default number of tiles downloaded at the same time by a TileScheduler.
+DEFAULT_MAX_CONCURRENT_TILES = 16
+# Default number of attempts per tile.
+DEFAULT_TILE_RETRIES = 3
+# Default time in seconds a single attempt to download a tile may take.
+DEFAULT_TILE_TIMEOUT = 30
+# Default total time in seconds for all attempts of a tile, including the sleeps between them.
+DEFAULT_TILE_BUDGET = 120
+# Default base of the exponential backoff between attempts, in seconds.
+DEFAULT_TILE_BACKOFF = 0.5
+# Default number of threads that decode the tiles of a composite.
+DEFAULT_DECODE_WORKERS = 4
+
+
+@dataclass
+class TileProgress:
+    """Progress of the downloads of a single composite image."""
+    total: int
+    received: int = 0
+    cached: int = 0
+    failed: int = 0
+
+    @property
+    def done(self) -> int:
+        return self.received + self.cached + self.failed
+
+    def __str__(self) -> str:
+        return f"{self.done}/{self.total} tiles ({self.cached} cached, {self.failed} failed)"
+
+
+class TileScheduler:
+    """Downloads XYZ tiles with a bounded number of concurrent requests.
+
+    Failed attempts are retried after an exponential backoff with full jitter, so tiles that failed at the
+    same moment are not retried all at the same moment. Every attempt has a timeout, and all attempts of a
+    tile together have a time budget.
+
+    A single scheduler can be shared by several composites that are built at the same time in one event
+    loop, so they share the concurrency limit. The progress of each composite is kept in its own
+    `TileProgress`. Like the aiohttp session, a scheduler is bound to the event loop it is first used in.
+    """
+
+    max_concurrent: int
+    retries: int
+    timeout: float
+    budget: float
+    backoff: float
+
+    def __init__(self, max_concurrent: int = DEFAULT_MAX_CONCURRENT_TILES, retries: int = DEFAULT_TILE_RETRIES,
+                 timeout: float = DEFAULT_TILE_TIMEOUT, budget: float = DEFAULT_TILE_BUDGET,
+                 backoff: float = DEFAULT_TILE_BACKOFF) -> None:
+        self.max_concurrent = max_concurrent
+        self.retries = retries
+        self.timeout = timeout
+        self.budget = budget
+        self.backoff = backoff
+        self._semaphore = asyncio.Semaphore(max_concurrent)
+
+    async def fetch(self, session, x: int, y: int, zoom: int, iiif_map_link: str,
+                    progress: Optional[TileProgress] = None) -> Optional[Image.Image]:
+        """Returns the tile from the tile cache or the tile server, or None if it could not be downloaded."""
+        content = await self.fetch_content(session, x, y, zoom, iiif_map_link, progress)
+        if content is None:
+            return None
+        return Image.open(BytesIO(content))
+
+    async def fetch_content(self, session, x: int, y: int, zoom: int, iiif_map_link: str,
+                            progress: Optional[TileProgress] = None) -> Optional[bytes]:
+        """Like `fetch`, but returns the encoded tile."""
+        tile_cache = get_tile_cache()
+        if tile_cache is not None:
+            content = tile_cache.get(iiif_map_link, zoom, x, y)
+            if content is not None:
+                if progress is not None:
+                    progress.cached += 1
+                return content
+
+        content = await self._download(session, x, y, zoom, iiif_map_link)
+        if progress is not None:
+            if content is None:
+                progress.failed += 1
+            else:
+                progress.received += 1
+            logging.debug(f"Tile {zoom}/{x}/{y}: {progress}")
+        if content is not None and tile_cache is not None:
+            tile_cache.put(iiif_map_link, zoom, x, y, content)
+        return content
+
+    async def fetch_all(self, session, tiles: list[tuple[int, int, int]], iiif_map_link: str,
+                        progress: Optional[TileProgress] = None) -> list[Optional[Image.Image]]:
+        """Fetches (zoom, x, y) tiles, in the same order."""
+        return await asyncio.gather(*[
+            self.fetch(session, x, y, zoom, iiif_map_link, progress) for zoom, x, y in tiles
+        ])
+
+    async def _download(self, session, x: int, y: int, zoom: int, iiif_map_link: str) -> Optional[bytes]:
+        import aiohttp
+
+        url = f"https://allmaps.xyz/{zoom}/{x}/{y}.png?url=" + urllib.parse.quote(iiif_map_link)
+        deadline = time.monotonic() + self.budget
+        attempt = 0
+        for attempt in range(self.retries):
+            if attempt:
+                delay = random.uniform(0, self.backoff * 2 ** attempt)
+                if time.monotonic() + delay >= deadline:
+                    break
+                await asyncio.sleep(delay)
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                # Only the request itself holds a slot, not the sleep before a retry
+                async with self._semaphore:
+                    status, content = await asyncio.wait_for(
+                        self._get(session, url), timeout=min(self.timeout, remaining)
+                    )
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                logging.debug(f"{type(e).__name__} while fetching tile {zoom}/{x}/{y}, retrying.")
+                continue
+            if status == 200:  # OK
+                return content
+            if status not in RETRY_STATUS_CODES:
+                logging.warning(f"Failed to get tile {zoom}/{x}/{y}. HTTP status code: {status}")
+                return None
+            logging.debug(f"HTTP status {status} for tile {zoom}/{x}/{y}, retrying.")
+        logging.warning(f"Failed to retrieve tile {zoom}/{x}/{y} after {attempt + 1} attempts.")
+        return None
+
+    @staticmethod
+    async def _get(session, url: str) -> tuple[int, Optional[bytes]]:
+        async with session.get(url, headers={'User-Agent': 'Mozilla/5.0'}) as response:
+            if response.status != 200:
+                return response.status, None
+            return response.status, await response.read()
+
+
+# Fetches a tile from the tile cache or the server
+async def fetch_tile(session, x, y, zoom, iiif_map_link, retries=DEFAULT_TILE_RETRIES):
+    return await TileScheduler(retries=retries).fetch(session, x, y, zoom, iiif_map_link)
+
+def _decode_tile_into(content: bytes, out: numpy.ndarray) -> None:
+    """Decodes an encoded tile into a (256, 256, 3) BGR view of the composite."""
+    tile = cv2.imdecode(numpy.frombuffer(content, dtype=numpy.uint8), cv2.IMREAD_COLOR)
+    if tile is None:
+        logging.warning("Failed to decode tile, leaving it black.")
+        return
+    height, width = min(tile.shape[0], out.shape[0]), min(tile.shape[1], out.shape[1])
+    out[:height, :width] = tile[:height, :width]
 
 # Constructs a composite image from the tiles
-async def construct_composite_image(top_left, bottom_right, zoom, iiif_map_link):
+async def construct_composite_image(top_left, bottom_right, zoom, iiif_map_link,
+                                    scheduler: Optional[TileScheduler] = None,
+                                    progress: Optional[TileProgress] = None,
+                                    decode_workers: int = DEFAULT_DECODE_WORKERS):
+    """Downloads the tiles of a box and decodes them into a single BGR image.
+
+    Every tile is decoded on a thread pool as soon as it arrives, straight into its place in the composite,
+    so decoding overlaps with waiting for the other tiles and the composite is never copied.
+
+    Args:
+        scheduler (TileScheduler, optional): Scheduler shared with other composites that are built at the same
+            time. Defaults to a new scheduler with the default settings.
+        progress (TileProgress, optional): Progress object that is updated while the tiles come in, e.g. to
+            report the progress from another task. Its total is set here. Defaults to a new object.
+        decode_workers (int, optional): Number of threads that decode tiles. Defaults to 4.
+    """
     xtile1, ytile1 = latlon_to_tile(top_left.lat, top_left.lon, zoom)
     xtile2, ytile2 = latlon_to_tile(bottom_right.lat, bottom_right.lon, zoom)
 
-    tile_size = 256
+    tile_size = TILE_SIZE
     composite_width = (xtile2 - xtile1 + 1) * tile_size
     composite_height = (ytile2 - ytile1 + 1) * tile_size
-    global total
-    total = (xtile2 - xtile1 + 1) * (ytile2 - ytile1 + 1)
-    composite = Image.new('RGB', (composite_width, composite_height))
-    print(f"Requesting {total} tiles.")
-    async with aiohttp.ClientSession() as session:
-        tasks = []
-        for x in range(xtile1, xtile2 + 1):
-            for y in range(ytile1, ytile2 + 1):
-                task = fetch_tile(session, x, y, zoom, iiif_map_link)
-                tasks.append(task)
-
-        images = await asyncio.gather(*tasks)
-        print("Done")
-        idx = 0
-        for x in range(xtile1, xtile2 + 1):
-            for y in range(ytile1, ytile2 + 1):
-                img = images[idx]
-                if img:
-                    x_offset = (x - xtile1) * tile_size
-                    y_offset = (y - ytile1) * tile_size
-                    composite.paste(img, (x_offset, y_offset))
-                idx += 1
-    composite = cv2.cvtColor(numpy.array(composite), cv2.COLOR_RGB2BGR)
+    tiles = [(zoom, x, y) for x in range(xtile1, xtile2 + 1) for y in range(ytile1, ytile2 + 1)]
+    if scheduler is None:
+        scheduler = TileScheduler()
+    if progress is None:
+        progress = TileProgress(len(tiles))
+    progress.total = len(tiles)
+    # Tiles that fail to download stay black, like in the composites built with PIL before
+    composite = numpy.zeros((composite_height, composite_width, 3), dtype=numpy.uint8)
+    loop = asyncio.get_running_loop()
+    logging.info(f"Requesting {len(tiles)} tiles.")
+
+    with ThreadPoolExecutor(max_workers=decode_workers) as executor:
+        async def place_tile(session, x, y):
+            content = await scheduler.fetch_content(session, x, y, zoom, iiif_map_link, progress)
+            if content is None:
+                return
+            x_offset = (x - xtile1) * tile_size
+            y_offset = (y - ytile1) * tile_size
+            out = composite[y_offset:y_offset + tile_size, x_offset:x_offset + tile_size]
+            await loop.run_in_executor(executor, _decode_tile_into, content, out)
+
+        async with create_async_session() as session:
+            await asyncio.gather(*[place_tile(session, x, y) for _, x, y in tiles])
+    logging.info(f"Done: {progress}")
     return composite
 
 
+async def _warm_up_tiles(tiles, iiif_map_link):
+    progress = TileProgress(len(tiles))
+    scheduler = TileScheduler()
+    async with create_async_session() as session:
+        await asyncio.gather(*[
+            scheduler.fetch_content(session, x, y, zoom, iiif_map_link, progress) for zoom, x, y in tiles
+        ])
+    return progress.received
+
+
 def latlon_to_tile(lat, lon, zoom):
     lat_rad = math.radians(lat)
     n = 2.0 ** zoom
@@ -82,11 +241,86 @@ def latlon_to_tile(lat, lon, zoom):
     ytile = int((1.0 - math.asinh(math.tan(lat_rad)) / math.pi) / 2.0 * n)
     return xtile, ytile
 
+
+def latlon_to_pixel(lat, lon, zoom):
+    """Web Mercator pixel coordinates of the whole world at a zoom level, of scalars or numpy arrays."""
+    n = TILE_SIZE * 2.0 ** zoom
+    x = (numpy.asarray(lon) + 180.0) / 360.0 * n
+    y = (1.0 - numpy.arcsinh(numpy.tan(numpy.radians(lat))) / math.pi) / 2.0 * n
+    return x, y
+
+
+def pixel_to_latlon(x, y, zoom):
+    """Inverse of `latlon_to_pixel`."""
+    n = TILE_SIZE * 2.0 ** zoom
+    lon = numpy.asarray(x) / n * 360.0 - 180.0
+    lat = numpy.degrees(numpy.arctan(numpy.sinh(math.pi * (1.0 - 2.0 * numpy.asarray(y) / n))))
+    return lat, lon
+
+
+def tile_range(searchbox: "SearchBox", zoom: int) -> tuple[int, int, int, int]:
+    """First and last tile column and row that cover the search box."""
+    xtile1, ytile1 = latlon_to_tile(searchbox.top_left.lat, searchbox.top_left.lon, zoom)
+    xtile2, ytile2 = latlon_to_tile(searchbox.bottom_right.lat, searchbox.bottom_right.lon, zoom)
+    return xtile1, ytile1, xtile2, ytile2
+
 @dataclass
 class SearchBox:
     top_left: "Wgs84Coordinate"
     bottom_right: "Wgs84Coordinate"
 
+
+@dataclass
+class TileGridGeoreference:
+    """Exact transform between the pixels of an image cut from the XYZ tile grid and WGS84 coordinates.
+
+    It has the same `interpolate` as a `Georeference`, but follows the Web Mercator projection instead of
+    an affine transform, since latitude is not linear in the pixel rows.
+
+    Pixel coordinates are array indices, like the keypoints found on the image: pixel (i, j) is the centre
+    of the pixel in column i and row j. That is where tile servers and `LocalReferenceMap` sample the map.
+    """
+    zoom: int
+    x: int  # Web Mercator pixel column of the left edge of the image, at the zoom level
+    y: int  # Web Mercator pixel row of the top edge of the image
+
+    def interpolate(self, pixel_coordinate: PixelCoordinate) -> Wgs84Coordinate:
+        lat, lon = pixel_to_latlon(
+            self.x + pixel_coordinate.x + 0.5, self.y + pixel_coordinate.y + 0.5, self.zoom
+        )
+        return Wgs84Coordinate(float(lat), float(lon))
+
+    def pixel_of(self, coordinate: Wgs84Coordinate) -> tuple[float, float]:
+        """Inverse of `interpolate`, as x and y in pixels of the image."""
+        x, y = latlon_to_pixel(coordinate.lat, coordinate.lon, self.zoom)
+        return float(x) - self.x - 0.5, float(y) - self.y - 0.5
+
+
+def searchbox_pixel_bounds(searchbox: SearchBox, zoom: int) -> tuple[int, int, int, int]:
+    """Left, top, right and bottom Web Mercator pixel of the search box, within the tiles from `tile_range`."""
+    xtile1, ytile1, xtile2, ytile2 = tile_range(searchbox, zoom)
+    left, top = latlon_to_pixel(searchbox.top_left.lat, searchbox.top_left.lon, zoom)
+    right, bottom = latlon_to_pixel(searchbox.bottom_right.lat, searchbox.bottom_right.lon, zoom)
+    left = min(max(math.floor(left), xtile1 * TILE_SIZE), (xtile2 + 1) * TILE_SIZE)
+    top = min(max(math.floor(top), ytile1 * TILE_SIZE), (ytile2 + 1) * TILE_SIZE)
+    right = min(max(math.ceil(right), left), (xtile2 + 1) * TILE_SIZE)
+    bottom = min(max(math.ceil(bottom), top), (ytile2 + 1) * TILE_SIZE)
+    return left, top, right, bottom
+
+
+def crop_to_searchbox(
+        composite: "Cv2Image", searchbox: SearchBox, zoom: int
+) -> tuple["Cv2Image", TileGridGeoreference]:
+    """Cuts the search box out of a composite of the tiles from `tile_range`.
+
+    Returns:
+        tuple[Cv2Image, TileGridGeoreference]: A view of the composite and its georeference.
+    """
+    xtile1, ytile1, _, _ = tile_range(searchbox, zoom)
+    left, top, right, bottom = searchbox_pixel_bounds(searchbox, zoom)
+    x0, y0 = xtile1 * TILE_SIZE, ytile1 * TILE_SIZE
+    return composite[top - y0:bottom - y0, left - x0:right - x0], TileGridGeoreference(zoom, left, top)
+
 class ReferenceMapResolution:
     LOW = 13
     MEDIUM = 14
@@ -98,7 +332,15 @@ class ReferenceMap:
     def __init__(self, iiif_map_link: str) -> None:
         self.iiif_map_link = iiif_map_link
 
-    def extract_searchbox(self, searchbox: "SearchBox", resolution: ReferenceMapResolution) -> "Cv2Image":
+    def extract_searchbox(
+            self, searchbox: "SearchBox", resolution: ReferenceMapResolution
+    ) -> tuple["Cv2Image", TileGridGeoreference]:
+        """Downloads the tiles that cover the search box and cuts the search box out of them.
+
+        Returns:
+            tuple[Cv2Image, TileGridGeoreference]: The BGR image of the search box and the exact transform
+                between its pixels and WGS84 coordinates.
+        """
 
         # Defines the coordinates of the area of interest
         top_left = searchbox.top_left
@@ -113,4 +355,32 @@ class ReferenceMap:
             )
         )
 
-        return composite
\ No newline at end of file
+        return crop_to_searchbox(composite, searchbox, resolution)
+
+    def warm_up_tile_cache(self, searchbox: "SearchBox", resolutions: list[int]) -> int:
+        """Downloads all tiles of the search box at the given resolutions that are not in the tile cache yet.
+
+        Run this once for the area of a series of sheets, so that later runs don't need the network.
+
+        Returns:
+            int: The number of tiles that were downloaded.
+
+        Raises:
+            RuntimeError: If no tile cache is configured, see `configure_tile_cache`.
+        """
+        tile_cache = get_tile_cache()
+        if tile_cache is None:
+            raise RuntimeError("No tile cache configured, call configure_tile_cache first.")
+
+        missing = []
+        for zoom in resolutions:
+            xtile1, ytile1 = latlon_to_tile(searchbox.top_left.lat, searchbox.top_left.lon, zoom)
+            xtile2, ytile2 = latlon_to_tile(searchbox.bottom_right.lat, searchbox.bottom_right.lon, zoom)
+            missing += [
+                (zoom, x, y)
+                for x in range(xtile1, xtile2 + 1) for y in range(ytile1, ytile2 + 1)
+                if not tile_cache.contains(self.iiif_map_link, zoom, x, y)
+            ]
+        if not missing:
+            return 0
+        return asyncio.run(_warm_up_tiles(missing, self.iiif_map_link))
\ No newline at end of file
@@ -0,0 +1,160 @@
+"""Geometric verification of matches with RANSAC for affine transforms.
+
+Compared to `skimage.measure.ransac`, hypotheses are generated and scored in vectorized batches, the number
+of trials adapts to the inlier ratio found so far, and every new best hypothesis is refined on its inliers
+(LO-RANSAC). With a seed, the result is reproducible.
+"""
+import math
+from dataclasses import dataclass
+from typing import Optional
+
+import numpy as np
+
+# Default probability that at least one of the trials samples only inliers, which sets the number of trials.
+DEFAULT_CONFIDENCE = 0.999
+# Number of hypotheses generated and scored at once.
+DEFAULT_BATCH_SIZE = 64
+# Number of least squares refinements of every new best hypothesis.
+LOCAL_OPTIMIZATION_STEPS = 3
+_MIN_SAMPLES = 3
+
+
+@dataclass
+class AffineModel:
+    """Affine transform from image to reference pixels, with the interface of skimage's AffineTransform."""
+    params: np.ndarray  # (3, 3) homogeneous matrix
+
+    def __call__(self, coords: np.ndarray) -> np.ndarray:
+        return coords @ self.params[:2, :2].T + self.params[:2, 2]
+
+    def residuals(self, src: np.ndarray, dst: np.ndarray) -> np.ndarray:
+        return np.linalg.norm(self(src) - dst, axis=1)
+
+
+@dataclass
+class RansacResult:
+    model: Optional[AffineModel]  # None if no transform could be estimated
+    inliers: np.ndarray  # (N,) boolean mask of the matches that agree with the model
+    trials: int  # Number of hypotheses that were scored
+
+
+def _fit_affine(src: np.ndarray, dst: np.ndarray) -> Optional[np.ndarray]:
+    """Least squares affine transform from src to dst, or None if the points are degenerate."""
+    design = np.hstack([src, np.ones((len(src), 1))])
+    solution, _, rank, _ = np.linalg.lstsq(design, dst, rcond=None)
+    if rank < 3:
+        return None
+    return np.vstack([solution.T, [0, 0, 1]])
+
+
+def _required_trials(inlier_count: int, total: int, confidence: float) -> float:
+    """Number of trials needed to sample only inliers at least once with the given confidence."""
+    inlier_ratio = inlier_count / total
+    all_inliers = inlier_ratio ** _MIN_SAMPLES
+    if all_inliers >= 1:
+        return 0
+    if all_inliers <= 0:
+        return math.inf
+    return math.log(1 - confidence) / math.log(1 - all_inliers)
+
+
+def _hypotheses(src: np.ndarray, dst: np.ndarray, samples: np.ndarray) -> np.ndarray:
+    """Affine transforms through the three matches of every sample, (B, 3, 2). Degenerate samples are NaN."""
+    design = np.concatenate([src[samples], np.ones(samples.shape + (1,))], axis=2)  # (B, 3, 3)
+    determinants = np.linalg.det(design)
+    # Samples with repeated or collinear points have no unique solution
+    degenerate = np.abs(determinants) < 1e-9
+    design[degenerate] = np.eye(3)
+    params = np.linalg.solve(design, dst[samples])
+    params[degenerate] = np.nan
+    return params
+
+
+def _score(src_h: np.ndarray, dst: np.ndarray, params: np.ndarray, threshold: float) -> tuple[np.ndarray, np.ndarray]:
+    """Inlier count and truncated squared error (the MSAC cost) of every hypothesis, for all matches at once."""
+    squared_residuals = np.sum((src_h @ params - dst) ** 2, axis=2)  # (B, N)
+    inliers = squared_residuals <= threshold ** 2
+    cost = np.minimum(squared_residuals, threshold ** 2).sum(axis=1)
+    counts = inliers.sum(axis=1)
+    counts[np.isnan(cost)] = -1
+    return counts, cost
+
+
+def _local_optimization(
+        src: np.ndarray, dst: np.ndarray, model: np.ndarray, threshold: float
+) -> tuple[np.ndarray, np.ndarray]:
+    """Refits the model on its inliers until the inliers stop changing."""
+    inliers = AffineModel(model).residuals(src, dst) <= threshold
+    for _ in range(LOCAL_OPTIMIZATION_STEPS):
+        refined = _fit_affine(src[inliers], dst[inliers])
+        if refined is None:
+            break
+        refined_inliers = AffineModel(refined).residuals(src, dst) <= threshold
+        if refined_inliers.sum() < inliers.sum():
+            break
+        model = refined
+        if np.array_equal(refined_inliers, inliers):
+            break
+        inliers = refined_inliers
+    return model, inliers
+
+
+def ransac_affine(
+        matches: tuple[np.ndarray, np.ndarray], residual_threshold: float, max_trials: int = 1000,
+        confidence: float = DEFAULT_CONFIDENCE, seed: Optional[int] = None, local_optimization: bool = True,
+        batch_size: int = DEFAULT_BATCH_SIZE
+) -> RansacResult:
+    """Finds the affine transform that most matches agree with.
+
+    Args:
+        matches (tuple[np.ndarray, np.ndarray]): (N, 2) matching locations on the image and on the reference.
+        residual_threshold (float): Maximum distance in reference pixels for a match to count as inlier.
+        max_trials (int, optional): Maximum number of hypotheses. Defaults to 1000.
+        confidence (float, optional): Stop once the probability that a hypothesis of only inliers was tried is
+            at least this high, given the best inlier ratio so far. Defaults to 0.999.
+        seed (int, optional): Seed of the random sampling, for reproducible results. Defaults to None.
+        local_optimization (bool, optional): Refine every new best hypothesis on its inliers. Defaults to True.
+        batch_size (int, optional): Number of hypotheses scored at once. Defaults to 64.
+
+    Returns:
+        RansacResult: The model, the inlier mask and the number of trials.
+    """
+    src = np.asarray(matches[0], dtype=np.float64)
+    dst = np.asarray(matches[1], dtype=np.float64)
+    total = len(src)
+    if total < _MIN_SAMPLES:
+        return RansacResult(None, np.zeros(total, dtype=bool), 0)
+
+    rng = np.random.default_rng(seed)
+    src_h = np.hstack([src, np.ones((total, 1))])
+    best_model, best_count, best_cost = None, 0, math.inf
+    required_trials = max_trials
+    trials = 0
+    while trials < min(max_trials, required_trials):
+        size = int(min(batch_size, max_trials - trials))
+        samples = rng.integers(0, total, (size, _MIN_SAMPLES))
+        params = _hypotheses(src, dst, samples)
+        counts, costs = _score(src_h, dst, params, residual_threshold)
+        trials += size
+
+        # Most inliers first, lowest cost between hypotheses with the same number of inliers
+        best = np.lexsort((costs, -counts))[0]
+        if counts[best] > best_count or (counts[best] == best_count and costs[best] < best_cost):
+            model = np.vstack([params[best].T, [0, 0, 1]])
+            inliers = None
+            if local_optimization:
+                model, inliers = _local_optimization(src, dst, model, residual_threshold)
+            inliers = AffineModel(model).residuals(src, dst) <= residual_threshold if inliers is None else inliers
+            best_model, best_count, best_cost = model, int(inliers.sum()), costs[best]
+            required_trials = _required_trials(best_count, total, confidence)
+
+    if best_model is None or best_count < _MIN_SAMPLES:
+        return RansacResult(None, np.zeros(total, dtype=bool), trials)
+
+    # Like skimage, the final model is the least squares fit on all inliers
+    model = AffineModel(best_model)
+    inliers = model.residuals(src, dst) <= residual_threshold
+    refined = _fit_affine(src[inliers], dst[inliers])
+    if refined is not None:
+        model = AffineModel(refined)
+    return RansacResult(model, inliers, trials)
@@ -0,0 +1,98 @@
+import asyncio
+import json
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Iterable
+
+from . import session
+from .cache import get_info_cache
+from .session import async_get, create_async_session
+
+
+def _info_url(image_endpoint: str) -> str:
+    return image_endpoint + "/info.json"
+
+
+def get_image_info(image_endpoint: str) -> dict[str, Any]:
+    """Returns the IIIF info.json of an image endpoint, from the info cache if possible.
+
+    Raises:
+        requests.HTTPError: If the server doesn't return the info.json. Error responses are not cached.
+    """
+    cache = get_info_cache()
+    info = cache.get(image_endpoint)
+    if info is None:
+        logging.debug(f"Requesting info.json of {image_endpoint}.")
+        response = session.get(_info_url(image_endpoint))
+        # IIIF servers often answer with a JSON error body, which must not end up in the cache
+        response.raise_for_status()
+        info = response.json()
+        cache.put(image_endpoint, info)
+    return info
+
+
+def get_image_dimensions(image_endpoint: str) -> tuple[int, int]:
+    """Returns the (width, height) of the full image."""
+    info = get_image_info(image_endpoint)
+    return info["width"], info["height"]
+
+
+async def _prefetch(endpoints: list[str], concurrency: int) -> dict[str, dict[str, Any]]:
+    cache = get_info_cache()
+    semaphore = asyncio.Semaphore(concurrency)
+    infos = {}
+
+    async def fetch(endpoint: str) -> None:
+        async with semaphore:
+            try:
+                info = json.loads(await async_get(http_session, _info_url(endpoint)))
+            except Exception as e:
+                logging.error(f"Failed to fetch info.json of {endpoint}: {e}")
+                return
+        cache.put(endpoint, info)
+        infos[endpoint] = info
+
+    async with create_async_session(limit=concurrency) as http_session:
+        await asyncio.gather(*[fetch(endpoint) for endpoint in endpoints])
+    return infos
+
+
+def prefetch_image_info(image_endpoints: Iterable[str], concurrency: int = 16) -> dict[str, dict[str, Any]]:
+    """Requests the info.json of many image endpoints concurrently and stores them in the info cache.
+
+    Endpoints that are already cached are not requested again. Failed requests are logged and left out.
+    It can be called from a running event loop, but then blocks that loop until the requests are done.
+
+    Args:
+        image_endpoints (Iterable[str]): IIIF image endpoints, without "/info.json".
+        concurrency (int, optional): Maximum number of simultaneous requests. Defaults to 16.
+
+    Returns:
+        dict[str, dict]: The info.json of every endpoint that could be resolved.
+    """
+    cache = get_info_cache()
+    infos = {}
+    missing = []
+    for endpoint in dict.fromkeys(image_endpoints):
+        info = cache.get(endpoint)
+        if info is None:
+            missing.append(endpoint)
+        else:
+            infos[endpoint] = info
+
+    if missing:
+        logging.info(f"Prefetching info.json of {len(missing)} image endpoints.")
+        infos.update(_run(_prefetch(missing, concurrency)))
+    return infos
+
+
+def _run(coroutine):
+    """Runs a coroutine to completion, also when called from a running event loop (e.g. in a notebook)."""
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return asyncio.run(coroutine)
+    # asyncio.run can't be nested, so the coroutine gets its own loop in a worker thread, like in
+    # MapSeries.fetch_images
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        return executor.submit(asyncio.run, coroutine).result()
@@ -1,10 +1,22 @@
+import asyncio
 import json
 import os
+import queue
+import threading
 import urllib.parse
 import webbrowser
+from typing import TYPE_CHECKING, Iterator
 
 import logging
 from . import MapSheet
+from .mapsheet import Resolution
+from .session import async_get, create_async_session
+
+if TYPE_CHECKING:
+    from .custom_types import Cv2Image
+
+# Marks the end of the results of fetch_images
+_DONE = object()
 
 def _get_recursive_filenames(folder_path):
     for root, dirs, files in os.walk(folder_path):
@@ -15,6 +27,49 @@ def _get_nonrecursive_filenames(folder_path):
     for fn in os.listdir(folder_path):
         yield folder_path, fn
 
+async def _fetch_sheet_image(
+        http_session, sheet: "MapSheet", resolution: str, semaphore: asyncio.Semaphore,
+        results: queue.Queue, stop: threading.Event
+) -> None:
+    region, rotation = "full", 0
+    async with semaphore:
+        if stop.is_set():
+            return
+        try:
+            content = await asyncio.to_thread(sheet._get_cached_image_bytes, region, resolution, rotation)
+            if content is None:
+                logging.debug(f"Downloading image from sheet {sheet.id} with {resolution=}.")
+                content = await async_get(http_session, sheet._image_url(region, resolution, rotation))
+                await asyncio.to_thread(sheet._cache_image_bytes, region, resolution, rotation, content)
+            image = await asyncio.to_thread(sheet._decode_image, content)
+        except Exception as e:
+            logging.error(f"Failed to fetch image of sheet {sheet.id}: {e}")
+            return
+
+    # Blocks while the consumer is behind, which keeps the number of images in memory bounded.
+    while not stop.is_set():
+        try:
+            await asyncio.to_thread(results.put, (sheet, image), timeout=0.1)
+            return
+        except queue.Full:
+            continue
+
+
+async def _fetch_images(
+        sheets: list["MapSheet"], resolution: str, concurrency: int, per_host: int,
+        results: queue.Queue, stop: threading.Event
+) -> None:
+    try:
+        semaphore = asyncio.Semaphore(concurrency)
+        async with create_async_session(limit=concurrency, limit_per_host=per_host) as http_session:
+            await asyncio.gather(*[
+                _fetch_sheet_image(http_session, sheet, resolution, semaphore, results, stop)
+                for sheet in sheets
+            ])
+    finally:
+        results.put(_DONE)
+
+
 class MapSeries:
     mapsheets: list["MapSheet"]
     _manifest: str
@@ -71,6 +126,52 @@ class MapSeries:
 
         return self
 
+    def fetch_images(
+            self, resolution=Resolution.MAX, concurrency: int = 8, per_host: int = 4
+    ) -> Iterator[tuple["MapSheet", "Cv2Image"]]:
+        """Downloads the images of all mapsheets concurrently and yields them as they complete.
+
+        The downloads run on an event loop in a background thread, so processing one image overlaps with
+        downloading the next ones. Sheets of which the image could not be downloaded are logged and skipped.
+        ```
+        for sheet, image in series.fetch_images(Resolution.percentage_size(25), concurrency=16):
+            ...
+        ```
+
+        Args:
+            resolution (Resolution, optional): Use the Resolution class for easier and more readable
+                passing of resolutions. Defaults to Resolution.MAX.
+            concurrency (int, optional): Maximum number of images that are downloaded at the same time.
+                Also the maximum number of finished images waiting to be processed. Defaults to 8.
+            per_host (int, optional): Maximum number of simultaneous connections to a single image
+                server. Defaults to 4.
+
+        Yields:
+            tuple[MapSheet, Cv2Image]: The mapsheet and its image, in order of completion.
+        """
+        results = queue.Queue(maxsize=concurrency)
+        stop = threading.Event()
+        thread = threading.Thread(
+            target=asyncio.run,
+            args=(_fetch_images(self.mapsheets, resolution, concurrency, per_host, results, stop),),
+            daemon=True,
+        )
+        thread.start()
+        try:
+            while True:
+                item = results.get()
+                if item is _DONE:
+                    break
+                yield item
+        finally:
+            # Stops the downloads when the caller doesn't consume all images.
+            stop.set()
+            while thread.is_alive():
+                try:
+                    results.get(timeout=0.1)
+                except queue.Empty:
+                    pass
+
     def to_annotationpage(self, indent=4) -> str:
         annotations = []
         for sheet in self.mapsheets:
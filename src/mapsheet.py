@@ -1,15 +1,17 @@
 import logging
+import math
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from io import BytesIO
 from typing import TYPE_CHECKING, Any, Union
 
 import numpy as np
-import requests
 from PIL import Image
 import json
 
-from matplotlib import pyplot as plt
-
-from .mask.baseclass import RectangleMask
+from . import session
+from .cache import ImageCache, get_image_cache
+from .imageinfo import get_image_info
+from .mask.baseclass import LazyFullImageMask
 
 if TYPE_CHECKING:
     from .custom_types import Cv2Image
@@ -19,6 +21,7 @@ from .mask import Mask
 
 # Constants
 AUTO = 0
+TILE_RETRIES = 3  # Number of attempts for a single tile before giving up on the whole image
 
 
 class Resolution:
@@ -104,7 +107,7 @@ class MapSheet:
         self.metadata = {}
         self._georeference = None
         if create_mask:
-            self._mask = RectangleMask.full_image(image_endpoint)
+            self._mask = LazyFullImageMask(image_endpoint)
         else:
             self._mask = None
 
@@ -169,6 +172,8 @@ class MapSheet:
         return json.dumps(annotationpage, indent=indent)
 
     def plot(self) -> None:
+        from matplotlib import pyplot as plt  # Slow import, only needed for plotting
+
         img = self.get_image(Resolution.percentage_size(50))
         plt.figure(dpi=300)
         plt.title(f"{self.id}: {self.metadata['title']}")
@@ -214,19 +219,152 @@ class MapSheet:
         region = f"{x},{y},{width},{height}"
         return self._get_image(region, resolution, 0)
 
+    def get_image_tiled(self, scale_factor: int = 1, max_workers: int = 8) -> "Cv2Image":
+        """Same as get_image, but assembled from the native tiles of the image server.
+
+        Native tiles are usually pre-rendered on the server and are much smaller than a full image request,
+        so they are faster to serve, are cached individually and can be retried individually when they fail.
+
+        Args:
+            scale_factor (int, optional): Downscaling factor of the image, one of the "scaleFactors" in the
+                tiles section of the info.json. Defaults to 1 (full resolution).
+            max_workers (int, optional): Number of tiles that are downloaded in parallel. Defaults to 8.
+
+        Returns:
+            Cv2Image: A numpy array of the image in opencv's default color mode.
+        """
+        info = get_image_info(self._image_endpoint)
+        return self._get_image_tiled(0, 0, info["width"], info["height"], scale_factor, max_workers)
+
+    def get_image_region_tiled(
+        self, x: int, y: int, width: int, height: int, scale_factor: int = 1, max_workers: int = 8
+    ) -> "Cv2Image":
+        """Same as get_image_region, but assembled from the native tiles of the image server.
+
+        With a scale factor, the scaled pixels are those of the native tiles, so the region starts at the scaled
+        pixel that contains (x, y).
+
+        Args:
+            x (int): Number of horizontal pixels from the top left of the image to the top left of
+            the crop region.
+            y (int): Number of vertical pixels from the top left of the image to the top left of
+            the crop region.
+            width (int): Width of the crop region in pixels.
+            height (int): Height of the crop region in pixels.
+            scale_factor (int, optional): Downscaling factor of the image, one of the "scaleFactors" in the
+                tiles section of the info.json. Defaults to 1 (full resolution).
+            max_workers (int, optional): Number of tiles that are downloaded in parallel. Defaults to 8.
+
+        Returns:
+            Cv2Image: A numpy array of the region in opencv's default color mode, of size
+                ceil(width / scale_factor) by ceil(height / scale_factor).
+        """
+        return self._get_image_tiled(x, y, width, height, scale_factor, max_workers)
+
+    def _get_image_tiled(
+        self, x: int, y: int, width: int, height: int, scale_factor: int, max_workers: int
+    ) -> "Cv2Image":
+        info = get_image_info(self._image_endpoint)
+        image_width, image_height = info["width"], info["height"]
+        # A region starting outside of the image loses the part that is outside
+        width, height = width + min(x, 0), height + min(y, 0)
+        x, y = max(x, 0), max(y, 0)
+        width, height = min(width, image_width - x), min(height, image_height - y)
+        if width <= 0 or height <= 0:
+            raise ValueError("Region is outside of the image.")
+
+        tiles = info.get("tiles")
+        if not tiles or scale_factor not in tiles[0].get("scaleFactors", [1]):
+            logging.warning(f"No native tiles with {scale_factor=} for sheet {self.id}, requesting it as one image.")
+            size = Resolution.fixed_size(width=math.ceil(width / scale_factor))
+            return self._get_image(f"{x},{y},{width},{height}", size, 0)
+
+        # Tile size in full resolution pixels
+        tile_width = tiles[0]["width"] * scale_factor
+        tile_height = tiles[0].get("height", tiles[0]["width"]) * scale_factor
+
+        tile_regions = []
+        for tile_y in range(y // tile_height * tile_height, y + height, tile_height):
+            for tile_x in range(x // tile_width * tile_width, x + width, tile_width):
+                tile_regions.append((tile_x, tile_y,
+                                 min(tile_width, image_width - tile_x), min(tile_height, image_height - tile_y)))
+
+        # Scaled pixels of the tiles start at multiples of the scale factor, so the tiles are assembled on
+        # that grid and the result is cropped afterwards
+        x0, y0 = x // scale_factor * scale_factor, y // scale_factor * scale_factor
+        grid_width = math.ceil((x + width - x0) / scale_factor)
+        grid_height = math.ceil((y + height - y0) / scale_factor)
+
+        logging.debug(f"Downloading {len(tile_regions)} tiles from sheet {self.id} with {scale_factor=}.")
+        image = None
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = {
+                executor.submit(self._get_tile, *region, scale_factor): region for region in tile_regions
+            }
+            for future in as_completed(futures):
+                tile_x, tile_y, _, _ = futures[future]
+                tile = future.result()
+                if image is None:
+                    image = np.zeros((grid_height, grid_width) + tile.shape[2:], dtype=tile.dtype)
+
+                # Overlap of the tile with the grid, in scaled pixels
+                left = (max(tile_x, x0) - x0) // scale_factor
+                top = (max(tile_y, y0) - y0) // scale_factor
+                tile_left = max(x0 - tile_x, 0) // scale_factor
+                tile_top = max(y0 - tile_y, 0) // scale_factor
+                crop = tile[tile_top:, tile_left:]
+                crop = crop[:grid_height - top, :grid_width - left]
+                image[top:top + crop.shape[0], left:left + crop.shape[1]] = crop
+
+        return image[:math.ceil(height / scale_factor), :math.ceil(width / scale_factor)]
+
+    def _get_tile(self, x: int, y: int, width: int, height: int, scale_factor: int) -> "Cv2Image":
+        region = f"{x},{y},{width},{height}"
+        size = Resolution.fixed_size(width=math.ceil(width / scale_factor))
+        for attempt in range(1, TILE_RETRIES + 1):
+            try:
+                return self._get_image(region, size, 0)
+            except Exception as e:
+                if attempt == TILE_RETRIES:
+                    raise
+                logging.warning(f"Failed to get tile {region} of sheet {self.id} ({e}), retrying...")
+
     def _get_image(
         self, region: str, resolution: str, rotation: Union[int, str]
     ) -> "Cv2Image":
         """Private function to prevent duplicate code."""
+        content = self._get_cached_image_bytes(region, resolution, rotation)
+        if content is not None:
+            logging.debug(f"Loaded image from sheet {self.id} with {region=}, {resolution=} and {rotation=} from cache.")
+            return self._decode_image(content)
+
         logging.debug(f"Downloading image from sheet {self.id} with {region=}, {resolution=} and {rotation=}.")
-        url = f"{self._image_endpoint}/{region}/{resolution}/{rotation}/default.jpg"
-        response = requests.get(url)
+        url = self._image_url(region, resolution, rotation)
+        response = session.get(url)
         if response.status_code == 200:  # OK
-            image = Image.open(BytesIO(response.content))
-            return np.array(image)
+            self._cache_image_bytes(region, resolution, rotation, response.content)
+            return self._decode_image(response.content)
         else:
             raise RuntimeError("Failed to download image from url: {url}")
 
+    def _image_url(self, region: str, resolution: str, rotation: Union[int, str]) -> str:
+        return f"{self._image_endpoint}/{region}/{resolution}/{rotation}/default.jpg"
+
+    def _get_cached_image_bytes(self, region: str, resolution: str, rotation: Union[int, str]) -> Union[bytes, None]:
+        cache = get_image_cache()
+        if not cache:
+            return None
+        return cache.get(ImageCache.key(self._image_endpoint, region, resolution, rotation))
+
+    def _cache_image_bytes(self, region: str, resolution: str, rotation: Union[int, str], content: bytes) -> None:
+        cache = get_image_cache()
+        if cache:
+            cache.put(ImageCache.key(self._image_endpoint, region, resolution, rotation), content)
+
+    @staticmethod
+    def _decode_image(content: bytes) -> "Cv2Image":
+        return np.array(Image.open(BytesIO(content)))
+
     @property
     def mask(self):
         return self._mask
@@ -1,2 +1,2 @@
-from .baseclass import Mask, RectangleMask
+from .baseclass import Mask, RectangleMask, LazyFullImageMask
 from .generator import MaskGenerator
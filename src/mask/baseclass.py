@@ -1,8 +1,8 @@
 from typing import TYPE_CHECKING
-import requests
 
 
 from ..custom_types import PixelCoordinate
+from ..imageinfo import get_image_dimensions
 
 class Mask:
     _coordinates: list["PixelCoordinate"]
@@ -12,11 +12,7 @@ class Mask:
 
     @classmethod
     def full_image(cls, image_endpoint: str) -> "Mask":
-        info_url = image_endpoint + "/info.json"
-
-        info_json = requests.get(info_url).json()
-        width = info_json["width"]
-        height = info_json["height"]
+        width, height = get_image_dimensions(image_endpoint)
 
         top_left = PixelCoordinate(0, height)
         bottom_right = PixelCoordinate(width, 0)
@@ -93,3 +89,29 @@ class RectangleMask(Mask):
             raise ValueError("Bottom right y is bigger than top right y")
         if self.top_left.x > self.top_right.x:
             raise ValueError("Top left x is bigger than top right x")
+
+
+class LazyFullImageMask(RectangleMask):
+    """Rectangle mask covering the full image, of which the size is only requested once it's needed.
+
+    This avoids a request for the info.json of the image when the mask is never used.
+    """
+    _image_endpoint: str
+
+    def __init__(self, image_endpoint: str):
+        self._image_endpoint = image_endpoint
+        self._resolved_coordinates = None
+
+    @property
+    def _coordinates(self) -> list["PixelCoordinate"]:
+        if self._resolved_coordinates is None:
+            self._resolved_coordinates = RectangleMask.full_image(self._image_endpoint)._coordinates
+        return self._resolved_coordinates
+
+    @_coordinates.setter
+    def _coordinates(self, coordinates: list["PixelCoordinate"]):
+        self._resolved_coordinates = coordinates
+
+    @property
+    def is_resolved(self) -> bool:
+        return self._resolved_coordinates is not None
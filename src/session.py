@@ -0,0 +1,157 @@
+"""Shared HTTP sessions for all network traffic of the package.
+
+All requests to IIIF servers, tile servers and the geocoder go through the sessions in this module,
+so that connections are kept alive and pooled instead of doing a TCP and TLS handshake per request.
+
+Usage:
+```
+from src.session import configure_session
+configure_session(pool_maxsize=32, timeout=30, retries=5)
+```
+Tests can replace the session by any object with a `get` method using `set_session`.
+"""
+import asyncio
+import dataclasses
+import logging
+from dataclasses import dataclass
+from typing import TYPE_CHECKING, Any, Optional, Union
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+if TYPE_CHECKING:
+    import aiohttp
+
+# Status codes that are worth retrying, since they are usually caused by an overloaded server.
+RETRY_STATUS_CODES = (429, 500, 502, 503, 504)
+
+
+@dataclass
+class SessionConfig:
+    pool_connections: int = 10  # Number of hosts to keep a connection pool for
+    pool_maxsize: int = 10  # Number of connections kept alive per host
+    timeout: Union[float, tuple[float, float]] = (10, 120)  # Connect and read timeout in seconds
+    retries: int = 3
+    backoff_factor: float = 0.5  # Sleep between retries is backoff_factor * 2 ** (retry - 1) seconds
+    user_agent: str = "iiifmap"
+
+
+_config = SessionConfig()
+_session: Optional[Any] = None
+
+
+def _create_session(config: SessionConfig) -> requests.Session:
+    retry = Retry(
+        total=config.retries,
+        backoff_factor=config.backoff_factor,
+        status_forcelist=RETRY_STATUS_CODES,
+        allowed_methods=["GET", "HEAD"],
+        raise_on_status=False,
+    )
+    adapter = HTTPAdapter(
+        pool_connections=config.pool_connections,
+        pool_maxsize=config.pool_maxsize,
+        max_retries=retry,
+    )
+    session = requests.Session()
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    session.headers["User-Agent"] = config.user_agent
+    return session
+
+
+def configure_session(**kwargs) -> requests.Session:
+    """Replaces the shared session by one with the given settings.
+
+    Args:
+        **kwargs: Any of the fields of `SessionConfig`. Fields that are not given keep their current value.
+
+    Returns:
+        requests.Session: The new shared session.
+    """
+    global _config, _session
+    # All settings are checked before any is applied, so an unknown one leaves the configuration unchanged
+    unknown = [key for key in kwargs if not hasattr(_config, key)]
+    if unknown:
+        raise TypeError(f"Unknown session setting: {', '.join(unknown)}")
+    _config = dataclasses.replace(_config, **kwargs)
+
+    if _session is not None and hasattr(_session, "close"):
+        _session.close()
+    _session = _create_session(_config)
+    logging.debug(f"Configured HTTP session with {_config}.")
+    return _session
+
+
+def get_session() -> Any:
+    """Returns the shared session, creating it with the default settings on first use."""
+    global _session
+    if _session is None:
+        _session = _create_session(_config)
+    return _session
+
+
+def set_session(session: Any) -> None:
+    """Replaces the shared session, e.g. by a local stand-in in tests. None resets to the default."""
+    global _session
+    _session = session
+
+
+def get_config() -> SessionConfig:
+    return _config
+
+
+def get(url: str, **kwargs) -> requests.Response:
+    """GET request through the shared session, using the configured timeout unless one is given."""
+    kwargs.setdefault("timeout", _config.timeout)
+    return get_session().get(url, **kwargs)
+
+
+def create_async_session(limit: int = 100, limit_per_host: Optional[int] = None) -> "aiohttp.ClientSession":
+    """Creates an aiohttp session with the same pool size and timeout settings as the shared session.
+
+    aiohttp sessions are bound to an event loop, so these can't be shared between calls to
+    `asyncio.run` and should be used as an async context manager.
+
+    Args:
+        limit (int, optional): Maximum number of simultaneous connections. Defaults to 100.
+        limit_per_host (int, optional): Maximum number of simultaneous connections to a single host.
+            Defaults to the configured pool_maxsize.
+    """
+    import aiohttp  # Imported here since it's slow and only needed for concurrent downloads
+
+    if limit_per_host is None:
+        limit_per_host = _config.pool_maxsize
+    if isinstance(_config.timeout, tuple):
+        connect_timeout, read_timeout = _config.timeout
+        timeout = aiohttp.ClientTimeout(sock_connect=connect_timeout, sock_read=read_timeout)
+    else:
+        timeout = aiohttp.ClientTimeout(total=_config.timeout)
+    connector = aiohttp.TCPConnector(limit=limit, limit_per_host=limit_per_host)
+    return aiohttp.ClientSession(
+        connector=connector, timeout=timeout, headers={"User-Agent": _config.user_agent}
+    )
+
+
+async def async_get(http_session: "aiohttp.ClientSession", url: str) -> bytes:
+    """Async GET request with the same retry and backoff behaviour as the shared session.
+
+    Raises:
+        RuntimeError: If the request still fails after the configured number of retries.
+    """
+    import aiohttp
+
+    for attempt in range(_config.retries + 1):
+        if attempt:
+            await asyncio.sleep(_config.backoff_factor * 2 ** (attempt - 1))
+        try:
+            async with http_session.get(url) as response:
+                if response.status == 200:  # OK
+                    return await response.read()
+                if response.status not in RETRY_STATUS_CODES:
+                    raise RuntimeError(f"Failed to download {url}, HTTP status code: {response.status}")
+                logging.debug(f"HTTP status {response.status} for {url}, retrying.")
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            logging.debug(f"{type(e).__name__} for {url}, retrying.")
+    raise RuntimeError(f"Failed to download {url} after {_config.retries} retries.")
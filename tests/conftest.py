@@ -2,10 +2,20 @@ import pytest
 from PIL import Image
 import io
 import json
+from unittest.mock import MagicMock
 
 from src import MapSeries
+from src import session
 
 
+@pytest.fixture
+def mock_session():
+    """Replaces the shared HTTP session by a mock, so no requests go over the network."""
+    stand_in = MagicMock()
+    session.set_session(stand_in)
+    yield stand_in
+    session.set_session(None)
+
 @pytest.fixture
 def sample_image_bytes():
     image = Image.new('RGB', (50, 50), color='red')  # Create a 50x50 red image
@@ -0,0 +1,125 @@
+import asyncio
+from unittest import mock
+
+import numpy as np
+import pytest
+
+from src import MapSheet, configure_image_cache, configure_tile_cache
+from src.cache import ImageCache, TileCache
+from src.georeference.referencemap import fetch_tile
+
+
+@pytest.fixture
+def image_cache(tmp_path):
+    cache = configure_image_cache(str(tmp_path / "images"))
+    yield cache
+    configure_image_cache(None)
+
+
+@pytest.fixture
+def tile_cache(tmp_path):
+    cache = configure_tile_cache(str(tmp_path / "tiles.sqlite"))
+    yield cache
+    configure_tile_cache(None)
+
+
+def test_cache_key_depends_on_request():
+    key = ImageCache.key("Endpoint", "full", "max", 0)
+    assert key == ImageCache.key("Endpoint", "full", "max", 0)
+    assert key != ImageCache.key("Endpoint", "full", "pct:50", 0)
+    assert key != ImageCache.key("Endpoint", "0,0,10,10", "max", 0)
+
+
+def test_cache_hit_and_miss(tmp_path):
+    cache = ImageCache(str(tmp_path))
+    assert cache.get("a") is None
+    cache.put("a", b"content")
+    assert cache.get("a") == b"content"
+    assert cache.stats()["hits"] == 1
+    assert cache.stats()["misses"] == 1
+    assert cache.stats()["bytes_saved"] == len(b"content")
+
+
+def test_cache_persists_between_instances(tmp_path):
+    ImageCache(str(tmp_path)).put("a", b"content")
+    assert ImageCache(str(tmp_path)).get("a") == b"content"
+
+
+def test_cache_evicts_least_recently_used(tmp_path):
+    cache = ImageCache(str(tmp_path), max_bytes=10)
+    cache.put("a", b"aaaa")
+    cache.put("b", b"bbbb")
+    cache._index["a.bin"] = (0, 4)  # Make "a" the oldest regardless of the file system clock
+    cache.put("c", b"cccc")
+    assert cache.get("a") is None
+    assert cache.get("b") == b"bbbb"
+    assert cache.get("c") == b"cccc"
+    assert cache.size_bytes <= 10
+
+
+def test_get_image_uses_cache(mock_session, image_cache, sample_image_bytes):
+    mock_session.get.return_value.status_code = 200
+    mock_session.get.return_value.content = sample_image_bytes
+    sheet = MapSheet("Endpoint", create_mask=False)
+    first = sheet.get_image()
+    second = sheet.get_image()
+    assert mock_session.get.call_count == 1
+    assert np.array_equal(first, second)
+    assert image_cache.hits == 1
+    assert image_cache.misses == 1
+
+
+def test_tile_cache_hit_and_miss(tmp_path):
+    cache = TileCache(str(tmp_path / "tiles.sqlite"))
+    assert cache.get("Map", 15, 1, 2) is None
+    cache.put("Map", 15, 1, 2, b"tile")
+    assert cache.get("Map", 15, 1, 2) == b"tile"
+    assert cache.get("Other map", 15, 1, 2) is None
+    assert cache.get("Map", 15, 2, 1) is None
+    assert cache.stats()["hits"] == 1
+    assert cache.stats()["misses"] == 3
+    assert cache.stats()["entries"] == 1
+
+
+def test_tile_cache_persists_between_instances(tmp_path):
+    cache = TileCache(str(tmp_path / "tiles.sqlite"))
+    cache.put("Map", 15, 1, 2, b"tile")
+    cache.close()
+    cache = TileCache(str(tmp_path / "tiles.sqlite"))
+    assert cache.contains("Map", 15, 1, 2)
+    assert cache.size_bytes == len(b"tile")
+
+
+def test_tile_cache_evicts_least_recently_used(tmp_path):
+    cache = TileCache(str(tmp_path / "tiles.sqlite"), max_bytes=10)
+    cache.put("Map", 15, 0, 0, b"aaaa")
+    cache.put("Map", 15, 1, 0, b"bbbb")
+    cache._connection.execute("UPDATE tiles SET last_access = 0 WHERE tile_column = 0")
+    cache.put("Map", 15, 2, 0, b"cccc")
+    assert not cache.contains("Map", 15, 0, 0)
+    assert cache.contains("Map", 15, 1, 0)
+    assert cache.contains("Map", 15, 2, 0)
+    assert cache.size_bytes <= 10
+
+
+def _mock_async_session(status, content):
+    response = mock.MagicMock(status=status)
+    response.read = mock.AsyncMock(return_value=content)
+    session = mock.MagicMock()
+    session.get.return_value.__aenter__.return_value = response
+    return session
+
+
+def test_fetch_tile_uses_cache(tile_cache, sample_image_bytes):
+    session = _mock_async_session(200, sample_image_bytes)
+    first = asyncio.run(fetch_tile(session, 1, 2, 15, "Map"))
+    second = asyncio.run(fetch_tile(session, 1, 2, 15, "Map"))
+    assert session.get.call_count == 1
+    assert np.array_equal(np.array(first), np.array(second))
+    assert tile_cache.get("Map", 15, 1, 2) == sample_image_bytes
+
+
+def test_fetch_tile_does_not_cache_failures(tile_cache):
+    session = _mock_async_session(404, b"")
+    assert asyncio.run(fetch_tile(session, 1, 2, 15, "Map")) is None
+    assert not tile_cache.contains("Map", 15, 1, 2)
@@ -0,0 +1,178 @@
+import os
+
+import numpy as np
+import pytest
+import torch
+
+from extern.cnn_matching.lib import cnn_feature
+from extern.cnn_matching.lib.model import D2Net, set_cpu_backend
+
+
+@pytest.fixture
+def random_model():
+    """D2Net with random weights, so the tests don't need d2_tf.pth."""
+    torch.manual_seed(0)
+    previous_model = cnn_feature._model
+    cnn_feature._model = D2Net(model_file=None, use_cuda=False).eval()
+    yield cnn_feature._model
+    cnn_feature._model = previous_model
+
+
+@pytest.fixture
+def sample_images():
+    rng = np.random.default_rng(0)
+    # Blocky images give more detections than noise
+    return [
+        np.kron(rng.integers(0, 255, (12, 16, 3)), np.ones((8, 8, 1))).astype(np.uint8),
+        np.kron(rng.integers(0, 255, (10, 12, 3)), np.ones((8, 8, 1))).astype(np.uint8),
+        np.kron(rng.integers(0, 255, (12, 16, 3)), np.ones((8, 8, 1))).astype(np.uint8),
+    ]
+
+
+def test_batch_extract_same_size_matches_single(random_model, sample_images):
+    images = [sample_images[0], sample_images[2]]
+    batch_results = cnn_feature.cnn_feature_extract_batch(images, nfeatures=-1, batch_size=2)
+    for image, (keypoints, scores, descriptors) in zip(images, batch_results):
+        expected = cnn_feature.cnn_feature_extract(image, nfeatures=-1)
+        assert len(keypoints) > 0
+        np.testing.assert_allclose(keypoints, expected[0], atol=1e-4)
+        np.testing.assert_allclose(scores, expected[1], atol=1e-4)
+        np.testing.assert_allclose(descriptors, expected[2], atol=1e-4)
+
+
+def test_batch_extract_drops_padding(random_model, sample_images):
+    batch_results = cnn_feature.cnn_feature_extract_batch(sample_images, nfeatures=-1, batch_size=3)
+    assert len(batch_results) == 3
+    for image, (keypoints, _, _) in zip(sample_images, batch_results):
+        assert np.all(keypoints[:, 0] < image.shape[1])
+        assert np.all(keypoints[:, 1] < image.shape[0])
+
+
+@pytest.mark.parametrize("length, size, overlap", [(100, 200, 20), (200, 64, 16), (130, 64, 16), (64, 64, 16)])
+def test_tile_layout_covers_axis_once(length, size, overlap):
+    starts, cores = cnn_feature._tile_layout(length, size, overlap)
+    assert starts[0] == 0
+    assert starts[-1] + min(size, length) == length
+    assert cores[0][0] == 0 and cores[-1][1] == length
+    for (_, core_end), (next_core_start, _) in zip(cores, cores[1:]):
+        assert core_end == next_core_start
+    for start, (core_start, core_end) in zip(starts, cores):
+        assert start <= core_start < core_end <= start + size
+
+
+def test_tiled_extract_single_tile_matches_whole_image(random_model, sample_images):
+    image = sample_images[0]
+    expected = cnn_feature.cnn_feature_extract(image, nfeatures=-1)
+    keypoints, scores, descriptors = cnn_feature.cnn_feature_extract_tiled(image, nfeatures=-1, tile_size=256)
+    np.testing.assert_allclose(keypoints, expected[0], atol=1e-4)
+    np.testing.assert_allclose(scores, expected[1], atol=1e-4)
+
+
+def test_tiled_extract_does_not_duplicate_overlap(random_model, sample_images):
+    image = np.hstack([sample_images[0], sample_images[2]])  # 96 x 256
+    keypoints, scores, descriptors = cnn_feature.cnn_feature_extract_tiled(
+        image, nfeatures=-1, tile_size=96, overlap=32, max_workers=2
+    )
+    assert len(keypoints) > 0
+    assert len(keypoints) == len(scores) == len(descriptors)
+    assert np.all(keypoints[:, 0] < image.shape[1]) and np.all(keypoints[:, 1] < image.shape[0])
+    assert len(np.unique(np.round(keypoints[:, :2]), axis=0)) == len(keypoints)
+
+
+def test_channels_last_matches_default(random_model, sample_images):
+    expected = cnn_feature.cnn_feature_extract(sample_images[0], nfeatures=-1)
+    set_cpu_backend(random_model.dense_feature_extraction, channels_last=True)
+    keypoints, scores, descriptors = cnn_feature.cnn_feature_extract(sample_images[0], nfeatures=-1)
+    np.testing.assert_allclose(keypoints, expected[0], atol=1e-4)
+    np.testing.assert_allclose(descriptors, expected[2], atol=1e-4)
+
+
+def test_bfloat16_backend_gives_fp32_features(random_model, sample_images):
+    set_cpu_backend(random_model.dense_feature_extraction, channels_last=True, bfloat16=True)
+    keypoints, scores, descriptors = cnn_feature.cnn_feature_extract(sample_images[0], nfeatures=-1)
+    assert len(keypoints) > 0
+    assert descriptors.dtype == np.float32
+
+
+@pytest.fixture
+def model_files(tmp_path, monkeypatch):
+    """Random D2-Net weights in a temporary folder, loaded through get_model."""
+    torch.manual_seed(0)
+    weights = tmp_path / "d2_tf.pth"
+    torch.save({"model": D2Net(model_file=None, use_cuda=False).state_dict()}, weights)
+    monkeypatch.setattr(cnn_feature, "model_file", str(weights))
+    monkeypatch.setattr(cnn_feature, "scripted_model_file", str(tmp_path / "d2_tf.torchscript.pt"))
+    monkeypatch.setattr(cnn_feature, "_model", None)
+    return weights
+
+
+def test_filters_are_not_in_state_dict():
+    model = D2Net(model_file=None, use_cuda=False)
+    assert not any("filter" in key for key in model.state_dict())
+    assert "dii_filter" in dict(model.detection.named_buffers())
+
+
+def test_get_model_caches_scripted_model(model_files, sample_images):
+    eager = D2Net(model_file=str(model_files), use_cuda=False).eval()
+    model = cnn_feature.get_model()
+    assert isinstance(model, torch.jit.ScriptModule)
+    assert os.path.exists(cnn_feature.scripted_model_file)
+
+    keypoints, scores, descriptors = cnn_feature.cnn_feature_extract(sample_images[0], nfeatures=-1)
+    cnn_feature._model = eager
+    expected = cnn_feature.cnn_feature_extract(sample_images[0], nfeatures=-1)
+    np.testing.assert_allclose(keypoints, expected[0], atol=1e-4)
+    np.testing.assert_allclose(descriptors, expected[2], atol=1e-4)
+
+    cnn_feature._model = None
+    assert isinstance(cnn_feature.get_model(), torch.jit.ScriptModule)
+
+
+def test_bfloat16_backend_loads_eager_model(model_files):
+    assert isinstance(cnn_feature.get_model(), torch.jit.ScriptModule)
+    cnn_feature.configure_cpu_backend(bfloat16=True)
+    try:
+        assert isinstance(cnn_feature.get_model(), D2Net)
+    finally:
+        cnn_feature.configure_cpu_backend(channels_last=False, bfloat16=False)
+
+
+def test_report_per_scale(random_model, sample_images):
+    report = []
+    keypoints, _, _ = cnn_feature.cnn_feature_extract(sample_images[0], nfeatures=-1, report=report)
+    assert [level["scale"] for level in report] == [0.25, 0.5, 1.0]
+    assert report[-1]["size"] == sample_images[0].shape[:2]
+    assert report[-1]["keypoints"] == [len(keypoints)]
+    assert all(level["seconds"] > 0 for level in report)
+
+
+def test_min_keypoints_skips_larger_scales(random_model, sample_images):
+    report = []
+    keypoints, _, _ = cnn_feature.cnn_feature_extract(
+        sample_images[0], scales=[0.5, 1.0], nfeatures=-1, min_keypoints=1, report=report
+    )
+    expected = cnn_feature.cnn_feature_extract(sample_images[0], scales=[0.5], nfeatures=-1)
+    assert len(report) == 1
+    np.testing.assert_array_equal(keypoints, expected[0])
+
+
+def _original_top_features(keypoints, scores, nfeatures):
+    """The original selection of the features with the highest scores, by sorting all of them."""
+    res = np.hstack((np.array([scores]).T, keypoints))
+    res = res[np.lexsort(-res[:, ::-1].T)]
+    return res[0:nfeatures, 1:4], res[0:nfeatures, 0]
+
+
+@pytest.mark.parametrize("nfeatures", [1, 50, 199, 200, 500])
+def test_top_features_match_original(nfeatures):
+    rng = np.random.default_rng(0)
+    keypoints = rng.integers(0, 20, (200, 3)).astype(np.float32)
+    scores = rng.integers(0, 30, 200).astype(np.float32)  # Many ties
+    # Descriptors that tell which keypoint they belong to
+    descriptors = np.hstack([keypoints, scores[:, np.newaxis]])
+
+    result = cnn_feature._postprocess(keypoints[:, [1, 0, 2]].copy(), scores, descriptors, 1, 1, nfeatures)
+    expected = _original_top_features(keypoints, scores, nfeatures)
+    np.testing.assert_array_equal(result[0], expected[0])
+    np.testing.assert_array_equal(result[1], expected[1])
+    np.testing.assert_array_equal(result[2], np.hstack([result[0], result[1][:, np.newaxis]]))
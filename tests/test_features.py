@@ -0,0 +1,123 @@
+from unittest.mock import MagicMock, patch
+
+import numpy as np
+import pytest
+
+from src.georeference.features import (
+    Features, FeatureCache, configure_descriptor_pca, configure_feature_cache, get_mapsheet_features
+)
+from src.georeference.matcher import ReferenceMatcher
+from src.georeference.pca import DescriptorPCA
+
+
+@pytest.fixture
+def sample_features():
+    rng = np.random.default_rng(0)
+    return Features(rng.random((100, 3)), rng.random(100), rng.random((100, 512)).astype(np.float32))
+
+
+def test_features_save_load(tmp_path, sample_features):
+    fp = str(tmp_path / "features.npz")
+    sample_features.save(fp)
+    loaded = Features.load(fp)
+    assert np.array_equal(loaded.descriptors, sample_features.descriptors)
+    assert np.array_equal(loaded.keypoints, sample_features.keypoints)
+    assert len(loaded) == 100
+
+
+def test_feature_cache_key():
+    assert FeatureCache.key("Endpoint", "pct:50") == FeatureCache.key("Endpoint", "pct:50")
+    assert FeatureCache.key("Endpoint", "pct:50") != FeatureCache.key("Endpoint", "pct:25")
+
+
+def test_feature_cache_key_depends_on_precision(tmp_path, sample_features):
+    from extern.cnn_matching.lib import cnn_feature
+
+    cache = FeatureCache(str(tmp_path))
+    cache.put(FeatureCache.key("Endpoint", "pct:50"), sample_features)
+    channels_last = cnn_feature._channels_last
+    try:
+        cnn_feature.configure_cpu_backend(channels_last=channels_last, bfloat16=True)
+        assert cache.get(FeatureCache.key("Endpoint", "pct:50")) is None
+    finally:
+        cnn_feature.configure_cpu_backend(channels_last=channels_last, bfloat16=False)
+    assert cache.get(FeatureCache.key("Endpoint", "pct:50")) is not None
+
+
+def test_feature_cache_memory_limit(sample_features):
+    cache = FeatureCache(memory_entries=1)
+    cache.put("a", sample_features)
+    cache.put("b", sample_features)
+    assert cache.get("a") is None
+    assert cache.get("b") is sample_features
+
+
+def test_feature_cache_on_disk(tmp_path, sample_features):
+    FeatureCache(str(tmp_path)).put("a", sample_features)
+    loaded = FeatureCache(str(tmp_path)).get("a")
+    assert np.array_equal(loaded.scores, sample_features.scores)
+
+
+@patch("src.georeference.features.extract_features")
+def test_mapsheet_features_extracted_once(mock_extract, sample_features):
+    configure_feature_cache()
+    mock_extract.return_value = sample_features
+    sheet = MagicMock()
+    sheet._image_endpoint = "Endpoint"
+    assert get_mapsheet_features(sheet, "pct:50") is sample_features
+    assert get_mapsheet_features(sheet, "pct:50") is sample_features
+    assert mock_extract.call_count == 1
+    assert sheet.get_image.call_count == 1
+
+
+@pytest.fixture
+def low_rank_features():
+    """Features of which the descriptors lie in a 16 dimensional subspace, like a PCA expects."""
+    rng = np.random.default_rng(0)
+    descriptors = rng.normal(size=(500, 16)) @ rng.normal(size=(16, 512))
+    return Features(rng.random((500, 3)) * 100, rng.random(500), descriptors.astype(np.float32))
+
+
+@pytest.fixture
+def descriptor_pca(low_rank_features):
+    pca = configure_descriptor_pca(DescriptorPCA.fit([low_rank_features], dimensions=32, seed=0))
+    yield pca
+    configure_descriptor_pca(None)
+
+
+def test_pca_reduces_descriptors(descriptor_pca, low_rank_features):
+    reduced = descriptor_pca.apply(low_rank_features)
+    assert reduced.descriptors.shape == (500, 32)
+    assert reduced.descriptors.dtype == np.float16
+    assert reduced.keypoints is low_rank_features.keypoints
+    assert descriptor_pca.explained_variance_ratio[:16].sum() > 0.999
+
+
+def test_pca_keeps_matches(descriptor_pca, low_rank_features):
+    rng = np.random.default_rng(1)
+    noisy = Features(low_rank_features.keypoints, low_rank_features.scores,
+                     low_rank_features.descriptors + rng.normal(scale=0.5, size=(500, 512)).astype(np.float32))
+    expected = ReferenceMatcher(low_rank_features).match(noisy)
+    matches = ReferenceMatcher(descriptor_pca.apply(low_rank_features)).match(descriptor_pca.apply(noisy))
+    assert len(matches[0]) >= 0.9 * len(expected[0])
+    # Features of the noisy copy should only match the feature they were made from
+    assert np.array_equal(matches[0], matches[1])
+
+
+def test_pca_save_load(tmp_path, descriptor_pca, low_rank_features):
+    fp = str(tmp_path / "pca.npz")
+    descriptor_pca.save(fp)
+    loaded = configure_descriptor_pca(fp)
+    assert loaded.version == descriptor_pca.version
+    assert np.array_equal(loaded.transform(low_rank_features.descriptors),
+                          descriptor_pca.transform(low_rank_features.descriptors))
+
+
+def test_feature_cache_key_depends_on_pca(low_rank_features):
+    key = FeatureCache.key("Endpoint", "pct:50")
+    configure_descriptor_pca(DescriptorPCA.fit([low_rank_features], dimensions=32))
+    try:
+        assert FeatureCache.key("Endpoint", "pct:50") != key
+    finally:
+        configure_descriptor_pca(None)
+    assert FeatureCache.key("Endpoint", "pct:50") == key
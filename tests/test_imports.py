@@ -0,0 +1,7 @@
+import subprocess
+import sys
+
+
+def test_import_does_not_load_torch():
+    code = "import sys, src; assert 'torch' not in sys.modules, 'torch was imported'"
+    subprocess.run([sys.executable, "-c", code], check=True)
@@ -1,6 +1,10 @@
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
 import pytest
 
-from src import MapSeries
+from src import MapSeries, MapSheet
 
 @pytest.mark.skip
 def test_open_allmaps(sample_mapseries):
@@ -10,4 +14,47 @@ def test_series_from_folder():
     folder = "project/resources/tmk_neat_combined"
     series = MapSeries.from_annotationpage_folder(folder)
     assert series.mapsheets
-    assert series.mapsheets[0].metadata["title"] == "Ameland"
\ No newline at end of file
+    assert series.mapsheets[0].metadata["title"] == "Ameland"
+
+@pytest.fixture
+def image_server(sample_image_bytes):
+    """Local stand-in for an IIIF image server, which answers every request with the same image."""
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if "missing" in self.path:
+                self.send_response(404)
+                self.end_headers()
+                return
+            self.send_response(200)
+            self.send_header("Content-Type", "image/jpeg")
+            self.send_header("Content-Length", str(len(sample_image_bytes)))
+            self.end_headers()
+            self.wfile.write(sample_image_bytes)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{server.server_address[1]}"
+    server.shutdown()
+
+
+def test_fetch_images(image_server):
+    series = MapSeries()
+    series.mapsheets = [MapSheet(f"{image_server}/sheet{i}", create_mask=False) for i in range(10)]
+    series.mapsheets.append(MapSheet(f"{image_server}/missing", create_mask=False))
+
+    fetched = list(series.fetch_images(concurrency=3))
+    assert len(fetched) == 10
+    assert {sheet._image_endpoint for sheet, _ in fetched} == {f"{image_server}/sheet{i}" for i in range(10)}
+    assert all(image.shape == (50, 50, 3) for _, image in fetched)
+
+
+def test_fetch_images_stops_early(image_server):
+    series = MapSeries()
+    series.mapsheets = [MapSheet(f"{image_server}/sheet{i}", create_mask=False) for i in range(20)]
+    for sheet, image in series.fetch_images(concurrency=2):
+        break
+    assert isinstance(image, np.ndarray)
@@ -1,9 +1,16 @@
+import asyncio
+import io
 import json
+from unittest.mock import MagicMock
 
 import numpy as np
 import pytest
-from src import Resolution, MapSheet
-from unittest.mock import patch
+import requests
+from PIL import Image
+
+from src import Resolution, MapSheet, configure_info_cache, get_image_info, prefetch_image_info, session
+from src import imageinfo
+from src.cache import get_info_cache
 
 from src.custom_types import PixelCoordinate
 from src.mask.baseclass import RectangleMask
@@ -36,10 +43,9 @@ def test_percentage_size_type_error():
         Resolution.percentage_size("50")
 
 
-@patch("requests.get")
-def test_init(mock_get):
-    mock_get.return_value.status_code = 200
-    mock_get.return_value.content = json.dumps({"width": 300, "height": 300})
+def test_init(mock_session):
+    mock_session.get.return_value.status_code = 200
+    mock_session.get.return_value.content = json.dumps({"width": 300, "height": 300})
     sheet = MapSheet("Endpoint")
     assert sheet._image_endpoint == "Endpoint"
 
@@ -67,19 +73,17 @@ def test_mapsheet_to_annotationpage(sample_annotationpage):
         assert original_item[key] == value
 
 # Mocking request for get_image
-@patch("requests.get")
-def test_get_image(mock_get, sample_image_bytes):
-    mock_get.return_value.status_code = 200
-    mock_get.return_value.content = sample_image_bytes
+def test_get_image(mock_session, sample_image_bytes):
+    mock_session.get.return_value.status_code = 200
+    mock_session.get.return_value.content = sample_image_bytes
     sheet = MapSheet("Endpoint")
     assert isinstance(sheet.get_image(), np.ndarray)  # Your own assertion here
 
 
 # Mocking request for get_image
-@patch("requests.get")
-def test_get_image_region(mock_get, sample_image_bytes):
-    mock_get.return_value.status_code = 200
-    mock_get.return_value.content = sample_image_bytes
+def test_get_image_region(mock_session, sample_image_bytes):
+    mock_session.get.return_value.status_code = 200
+    mock_session.get.return_value.content = sample_image_bytes
     sheet = MapSheet("Endpoint")
     assert isinstance(
         sheet.get_image_region(0, 0, 100, 100), np.ndarray
@@ -87,9 +91,135 @@ def test_get_image_region(mock_get, sample_image_bytes):
 
 
 # Mocking request for get_image
-@patch("requests.get")
-def test_get_image_failure(mock_get):
-    mock_get.return_value.status_code = 404
+def test_get_image_failure(mock_session):
+    mock_session.get.return_value.status_code = 404
     sheet = MapSheet("Endpoint")
     with pytest.raises(RuntimeError):
         sheet.get_image()
+
+
+def test_init_does_not_request_info(mock_session):
+    configure_info_cache()
+    mock_session.get.return_value.json.return_value = {"width": 300, "height": 200}
+    sheet = MapSheet("Endpoint")
+    assert mock_session.get.call_count == 0
+    assert sheet.mask.top_right == PixelCoordinate(300, 200)
+    assert mock_session.get.call_count == 1
+
+    # The info.json is only requested once per endpoint
+    other_sheet = MapSheet("Endpoint")
+    assert other_sheet.mask.as_svg_selector() == sheet.mask.as_svg_selector()
+    assert mock_session.get.call_count == 1
+
+
+def test_info_error_is_not_cached(mock_session):
+    configure_info_cache()
+    mock_session.get.return_value.raise_for_status.side_effect = requests.HTTPError("404 Client Error")
+    mock_session.get.return_value.json.return_value = {"error": "Not found"}
+    with pytest.raises(requests.HTTPError):
+        get_image_info("Endpoint")
+    assert get_info_cache().get("Endpoint") is None
+
+
+def test_prefetch_skips_info_errors(monkeypatch):
+    configure_info_cache()
+
+    async def async_get(http_session, url):
+        if "Missing" in url:
+            raise RuntimeError(f"Failed to download {url}, HTTP status code: 404")
+        return json.dumps({"width": 300, "height": 200}).encode()
+
+    monkeypatch.setattr(imageinfo, "async_get", async_get)
+    infos = prefetch_image_info(["Endpoint", "Missing"])
+    assert infos == {"Endpoint": {"width": 300, "height": 200}}
+    assert get_info_cache().get("Missing") is None
+
+
+def test_prefetch_from_running_event_loop(monkeypatch):
+    configure_info_cache()
+
+    async def async_get(http_session, url):
+        return json.dumps({"width": 300, "height": 200}).encode()
+
+    async def caller():
+        return prefetch_image_info(["Endpoint"])
+
+    monkeypatch.setattr(imageinfo, "async_get", async_get)
+    assert asyncio.run(caller()) == {"Endpoint": {"width": 300, "height": 200}}
+
+
+def test_info_cache_on_disk(tmp_path):
+    configure_info_cache(str(tmp_path)).put("Endpoint", {"width": 300, "height": 200})
+    assert configure_info_cache(str(tmp_path)).get("Endpoint") == {"width": 300, "height": 200}
+    assert configure_info_cache(str(tmp_path), ttl_seconds=-1).get("Endpoint") is None
+    configure_info_cache()
+
+
+class TiledImageServer:
+    """Local stand-in for an IIIF image server with native tiles, serving a random image."""
+
+    def __init__(self, width, height, tile_size):
+        rng = np.random.default_rng(0)
+        self.image = rng.integers(0, 255, (height, width, 3), dtype=np.uint8)
+        self.info = {"width": width, "height": height,
+                     "tiles": [{"width": tile_size, "scaleFactors": [1, 2, 4]}]}
+        self.requested = []
+
+    def get(self, url, **kwargs):
+        response = MagicMock()
+        response.status_code = 200
+        if url.endswith("/info.json"):
+            response.json.return_value = self.info
+            return response
+        region, size = url.split("/")[-4:-2]
+        self.requested.append(region)
+        x, y, w, h = map(int, region.split(","))
+        crop = self.image[y:y + h, x:x + w]
+        scaled_width = int(size.rstrip(","))
+        if scaled_width != w:
+            crop = crop[::w // scaled_width, ::w // scaled_width]
+        buffer = io.BytesIO()
+        Image.fromarray(crop).save(buffer, format="PNG")
+        response.content = buffer.getvalue()
+        return response
+
+
+@pytest.fixture
+def tiled_server():
+    configure_info_cache()
+    server = TiledImageServer(300, 200, 64)
+    session.set_session(server)
+    yield server
+    session.set_session(None)
+
+
+def test_get_image_tiled(tiled_server):
+    sheet = MapSheet("Endpoint", create_mask=False)
+    image = sheet.get_image_tiled()
+    assert np.array_equal(image, tiled_server.image)
+    assert len(tiled_server.requested) == 5 * 4
+
+
+def test_get_image_tiled_scaled(tiled_server):
+    sheet = MapSheet("Endpoint", create_mask=False)
+    image = sheet.get_image_tiled(scale_factor=2)
+    assert np.array_equal(image, tiled_server.image[::2, ::2])
+
+
+def test_get_image_region_tiled(tiled_server):
+    sheet = MapSheet("Endpoint", create_mask=False)
+    image = sheet.get_image_region_tiled(70, 10, 100, 60)
+    assert np.array_equal(image, tiled_server.image[10:70, 70:170])
+    assert len(tiled_server.requested) == 4
+
+
+def test_get_image_region_tiled_unaligned_and_scaled(tiled_server):
+    sheet = MapSheet("Endpoint", create_mask=False)
+    image = sheet.get_image_region_tiled(71, 11, 100, 61, scale_factor=2)
+    assert np.array_equal(image, tiled_server.image[10:72:2, 70:170:2])
+
+
+def test_get_image_region_tiled_negative_origin(tiled_server):
+    sheet = MapSheet("Endpoint", create_mask=False)
+    image = sheet.get_image_region_tiled(-10, -5, 50, 30)
+    assert np.array_equal(image, tiled_server.image[0:25, 0:40])
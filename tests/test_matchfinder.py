@@ -0,0 +1,291 @@
+from unittest.mock import MagicMock, patch
+
+import cv2
+import numpy as np
+import pytest
+
+from src.custom_types import PixelCoordinate, Wgs84Coordinate
+from src.georeference.baseclasses import ControlPoint, Georeference
+from src.georeference.matchfinder import (
+    GeoreferenceMatchFinder, REFINEMENT_KEEP_BEST, REFINEMENT_PERCENTAGE, _consistent_controlpoints,
+    _get_refinement_box, _refinement_windows,
+    verify_mapsheet_matches
+)
+
+from src.georeference.features import Features, FeatureCache
+from src.georeference.matcher import ReferenceMatcher, _ratio_test
+from src.georeference.referencemap import TileGridGeoreference, searchbox_pixel_bounds
+
+
+def _ratio_test_loop(matches, kps_image, kps_reference):
+    """The original implementation of the ratio test, on cv2.DMatch objects."""
+    disdif_avg = 0
+    for m, n in matches:
+        disdif_avg += n.distance - m.distance
+    disdif_avg = disdif_avg / len(matches)
+
+    match_locations_on_image = []
+    match_locations_on_reference = []
+    for m, n in matches:
+        if n.distance > m.distance + disdif_avg:
+            p2 = cv2.KeyPoint(kps_reference[m.trainIdx][0], kps_reference[m.trainIdx][1], 1)
+            p1 = cv2.KeyPoint(kps_image[m.queryIdx][0], kps_image[m.queryIdx][1], 1)
+            match_locations_on_image.append([p1.pt[0], p1.pt[1]])
+            match_locations_on_reference.append([p2.pt[0], p2.pt[1]])
+
+    return np.array(match_locations_on_image), np.array(match_locations_on_reference)
+
+
+def test_ratio_test_identical_to_loop():
+    rng = np.random.default_rng(0)
+    des_image = rng.random((300, 16)).astype(np.float32)
+    des_reference = rng.random((400, 16)).astype(np.float32)
+    kps_image = rng.random((300, 3)) * 1000
+    kps_reference = rng.random((400, 3)) * 1000
+
+    # Exact (brute force) search, so both implementations get the same neighbours
+    matches = cv2.FlannBasedMatcher(dict(algorithm=0), dict()).knnMatch(des_image, des_reference, k=2)
+    indices, distances = cv2.flann_Index(des_reference, dict(algorithm=0)).knnSearch(des_image, 2, params=dict())
+
+    expected = _ratio_test_loop(matches, kps_image, kps_reference)
+    result = _ratio_test(indices, distances, kps_image, kps_reference)
+    assert len(result[0]) > 0
+    assert np.array_equal(result[0], expected[0])
+    assert np.array_equal(result[1], expected[1])
+
+
+def test_reference_matcher_save_load(tmp_path):
+    rng = np.random.default_rng(0)
+    reference = Features(rng.random((400, 3)) * 1000, rng.random(400), rng.random((400, 16)).astype(np.float32))
+    image = Features(rng.random((300, 3)) * 1000, rng.random(300), rng.random((300, 16)).astype(np.float32))
+
+    matcher = ReferenceMatcher(reference, trees=4, checks=32)
+    matcher.save(str(tmp_path / "index.flann"))
+    loaded = ReferenceMatcher.load(reference, str(tmp_path / "index.flann"), trees=4, checks=32)
+    expected = matcher.match(image)
+    result = loaded.match(image)
+    assert np.array_equal(result[0], expected[0])
+    assert np.array_equal(result[1], expected[1])
+
+
+def test_feature_cache_reuses_matcher(tmp_path):
+    rng = np.random.default_rng(0)
+    reference = Features(rng.random((400, 3)) * 1000, rng.random(400), rng.random((400, 16)).astype(np.float32))
+    cache = FeatureCache(str(tmp_path))
+    matcher = cache.get_matcher("a", reference)
+    assert cache.get_matcher("a", reference) is matcher
+    assert (tmp_path / "a.trees5.flann").exists()
+    assert FeatureCache(str(tmp_path)).get_matcher("a", reference) is not matcher
+
+
+def _synthetic_matches(n=200, outliers=0.3, seed=0):
+    rng = np.random.default_rng(seed)
+    image = rng.random((n, 2)) * 2000
+    affine = np.array([[0.5, 0.02, 100], [-0.01, 0.5, 300]])
+    reference = image @ affine[:, :2].T + affine[:, 2] + rng.normal(0, 1, (n, 2))
+    n_outliers = int(n * outliers)
+    reference[:n_outliers] = rng.random((n_outliers, 2)) * 1000
+    return image, reference
+
+
+def test_verify_mapsheet_matches_reproducible():
+    matches = _synthetic_matches()
+    georeferenced_mapsheet = MagicMock()
+    georeferenced_mapsheet._georeference.interpolate.side_effect = lambda px: Wgs84Coordinate(px.y, px.x)
+
+    first = verify_mapsheet_matches(matches, georeferenced_mapsheet, seed=3)
+    second = verify_mapsheet_matches(matches, georeferenced_mapsheet, seed=3)
+    assert len(first.control_points) == 5
+    assert [cp.pixel_coordinate for cp in first.control_points] == \
+           [cp.pixel_coordinate for cp in second.control_points]
+
+
+# Full resolution pixels of a 4000 x 3000 mapsheet to WGS84, with a slight rotation
+SHEET_GEOREFERENCE = Georeference([
+    ControlPoint(PixelCoordinate(0, 0), Wgs84Coordinate(52.10, 5.10)),
+    ControlPoint(PixelCoordinate(4000, 0), Wgs84Coordinate(52.101, 5.20)),
+    ControlPoint(PixelCoordinate(0, 3000), Wgs84Coordinate(52.04, 5.1005)),
+    ControlPoint(PixelCoordinate(4000, 3000), Wgs84Coordinate(52.041, 5.2005)),
+])
+
+
+def test_refinement_windows_cover_image():
+    windows = _refinement_windows(1001, 700, 3)
+    assert len(windows) == 9
+    assert sum(w * h for _, _, w, h in windows) == 1001 * 700
+    assert windows[-1][0] + windows[-1][2] == 1001
+    assert windows[-1][1] + windows[-1][3] == 700
+
+
+def test_refinement_box_contains_window():
+    top_left, bottom_right = _get_refinement_box((1000, 1000, 1000, 1000), SHEET_GEOREFERENCE, 100)
+    corners = [
+        SHEET_GEOREFERENCE.interpolate(PixelCoordinate(px, py))
+        for px, py in ((1000, 1000), (2000, 1000), (1000, 2000), (2000, 2000))
+    ]
+    for corner in corners:
+        assert bottom_right.lat < corner.lat < top_left.lat
+        assert top_left.lon < corner.lon < bottom_right.lon
+    assert top_left.lat - max(corner.lat for corner in corners) == pytest.approx(100 / 111139)
+
+
+def _refine(window_matches=None):
+    """Refines a georeference that is off by about 200 meters, with matches that agree with SHEET_GEOREFERENCE.
+
+    `window_matches` can replace the matches of a window, given the window image and the reference image.
+    """
+    requested = {}
+
+    def get_image_region(x, y, width, height, resolution):
+        requested["window"] = (x, y)
+        return np.zeros((height * REFINEMENT_PERCENTAGE // 100, width * REFINEMENT_PERCENTAGE // 100, 3), np.uint8)
+
+    def extract_searchbox(searchbox, resolution):
+        left, top, right, bottom = searchbox_pixel_bounds(searchbox, resolution)
+        requested["georeference"] = TileGridGeoreference(resolution, left, top)
+        return np.zeros((bottom - top, right - left, 3), np.uint8), requested["georeference"]
+
+    def find_guided_matches(window_image, reference_image, prior, tolerance):
+        if requested["window"] == (2000, 0) and window_matches is not None:
+            return window_matches(window_image, reference_image)
+        # Matches that agree with SHEET_GEOREFERENCE, on the reference image of the requested search box
+        rng = np.random.default_rng(0)
+        on_window = rng.random((20, 2)) * window_image.shape[1::-1]
+        on_reference = [
+            requested["georeference"].pixel_of(SHEET_GEOREFERENCE.interpolate(PixelCoordinate(px, py)))
+            for px, py in on_window * (100 / REFINEMENT_PERCENTAGE) + requested["window"]
+        ]
+        # The prior is only off by the error of the coarse georeference
+        predicted = on_window @ prior[:, :2].T + prior[:, 2]
+        assert np.all(np.linalg.norm(predicted - on_reference, axis=1) < tolerance)
+        return on_window, np.array(on_reference)
+
+    mapsheet = MagicMock()
+    mapsheet.get_image_region.side_effect = get_image_region
+    reference_map = MagicMock()
+    reference_map.extract_searchbox.side_effect = extract_searchbox
+    coarse = Georeference([
+        ControlPoint(cp.pixel_coordinate, Wgs84Coordinate(cp.wgs84_coordinate.lat + 0.002, cp.wgs84_coordinate.lon))
+        for cp in SHEET_GEOREFERENCE.control_points
+    ])
+
+    finder = GeoreferenceMatchFinder(reference_map, 30_000, 20_000, refine=True, refinement_grid=2)
+    with patch("src.georeference.matchfinder.get_image_dimensions", return_value=(4000, 3000)), \
+            patch("src.georeference.matchfinder._find_guided_matches", side_effect=find_guided_matches):
+        controlpoints = finder.refine_georeference(mapsheet, coarse)
+    assert reference_map.extract_searchbox.call_count == 4
+    return controlpoints
+
+
+def _assert_recovers_georeference(controlpoints):
+    refined = Georeference(controlpoints)
+    for px, py in ((0, 0), (4000, 3000), (1234, 2345)):
+        expected = SHEET_GEOREFERENCE.interpolate(PixelCoordinate(px, py))
+        actual = refined.interpolate(PixelCoordinate(px, py))
+        assert abs(actual.lat - expected.lat) < 1e-6
+        assert abs(actual.lon - expected.lon) < 1e-6
+
+
+def test_refinement_recovers_georeference():
+    """Windows are matched on the part of the reference map predicted by a slightly wrong georeference."""
+    controlpoints = _refine()
+    assert len(controlpoints) == 4 * REFINEMENT_KEEP_BEST
+    _assert_recovers_georeference(controlpoints)
+
+
+def _random_matches(window_image, reference_image):
+    rng = np.random.default_rng(1)
+    return rng.random((30, 2)) * window_image.shape[1::-1], rng.random((30, 2)) * reference_image.shape[1::-1]
+
+
+def _far_away_matches(window_image, reference_image):
+    # Consistent among themselves, but 2 kilometers from where the coarse georeference puts the window
+    on_window = np.random.default_rng(1).random((20, 2)) * window_image.shape[1::-1]
+    return on_window, on_window * 0.4 + (2000, 0)
+
+
+def _no_matches(window_image, reference_image):
+    return np.zeros((0, 2)), np.zeros((0, 2))
+
+
+@pytest.mark.parametrize("window_matches", [_random_matches, _far_away_matches, _no_matches])
+def test_refinement_skips_inconsistent_window(window_matches):
+    controlpoints = _refine(window_matches)
+    assert len(controlpoints) == 3 * REFINEMENT_KEEP_BEST
+    assert all(cp.pixel_coordinate.x < 2000 or cp.pixel_coordinate.y > 1500 for cp in controlpoints)
+    _assert_recovers_georeference(controlpoints)
+
+
+def test_consistent_controlpoints_drops_outliers():
+    controlpoints = [
+        ControlPoint(PixelCoordinate(px, py), SHEET_GEOREFERENCE.interpolate(PixelCoordinate(px, py)))
+        for px, py in np.random.default_rng(0).random((20, 2)) * (4000, 3000)
+    ]
+    outlier = ControlPoint(PixelCoordinate(100, 100), SHEET_GEOREFERENCE.interpolate(PixelCoordinate(500, 100)))
+    assert _consistent_controlpoints(controlpoints + [outlier], seed=0) == controlpoints
+
+
+def test_refinement_needs_three_lowres_controlpoints():
+    mapsheet = MagicMock()
+    mapsheet.get_image.return_value = np.zeros((100, 100, 3), np.uint8)
+    reference_map = MagicMock()
+    reference_map.extract_searchbox.return_value = (
+        np.zeros((100, 100, 3), np.uint8), TileGridGeoreference(13, 4_000_000, 2_000_000)
+    )
+    finder = GeoreferenceMatchFinder(reference_map, 1000, 1000, refine=True)
+    two_matches = (np.array([[1.0, 2], [3, 4]]), np.array([[5.0, 6], [7, 8]]))
+    with patch("src.georeference.matchfinder._find_matches", return_value=two_matches), \
+            patch.object(finder, "plot"), patch.object(finder, "refine_georeference") as refine_georeference:
+        georeference = finder.get_georeference_from_reference_map(mapsheet, Wgs84Coordinate(52.1, 5.1))
+    refine_georeference.assert_not_called()
+    assert georeference.control_points == []
+
+
+def _repetitive_scene():
+    """Reference features of which every descriptor appears twice, far apart, like repeated map symbols."""
+    rng = np.random.default_rng(0)
+    descriptors = rng.normal(size=(200, 32)).astype(np.float32)
+    keypoints = np.vstack([rng.random((200, 2)) * 500, rng.random((200, 2)) * 500 + 1000])
+    reference = Features(np.hstack([keypoints, np.ones((400, 1))]), np.ones(400), np.vstack([descriptors, descriptors]))
+
+    # The image shows the first half of the reference, scaled by 0.5 and shifted
+    affine = np.array([[2.0, 0, 10], [0, 2.0, 20], [0, 0, 1]])  # image -> reference
+    image_keypoints = (keypoints[:200] - affine[:2, 2]) / 2
+    noisy = descriptors + rng.normal(scale=0.3, size=descriptors.shape).astype(np.float32)
+    image = Features(np.hstack([image_keypoints, np.ones((200, 1))]), np.ones(200), noisy)
+    return image, reference, affine
+
+
+def test_guided_match_uses_prior():
+    image, reference, affine = _repetitive_scene()
+    matcher = ReferenceMatcher(reference)
+
+    on_image, on_reference = matcher.guided_match(image, affine + np.array([[0, 0, 5], [0, 0, -5], [0, 0, 0]]), 30)
+    assert len(on_image) > 50
+    # Every match is the copy of the feature near the predicted location
+    np.testing.assert_allclose(on_image * 2 + affine[:2, 2], on_reference, atol=1e-3)
+
+    # Without the prior the repeated descriptors are ambiguous, so the ratio test rejects most matches
+    assert len(matcher.match(image)[0]) < len(on_image)
+
+
+def test_match_without_image_features():
+    _, reference, _ = _repetitive_scene()
+    empty = Features(np.zeros((0, 3)), np.zeros(0), np.zeros((0, 32), np.float32))
+    on_image, on_reference = ReferenceMatcher(reference).match(empty)
+    assert on_image.shape == (0, 2) and on_reference.shape == (0, 2)
+
+
+def test_match_against_reference_without_two_features():
+    image, _, _ = _repetitive_scene()
+    for n in (0, 1):
+        reference = Features(np.ones((n, 3)), np.ones(n), np.ones((n, 32), np.float32))
+        on_image, on_reference = ReferenceMatcher(reference).match(image)
+        assert on_image.shape == (0, 2) and on_reference.shape == (0, 2)
+
+
+def test_guided_match_without_candidates():
+    image, reference, _ = _repetitive_scene()
+    far_away = np.array([[1.0, 0, 10_000], [0, 1.0, 10_000]])
+    on_image, on_reference = ReferenceMatcher(reference).guided_match(image, far_away, 30)
+    assert on_image.shape == (0, 2) and on_reference.shape == (0, 2)
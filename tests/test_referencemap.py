@@ -0,0 +1,230 @@
+import asyncio
+import contextlib
+import io
+
+import cv2
+import numpy as np
+import pytest
+from PIL import Image
+
+from src import MapSeries, MapSheet, configure_image_cache, configure_info_cache
+from src.cache import get_info_cache
+from src.custom_types import PixelCoordinate, Wgs84Coordinate
+from src.georeference import Georeference, LocalReferenceMap, referencemap
+from src.georeference.baseclasses import ControlPoint
+from src.mask import RectangleMask
+from src.georeference.referencemap import (
+    ReferenceMapResolution, SearchBox, TileGridGeoreference, TileProgress, TileScheduler, construct_composite_image,
+    crop_to_searchbox, pixel_to_latlon, tile_range,
+)
+
+
+@pytest.fixture
+def image_cache(tmp_path):
+    cache = configure_image_cache(str(tmp_path / "images"))
+    yield cache
+    configure_image_cache(None)
+
+
+class FakeTileSession:
+    """Stand-in for an aiohttp session that answers with the given status codes in turn, after a delay."""
+
+    def __init__(self, content, statuses=(200,), delay=0.0):
+        self.content = content
+        self.statuses = list(statuses)
+        self.delay = delay
+        self.calls = 0
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        return False
+
+    @contextlib.asynccontextmanager
+    async def get(self, url, **kwargs):
+        status = self.statuses[min(self.calls, len(self.statuses) - 1)]
+        self.calls += 1
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            await asyncio.sleep(self.delay)
+            yield FakeResponse(status, self.content)
+        finally:
+            self.in_flight -= 1
+
+
+class FakeResponse:
+    def __init__(self, status, content):
+        self.status = status
+        self.content = content
+
+    async def read(self):
+        return self.content
+
+
+def test_scheduler_retries_server_errors(sample_image_bytes):
+    session = FakeTileSession(sample_image_bytes, statuses=(503, 503, 200))
+    progress = TileProgress(1)
+    scheduler = TileScheduler(retries=3, backoff=0.001)
+    image = asyncio.run(scheduler.fetch(session, 1, 2, 15, "Map", progress))
+    assert image is not None
+    assert session.calls == 3
+    assert progress.received == 1 and progress.failed == 0
+
+
+def test_scheduler_does_not_retry_client_errors(sample_image_bytes):
+    session = FakeTileSession(sample_image_bytes, statuses=(404,))
+    progress = TileProgress(1)
+    image = asyncio.run(TileScheduler(backoff=0.001).fetch(session, 1, 2, 15, "Map", progress))
+    assert image is None
+    assert session.calls == 1
+    assert progress.failed == 1
+
+
+def test_scheduler_gives_up_after_timeout(sample_image_bytes):
+    session = FakeTileSession(sample_image_bytes, delay=1)
+    scheduler = TileScheduler(retries=5, timeout=0.01, budget=0.05, backoff=0.001)
+    assert asyncio.run(scheduler.fetch(session, 1, 2, 15, "Map")) is None
+    assert session.calls < 5
+
+
+def test_scheduler_limits_concurrency_across_composites(sample_image_bytes):
+    session = FakeTileSession(sample_image_bytes, delay=0.01)
+    scheduler = TileScheduler(max_concurrent=4)
+    progress_a, progress_b = TileProgress(10), TileProgress(6)
+
+    async def fetch_both():
+        return await asyncio.gather(
+            scheduler.fetch_all(session, [(15, x, 0) for x in range(10)], "Map A", progress_a),
+            scheduler.fetch_all(session, [(15, x, 1) for x in range(6)], "Map B", progress_b),
+        )
+
+    images_a, images_b = asyncio.run(fetch_both())
+    assert len(images_a) == 10 and len(images_b) == 6
+    assert all(image is not None for image in images_a + images_b)
+    assert session.max_in_flight == 4
+    assert progress_a.done == 10 and progress_b.done == 6
+
+
+def _png_tile(color, mode="RGB"):
+    buffer = io.BytesIO()
+    Image.new(mode, (256, 256), color=color).save(buffer, format="PNG")
+    return buffer.getvalue()
+
+
+def test_composite_is_decoded_in_bgr(monkeypatch):
+    session = FakeTileSession(_png_tile((255, 0, 0, 255), mode="RGBA"))
+    monkeypatch.setattr(referencemap, "create_async_session", lambda: session)
+    progress = TileProgress(0)
+    top_left, bottom_right = Wgs84Coordinate(52.10, 5.10), Wgs84Coordinate(52.09, 5.12)
+    composite = asyncio.run(construct_composite_image(top_left, bottom_right, 15, "Map", progress=progress))
+
+    assert composite.dtype == np.uint8 and composite.ndim == 3
+    assert composite.shape[0] % 256 == 0 and composite.shape[1] % 256 == 0
+    assert progress.total == session.calls == composite.shape[0] // 256 * composite.shape[1] // 256
+    assert np.all(composite == (0, 0, 255))
+
+
+def test_composite_leaves_failed_tiles_black(monkeypatch):
+    session = FakeTileSession(_png_tile((255, 0, 0)), statuses=(404, 200))
+    monkeypatch.setattr(referencemap, "create_async_session", lambda: session)
+    top_left, bottom_right = Wgs84Coordinate(52.10, 5.10), Wgs84Coordinate(52.09, 5.12)
+    composite = asyncio.run(construct_composite_image(top_left, bottom_right, 15, "Map"))
+
+    tiles = composite.reshape(composite.shape[0] // 256, 256, composite.shape[1] // 256, 256, 3)
+    black = np.all(tiles == 0, axis=(1, 3, 4))
+    red = np.all(tiles == (0, 0, 255), axis=(1, 3, 4))
+    assert black.sum() == 1
+    assert red.sum() == black.size - 1
+
+
+def _georeferenced_sheet(endpoint, top, left, image):
+    """Sheet of which the image spans 0.01 degrees of latitude and 0.02 degrees of longitude."""
+    height, width = image.shape[:2]
+    sheet = MapSheet(endpoint, create_mask=False)
+    sheet.set_georeference(Georeference([
+        ControlPoint(PixelCoordinate(0, 0), Wgs84Coordinate(top, left)),
+        ControlPoint(PixelCoordinate(width, 0), Wgs84Coordinate(top, left + 0.02)),
+        ControlPoint(PixelCoordinate(0, height), Wgs84Coordinate(top - 0.01, left)),
+    ]))
+    get_info_cache().put(endpoint, {"width": width, "height": height})
+    return sheet
+
+
+def test_local_reference_map_warps_cached_sheets(image_cache):
+    image = np.zeros((500, 1000, 3), dtype=np.uint8)
+    image[:, :500] = (0, 0, 255)  # Red left half, in BGR
+    image[:, 500:] = (255, 0, 0)  # Blue right half
+    cached = _georeferenced_sheet("Cached", 52.10, 5.00, image)
+    cached._cache_image_bytes("full", "max", 0, cv2.imencode(".png", image)[1].tobytes())
+    uncached = _georeferenced_sheet("Uncached", 52.10, 5.02, image)
+    series = MapSeries()
+    series.mapsheets = [cached, uncached]
+
+    reference_map = LocalReferenceMap(series)
+    searchbox = SearchBox(Wgs84Coordinate(52.105, 4.995), Wgs84Coordinate(52.085, 5.045))
+    assert reference_map.sheets_in(SearchBox(Wgs84Coordinate(52.1, 4.9), Wgs84Coordinate(52.0, 5.001))) == [cached]
+    image, georeference = reference_map.extract_searchbox(searchbox, ReferenceMapResolution.HIGH)
+
+    def color_at(lat, lon):
+        x, y = georeference.pixel_of(Wgs84Coordinate(lat, lon))
+        return tuple(image[round(y), round(x)])
+
+    assert color_at(52.095, 5.005) == (0, 0, 255)
+    assert color_at(52.095, 5.015) == (255, 0, 0)
+    assert color_at(52.103, 5.005) == (0, 0, 0)  # Outside of the sheet
+    assert color_at(52.095, 5.03) == (0, 0, 0)  # On the sheet that isn't cached
+
+
+def test_crop_to_searchbox_georeference_is_exact():
+    searchbox = SearchBox(Wgs84Coordinate(52.105, 4.995), Wgs84Coordinate(52.085, 5.045))
+    zoom = ReferenceMapResolution.HIGH
+    xtile1, ytile1, xtile2, ytile2 = tile_range(searchbox, zoom)
+    composite = np.zeros(((ytile2 - ytile1 + 1) * 256, (xtile2 - xtile1 + 1) * 256, 3), np.uint8)
+    image, georeference = crop_to_searchbox(composite, searchbox, zoom)
+
+    # The image starts at the search box, not at the tile boundary. Pixels are indexed by their centres,
+    # so the corners of the box are at most half a pixel outside of the first and last pixel.
+    x, y = georeference.pixel_of(searchbox.top_left)
+    assert -0.5 <= x < 0.5 and -0.5 <= y < 0.5
+    x, y = georeference.pixel_of(searchbox.bottom_right)
+    assert image.shape[1] - 1.5 < x <= image.shape[1] - 0.5 and image.shape[0] - 1.5 < y <= image.shape[0] - 0.5
+
+    # Pixel (i, j) is the centre of that pixel of the tile grid
+    for i, j in ((0, 0), (10, 20), (image.shape[1] - 1, image.shape[0] - 1)):
+        centre = georeference.interpolate(PixelCoordinate(i, j))
+        expected_lat, expected_lon = pixel_to_latlon(georeference.x + i + 0.5, georeference.y + j + 0.5, zoom)
+        assert (centre.lat, centre.lon) == pytest.approx((expected_lat, expected_lon), abs=1e-12)
+
+
+def test_tile_grid_georeference_round_trip():
+    georeference = TileGridGeoreference(15, 16_000 * 256, 10_000 * 256)
+    coordinate = georeference.interpolate(PixelCoordinate(123.5, 456.25))
+    assert georeference.pixel_of(coordinate) == pytest.approx((123.5, 456.25))
+
+
+def test_local_reference_map_does_not_request_info(image_cache, mock_session):
+    image = np.full((250, 500, 3), 255, dtype=np.uint8)
+    sheet = _georeferenced_sheet("Masked", 52.10, 5.00, np.zeros((500, 1000, 3), np.uint8))
+    configure_info_cache()  # Forget the info.json _georeferenced_sheet stored
+    sheet.set_mask(RectangleMask([
+        PixelCoordinate(0, 500), PixelCoordinate(0, 0), PixelCoordinate(1000, 0), PixelCoordinate(1000, 500)
+    ]))
+    sheet._cache_image_bytes("full", "pct:50", 0, cv2.imencode(".png", image)[1].tobytes())
+    series = MapSeries()
+    series.mapsheets = [sheet]
+
+    reference_map = LocalReferenceMap(series, resolution="pct:50")
+    searchbox = SearchBox(Wgs84Coordinate(52.099, 5.001), Wgs84Coordinate(52.091, 5.019))
+    image, _ = reference_map.extract_searchbox(searchbox, ReferenceMapResolution.HIGH)
+    assert np.all(image == 255)
+    assert mock_session.get.call_count == 0
+
+    # Without a mask the size of the image is needed, which must come from the info cache
+    sheet.set_mask(None)
+    with pytest.raises(RuntimeError, match="info.json"):
+        LocalReferenceMap(series)
+    assert mock_session.get.call_count == 0
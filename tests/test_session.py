@@ -0,0 +1,35 @@
+import pytest
+
+from src import session
+
+
+def test_get_uses_configured_timeout(mock_session):
+    session.get("https://example.org")
+    _, kwargs = mock_session.get.call_args
+    assert kwargs["timeout"] == session.get_config().timeout
+
+
+def test_configure_session_pool_and_retries():
+    http_session = session.configure_session(pool_maxsize=4, retries=2)
+    try:
+        adapter = http_session.get_adapter("https://service.archief.nl")
+        assert adapter._pool_maxsize == 4
+        assert adapter.max_retries.total == 2
+        assert session.get_session() is http_session
+    finally:
+        session.configure_session(pool_maxsize=10, retries=3)
+
+
+def test_configure_session_unknown_setting():
+    with pytest.raises(TypeError):
+        session.configure_session(pool_size=4)
+
+
+def test_configure_session_unknown_setting_changes_nothing():
+    config = session.get_config()
+    http_session = session.get_session()
+    with pytest.raises(TypeError):
+        session.configure_session(retries=7, pool_size=4)
+    assert session.get_config() == config
+    assert session.get_config().retries != 7
+    assert session.get_session() is http_session
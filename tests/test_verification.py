@@ -0,0 +1,49 @@
+import numpy as np
+import pytest
+
+from src.georeference.verification import ransac_affine
+
+AFFINE = np.array([[1.9, -0.1, 120], [0.08, 2.05, -40], [0, 0, 1]])
+
+
+def _matches(inlier_ratio, total=500, noise=1.0, seed=0):
+    rng = np.random.default_rng(seed)
+    src = rng.random((total, 2)) * 2000
+    dst = src @ AFFINE[:2, :2].T + AFFINE[:2, 2] + rng.normal(scale=noise, size=(total, 2))
+    is_inlier = rng.random(total) < inlier_ratio
+    dst[~is_inlier] = rng.random(((~is_inlier).sum(), 2)) * 4000
+    return (src, dst), is_inlier
+
+
+@pytest.mark.parametrize("inlier_ratio", [0.2, 0.5, 0.9])
+def test_ransac_recovers_affine(inlier_ratio):
+    matches, is_inlier = _matches(inlier_ratio)
+    result = ransac_affine(matches, residual_threshold=10, seed=0)
+    np.testing.assert_allclose(result.model.params, AFFINE, atol=0.05 * np.abs(AFFINE).max())
+    # Outliers can fall within the threshold by chance, but hardly any
+    assert np.sum(result.inliers != is_inlier) <= 2
+
+
+def test_ransac_stops_early_with_many_inliers():
+    matches, _ = _matches(0.9)
+    assert ransac_affine(matches, residual_threshold=10, seed=0).trials < 100
+    matches, _ = _matches(0.05)
+    assert ransac_affine(matches, residual_threshold=10, seed=0).trials == 1000
+
+
+def test_ransac_is_reproducible():
+    matches, _ = _matches(0.3)
+    first = ransac_affine(matches, residual_threshold=10, seed=42, local_optimization=False)
+    second = ransac_affine(matches, residual_threshold=10, seed=42, local_optimization=False)
+    assert np.array_equal(first.model.params, second.model.params)
+    assert np.array_equal(first.inliers, second.inliers)
+
+
+def test_ransac_degenerate_input():
+    too_few = (np.zeros((2, 2)), np.zeros((2, 2)))
+    assert ransac_affine(too_few, residual_threshold=10).model is None
+
+    collinear = np.stack([np.arange(10.0), np.arange(10.0)], axis=1)
+    result = ransac_affine((collinear, collinear * 2), residual_threshold=1, seed=0)
+    assert result.model is None
+    assert not result.inliers.any()